@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+import json
 from six.moves import cPickle
 import numpy as np
 import scipy.ndimage as nd
@@ -8,6 +9,16 @@ from PIL import Image
 import tensorflow as tf
 import optparse
 from dataset import dataset
+from checkpoint import checkpointer
+from recompute import split_blocks, block_name, recompute_grad
+from feature_cache import feature_store
+from telemetry import monitor
+from footprint import preflight
+from graph_cache import build_cached
+from pred_cache import pred_cache
+from tta import build_views, merge_views
+from sampler import loss_sampler
+from utils import session_config, load_profile, pruned_shape
 
 """
 GAIN-GCAM
@@ -18,6 +29,16 @@ This code implements the model described in the experiment section of GAIN(https
 """
 
 SAVER_PATH, PRED_PATH = "gain_gcam-saver", "gain_gcam-preds"
+PRED_LAYER = "gcam" # layer used to predict the masks
+# layers of VGG16, shared by the paths of `input` and `input_c`
+BLOCK_LAYERS = ["conv1_1","relu1_1","conv1_2","relu1_2","pool1","conv2_1","relu2_1","conv2_2","relu2_2","pool2",
+                "conv3_1","relu3_1","conv3_2","relu3_2","conv3_3","relu3_3","pool3",
+                "conv4_1","relu4_1","conv4_2","relu4_2","conv4_3","relu4_3","pool4",
+                "conv5_1","relu5_1","conv5_2","relu5_2","conv5_3","relu5_3","pool5"]
+FC_LAYERS = ["fc6","relu6","drop6","fc7","relu7","drop7"]
+FEATURE_LAYER = "pool5" # output of the backbone, cached to train the fc layers only
+OPTIMIZER_SLOTS = 2 # AdamOptimizer: two slots per variable
+GRAPH_ATTRS = ("net", "loss", "trainable_list") # python handles of the graph, restored by the graph cache
 
 def parse_arg():
     parser = optparse.OptionParser()
@@ -25,6 +46,16 @@ def parse_arg():
     parser.add_option('-f', dest='gpu_frac', default='0.49', help='specify the memory utilization of GPU')
     parser.add_option('-r', dest='restore_iter_id', default=None, help="continue training? default=False")
     parser.add_option('-a', dest='action', default='train', help="training or inference?")
+    parser.add_option('-s', dest='resume', action='store_true', default=False, help="resume the full training state from the latest checkpoint")
+    parser.add_option('-t', dest='ckpt_interval', default='1800', help="seconds between two training state checkpoints")
+    parser.add_option('-e', dest='feature_cache', default=None, help="directory of the backbone feature cache (-a cache | train_head)")
+    parser.add_option('-o', dest='overrides', default='{}', help="JSON of config and hyperparameter overrides, e.g. '{\"base_lr\":5e-4,\"accum_num\":8,\"crf_config\":{\"bi_srgb\":20}}'")
+    parser.add_option('-c', dest='graph_cache', default=None, help="directory of the graph cache: import the graph built by a previous launch with the same code and config")
+    parser.add_option('-j', dest='thread_profile', default=None, help="thread profile written by tune_threads.py (session threads, tf.data threads, crf workers, cores)")
+    parser.add_option('-d', dest='pred_cache', default=None, help="directory of the prediction cache (-a inference): only the images or checkpoints not seen yet are predicted")
+    parser.add_option('-p', dest='preflight', default='off', help="memory check before training: off, check (refuse a config that does not fit) or shrink (turn on the memory savings until it fits, this changes the config of the run)")
+    parser.add_option('-m', dest='recompute', action='store_true', default=False, help="gradient checkpointing: recompute the activations inside the VGG16 blocks in the backward pass")
+    parser.add_option('-k', dest='am_chunk', default='0', help="number of complement images per attention mining chunk, 0: all at once")
     (options, args) = parser.parse_args()
     return options
 
@@ -41,52 +72,61 @@ class GAIN():
         self.trainable_list, self.lr_1_list, self.lr_2_list, self.lr_4_list, self.lr_8_list = [], [], [], [], []
         self.stride["input"] = 1
         self.stride["input_c"] = 1
+        self.stride["input_c_chunk"] = 1
+        # weights used by each conv layer, and the ones to use while recomputing a block (gradient checkpointing)
+        self.block_params, self.recompute_params = {}, None
+        # performance telemetry, set while training
+        self.monitor = None
 
     def build(self):
         if "output" not in self.net:
             with tf.name_scope("placeholder"):
                 self.net["input"] = tf.placeholder(tf.float32,[None,self.h,self.w,self.config.get("input_channel",3)])
+                if self.config.get("tta"): # test-time augmentation: the images are fed to `tta_input`, `input` is the batch of their views
+                    self.net["tta_input"], self.net["input"] = self.net["input"], build_views(self.net["input"],**self.config["tta"])
                 self.net["label"] = tf.placeholder(tf.int32,[None,self.category_num])
                 self.net["drop_prob"] = tf.placeholder(tf.float32)
+                # frozen backbone: its output comes from the feature cache
+                if self.config.get("head_only", False): self.net["feature"] = tf.placeholder(tf.float32,[None,41,41,self.config.get("widths",{}).get("conv5_3",512)]) # conv5_3 may be pruned
             self.net["output"] = self.create_network()
         return self.net["output"]
     def create_network(self):
         if "init_model_path" in self.config: self.load_init_model()
         # path of `input` to VGG16
         with tf.name_scope("vgg16") as scope:
-            block = self.build_block("input", [
-                "conv1_1","relu1_1","conv1_2","relu1_2","pool1","conv2_1","relu2_1","conv2_2","relu2_2","pool2",
-                "conv3_1","relu3_1","conv3_2","relu3_2","conv3_3","relu3_3","pool3",
-                "conv4_1","relu4_1","conv4_2","relu4_2","conv4_3","relu4_3","pool4",
-                "conv5_1","relu5_1","conv5_2","relu5_2","conv5_3","relu5_3","pool5"])
-            last_layer = self.build_fc(block, ["fc6","relu6","drop6","fc7","relu7","drop7"])
+            block = self.build_block("input", BLOCK_LAYERS)
+            if self.config.get("head_only", False): block = "feature"
+            last_layer = self.build_fc(block, FC_LAYERS)
             self.net[last_layer] = tf.reduce_sum(self.net[last_layer], axis=(1,2))
             fc = self.build_fc(last_layer, ["fc8"])
             # generate the attention map with Grad-CAM
-            self.build_grad_cam(target="fc8", fmap="pool5")
+            self.build_grad_cam(target="fc8", fmap=block)
+        # attention mining needs the backbone on the complement images, it is skipped with a frozen backbone
+        if self.config.get("head_only", False): return self.net[fc]
         # path of `input_c` to VGG16
         with tf.name_scope("am") as scope:
             with tf.variable_scope(tf.get_variable_scope().name, reuse=tf.AUTO_REUSE) as var_scope:
                 var_scope.reuse_variables()
                 # generate `input_c`, which is the complement part of the image not selected by the attention map
-                input_c = self.build_input_c("gcam", "input")
-                block = self.build_block(input_c, [
-                    "conv1_1","relu1_1","conv1_2","relu1_2","pool1","conv2_1","relu2_1","conv2_2","relu2_2","pool2",
-                    "conv3_1","relu3_1","conv3_2","relu3_2","conv3_3","relu3_3","pool3",
-                    "conv4_1","relu4_1","conv4_2","relu4_2","conv4_3","relu4_3","pool4",
-                    "conv5_1","relu5_1","conv5_2","relu5_2","conv5_3","relu5_3","pool5"], is_exist=True)
-                last_layer = self.build_fc(block, ["fc6","relu6","drop6","fc7","relu7","drop7"], is_exist=True)
-                self.net[last_layer] = tf.reduce_sum(self.net[last_layer], axis=(1,2))
-                fc = self.build_fc(last_layer, ["fc8"], is_exist=True)
+                input_c = self.build_input_c("gcam", "input", w=self.config.get("am_w",10), th=self.config.get("am_th",0.5))
+                # with `am_chunk` the complements go through VGG16 chunk by chunk in `build_am_chunked`
+                if not self.config.get("am_chunk", 0): fc = self.build_am_stream(input_c)
         return self.net[fc]
-    def build_block(self, last_layer, layer_lists, is_exist=False):
-        input_layer = last_layer
+    def build_am_stream(self, input_c):
+        block = self.build_block(input_c, BLOCK_LAYERS, is_exist=True)
+        last_layer = self.build_fc(block, FC_LAYERS, is_exist=True)
+        self.net[last_layer] = tf.reduce_sum(self.net[last_layer], axis=(1,2))
+        return self.build_fc(last_layer, ["fc8"], is_exist=True)
+    def build_block(self, last_layer, layer_lists, is_exist=False, recompute=True, input_layer=None):
+        if recompute and self.config.get("recompute", False): return self.build_block_recompute(last_layer, layer_lists, is_exist=is_exist)
+        input_layer = last_layer if input_layer is None else input_layer
         for layer in layer_lists:
             player = layer if not is_exist else '-'.join([input_layer, layer])
             with tf.name_scope(layer) as scope:
                 if layer.startswith("conv"):
                     self.stride[player] = self.stride[last_layer]
-                    weights, bias = self.get_weights_and_bias(layer, is_exist=is_exist)
+                    weights, bias = self.recompute_params[player] if self.recompute_params is not None else self.get_weights_and_bias(layer, is_exist=is_exist)
+                    self.block_params[player] = (weights, bias)
                     self.net[player] = tf.nn.conv2d(self.net[last_layer], weights, strides=[1,1,1,1], padding="SAME", name="conv") if layer[4]!="5" else tf.nn.atrous_conv2d(self.net[last_layer], weights, rate=2, padding="SAME", name="conv")
                     self.net[player] = tf.nn.bias_add(self.net[player], bias, name="bias")
                 elif layer.startswith("batch_norm"):
@@ -102,6 +142,28 @@ class GAIN():
                 else: raise Exception("Unimplemented layer: {}".format(layer))
                 last_layer = player
         return last_layer
+    def build_block_recompute(self, last_layer, layer_lists, is_exist=False):
+        """
+        Gradient checkpointing: only the activations at the block boundaries (after the pooling layers) are kept
+        for backprop, the layers inside a block are recomputed during the backward pass.
+        config["recompute"]: True for all the blocks, or the list of blocks to recompute, e.g. ["pool4","pool5"]
+        """
+        input_layer, recompute = last_layer, self.config.get("recompute", False)
+        for block in split_blocks(layer_lists):
+            first = last_layer
+            last_layer = self.build_block(first, block, is_exist=is_exist, recompute=False, input_layer=input_layer)
+            if recompute is not True and block_name(block) not in recompute: continue
+            params = {p:self.block_params[p] for p in [layer if not is_exist else '-'.join([input_layer, layer]) for layer in block if layer.startswith("conv")]}
+            def rebuild(first=first, block=block, params=params):
+                net, stride = dict(self.net), dict(self.stride)
+                self.recompute_params = params
+                y = self.net[self.build_block(first, block, is_exist=is_exist, recompute=False, input_layer=input_layer)]
+                self.recompute_params = None
+                self.net.update(net)
+                self.stride.update(stride)
+                return y
+            self.net[last_layer] = recompute_grad(self.net[last_layer], self.net[first], [t for p in sorted(params) for t in params[p]], rebuild)
+        return last_layer
     def build_fc(self, last_layer, layer_lists, is_exist=False):
         input_layer = last_layer.split('-')[0]
         for layer in layer_lists:
@@ -134,7 +196,7 @@ class GAIN():
             # normalize alpha
             alpha = alpha/tf.reduce_sum(alpha, axis=(0,1))
             # linear combine the feature map to generate CAM
-            cam_c = tf.reduce_sum(tf.reshape(tf.reshape(alpha, (-1,1))*tf.reshape(tf.transpose(A, [0,3,1,2]), (-1,41*41)), (-1,512,41*41)), axis=1)
+            cam_c = tf.reduce_sum(tf.reshape(tf.reshape(alpha, (-1,1))*tf.reshape(tf.transpose(A, [0,3,1,2]), (-1,41*41)), (-1,A.shape.as_list()[-1],41*41)), axis=1) # the width of conv5_3, narrower in a pruned model
             cams.append(tf.nn.relu(cam_c))
         cams = tf.reshape(tf.stack(cams, axis=2), (-1,41,41,self.category_num))
         self.net['gcam'] = cams
@@ -178,7 +240,8 @@ class GAIN():
             if layer == "fc6": shape=[3,3,512,1024]
             elif layer == "fc7": shape=[1,1,1024,1024]
             elif layer == "fc8": shape=[1024,self.category_num]
-        if "init_model_path" not in self.config:
+        shape = pruned_shape(layer, shape, self.config.get("widths",{}), BLOCK_LAYERS+FC_LAYERS)
+        if "init_model_path" not in self.config or self.config.get("widths"): # a pruned model is restored from its checkpoint
             weights = tf.get_variable(name="{}_weights".format(layer), initializer=tf.random_normal_initializer(stddev=0.01), shape=shape)
             bias = tf.get_variable(name="{}_bias".format(layer), initializer=tf.constant_initializer(0), shape=[shape[-1]])
         else: # restroe from init.npy
@@ -207,58 +270,121 @@ class GAIN():
         score = tf.stack([x[:,c,c] for c in range(self.category_num)], axis=1)
         return tf.reduce_mean(tf.reduce_sum(score, axis=1) / tf.cast(tf.reduce_sum(self.net["label"], axis=1), tf.float32))
     
+    def build_am_chunked(self, chunk):
+        """
+        Attention Mining over chunks of `chunk` complement images
+        ---------------------------------------------------------
+        The AM loss is a sum of independent terms, one per complement image, so the forward and backward
+        passes of the `input_c` path run chunk by chunk in a sequential while_loop: the activations of a chunk
+        are released before the next one is computed and the peak memory no longer grows with category_num.
+        return: AM loss, gradient w.r.t. `input_c`, gradients w.r.t. `trainable_list` (through the `input_c` path only)
+        """
+        input_c, C = self.net["input_c"], self.category_num
+        n = tf.shape(input_c)[0]
+        # the complement r=b*C+c contributes sigmoid(score[r,c])/(#labels of b)/batch_size to the loss
+        norm = tf.reshape(tf.tile(tf.reshape(1.0/tf.cast(tf.reduce_sum(self.net["label"], axis=1)*tf.shape(self.net["label"])[0], tf.float32), (-1,1)), (1,C)), (-1,))
+        variables = {v.op.name:v for v in self.trainable_list}
+        def body(k, loss, d_input_c, *grads):
+            start = k*chunk
+            size = tf.minimum(chunk, n-start)
+            self.net["input_c_chunk"] = tf.slice(input_c, [start,0,0,0], [size,-1,-1,-1])
+            # read the weights through an identity in the loop body, so that tf.gradients stays inside the loop
+            local = {}
+            def getter(getter, name, *args, **kwargs):
+                local[name] = tf.identity(getter(name, *args, **kwargs))
+                return local[name]
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True, custom_getter=getter):
+                fc = self.build_am_stream("input_c_chunk")
+            score = tf.reduce_sum(tf.nn.sigmoid(self.net[fc])*tf.one_hot(tf.range(start, start+size) % C, C), axis=1)
+            loss_chunk = tf.reduce_sum(score*tf.slice(norm, [start], [size]))
+            g = tf.gradients(loss_chunk, [self.net["input_c_chunk"]]+[local[name] for name in sorted(variables)])
+            return [k+1, loss+loss_chunk, d_input_c.write(k, g[0])] + [a+b for a,b in zip(grads, g[1:])]
+        loop_vars = [tf.constant(0), tf.constant(0.0), tf.TensorArray(tf.float32, size=(n+chunk-1)//chunk, infer_shape=False)] + [tf.zeros_like(variables[name]) for name in sorted(variables)]
+        # parallel_iterations=1: one chunk at a time, otherwise the iterations may run (and allocate) concurrently
+        rst = tf.while_loop(lambda k, *_: k*chunk < n, body, loop_vars, parallel_iterations=1, back_prop=False)
+        grads = dict(zip(sorted(variables), rst[3:]))
+        return rst[1], rst[2].concat(), [grads[v.op.name] for v in self.trainable_list]
+
     def add_loss_summary(self):
         tf.summary.scalar('cl-loss', self.loss["loss_cl"])
         tf.summary.scalar('am-loss', self.loss["loss_am"])
         tf.summary.scalar('l2', self.loss["total"]-self.loss["norm"])
         tf.summary.scalar('total', self.loss["total"])
         self.merged = tf.summary.merge_all()
-        self.writer = tf.summary.FileWriter(os.path.join(SAVER_PATH, 'sum'))
+        self.writer = tf.summary.FileWriter(os.path.join(self.config.get("saver_path",SAVER_PATH), 'sum'))
 
     def optimize(self, base_lr, momentum, weight_decay):
         self.loss["loss_cl"] = self.get_cl_loss()
-        self.loss["loss_am"] = self.get_am_loss()
+        if self.config.get("head_only", False): self.loss["loss_am"] = tf.constant(0.0)
+        elif self.config.get("am_chunk", 0): self.loss["loss_am"], d_input_c, am_gradients = self.build_am_chunked(self.config["am_chunk"])
+        else: self.loss["loss_am"] = self.get_am_loss()
         self.loss["norm"] = self.loss["loss_cl"] + self.loss["loss_am"]
         self.loss["l2"] = tf.reduce_sum([tf.nn.l2_loss(self.weights[layer][0]) for layer in self.weights], axis=0)
         self.loss["total"] = self.loss["norm"] + weight_decay*self.loss["l2"]
         self.net["lr"] = tf.Variable(base_lr, trainable=False, dtype=tf.float32)
         opt = tf.train.AdamOptimizer(self.net["lr"],momentum)
-        gradients = opt.compute_gradients(self.loss["total"],var_list=self.trainable_list)
+        if self.config.get("head_only", False): # with a frozen backbone only the fc layers are trained
+            gradients = opt.compute_gradients(self.loss["total"],var_list=[v for v in self.trainable_list if v.op.name.startswith("fc")])
+        elif not self.config.get("am_chunk", 0): gradients = opt.compute_gradients(self.loss["total"],var_list=self.trainable_list)
+        else: # the AM gradients come from the chunked loop, then go back through `input_c` to the path of `input`
+            gradients = tf.gradients([self.loss["loss_cl"]+weight_decay*self.loss["l2"], self.net["input_c"]], self.trainable_list, grad_ys=[None, d_input_c])
+            gradients = [(g+g_am if g is not None else g_am, v) for g,g_am,v in zip(gradients, am_gradients, self.trainable_list)]
         self.grad = {}
+        # the lr factor of each variable and the 1/accum_num averaging are folded into a single multiplication
+        lr_mult = dict([(v.name,1) for v in self.lr_1_list] + [(v.name,2) for v in self.lr_2_list] + [(v.name,4) for v in self.lr_4_list] + [(v.name,8) for v in self.lr_8_list])
+        # the (large) weight accumulators may be kept in reduced precision, e.g. "accum_dtype":"float16"; biases stay in float32
+        accum_dtype = tf.as_dtype(self.config.get("accum_dtype","float32"))
         self.net["accum_gradient"] = []
-        self.net["accum_gradient_accum"] = []
-        new_gradients = []
+        accum, new_gradients = [], []
         for (g,v) in gradients:
-            if v in self.lr_2_list: g = 2*g
-            if v in self.lr_4_list: g = 4*g
-            if v in self.lr_8_list: g = 8*g
-            self.net["accum_gradient"].append(tf.Variable(tf.zeros_like(g),trainable=False))
-            self.net["accum_gradient_accum"].append(self.net["accum_gradient"][-1].assign_add(g/self.accum_num, use_locking=True))
-            new_gradients.append((self.net["accum_gradient"][-1],v))
+            g = g*(lr_mult[v.name]/self.accum_num)
+            if self.accum_num == 1: # nothing to accumulate, apply the gradient directly
+                new_gradients.append((g,v))
+                continue
+            dtype = accum_dtype if len(v.shape) > 1 else tf.float32
+            self.net["accum_gradient"].append(tf.Variable(tf.zeros(v.shape,dtype=dtype),trainable=False))
+            accum.append(self.net["accum_gradient"][-1].assign_add(tf.cast(g,dtype), use_locking=True))
+            new_gradients.append((tf.cast(self.net["accum_gradient"][-1],tf.float32)+g,v))
 
-        self.net["accum_gradient_clean"] = [g.assign(tf.zeros_like(g)) for g in self.net["accum_gradient"]]
-        self.net["accum_gradient_update"]  = opt.apply_gradients(new_gradients)
+        # micro-step: accumulate only; last micro-step: accumulate, apply and reset the buffers in the same call
+        self.net["accum_gradient_accum"] = tf.group(*accum)
+        with tf.control_dependencies([opt.apply_gradients(new_gradients)]):
+            self.net["accum_gradient_update"] = tf.group(*[g.assign(tf.zeros_like(g)) for g in self.net["accum_gradient"]])
 
     def train(self, base_lr, weight_decay, momentum, batch_size, epoches, gpu_frac):
-        gpu_options = tf.ConfigProto(gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_frac))
+        # the threads of the session: the profile of tune_threads.py, else "threads" (0: one per core), e.g. for runs sharing the cores of a machine
+        gpu_options = session_config(self.config, gpu_frac)
         self.sess = tf.Session(config=gpu_options)
-        x, _, y, c, id_of_image, iterator_train = self.data.next_batch(category="train",batch_size=batch_size,epoches=-1)
-        self.build()
-        self.optimize(base_lr,momentum, weight_decay)
+        batch_size = preflight(self, batch_size, gpu_frac)
+        saver_path = self.config.get("saver_path",SAVER_PATH)
+        state = checkpointer.latest_state(saver_path) if self.config.get("resume",False) else None
+        seed = state["seed"] if state is not None else int(np.random.randint(1<<31))
+        build_cached(self, __file__, base_lr, momentum, weight_decay, attrs=GRAPH_ATTRS) # the input pipeline is built after, it is not part of the cached graph
+        # "sampler": draw the images in proportion to their recent loss instead of uniformly, e.g. {"floor":0.2, "decay":0.7}
+        sampler = loss_sampler(self.data.data_f["train"]["id"], seed=seed, **self.config["sampler"]) if self.config.get("sampler") and not self.config.get("head_only", False) else None
+        if sampler is not None and state is not None: sampler.load(os.path.join(saver_path, "sampler.json"))
+        if self.config.get("head_only", False): batches = feature_store(self.config["feature_cache"]).batches(batch_size, seed=seed, skip=state["samples"] if state is not None else 0)
+        else: x, _, y, c, id_of_image, iterator_train = self.data.next_batch(category="train",batch_size=batch_size,epoches=-1,seed=seed,skip=state["samples"] if state is not None else 0,augment=True,sampler=sampler)
         self.saver["norm"] = tf.train.Saver(max_to_keep=2,var_list=self.trainable_list)
         self.saver["lr"] = tf.train.Saver(var_list=self.trainable_list)
         self.saver["best"] = tf.train.Saver(var_list=self.trainable_list,max_to_keep=2)
         self.add_loss_summary()
+        self.monitor = monitor(self.writer, interval=self.config.get("telemetry_interval",100))
+        self.checkpointer = checkpointer(self.sess, tf.global_variables(), saver_path, interval=self.config.get("checkpoint_interval",1800))
 
         with self.sess.as_default():
             self.sess.run(tf.global_variables_initializer())
             self.sess.run(tf.local_variables_initializer())
-            self.sess.run(iterator_train.initializer)
+            if not self.config.get("head_only", False): self.sess.run(iterator_train.initializer)
             if self.config.get("model_path",False) is not False: self.restore_from_model(self.saver["norm"], self.config.get("model_path"), checkpoint=False)
+            epoch, i, iterations_per_epoch_train = 0.0, 0, self.data.get_data_len()//batch_size
+            if state is not None: # weights, optimizer slots, accumulated gradients and lr
+                self.checkpointer.restore(state)
+                i, base_lr = state["step"], state["base_lr"]
+                epoch = i/iterations_per_epoch_train
             start_time = time.time()
             print("start_time: {}\nconfig -- lr:{} weight_decay:{} momentum:{} batch_size:{} epoches:{}".format(start_time, base_lr, weight_decay, momentum, batch_size, epoches))
-            
-            epoch, i, iterations_per_epoch_train = 0.0, 0, self.data.get_data_len()//batch_size
+
             while epoch < epoches:
                 if i == 0: self.sess.run(tf.assign(self.net["lr"],base_lr))
                 if i == 10*iterations_per_epoch_train:
@@ -271,11 +397,17 @@ class GAIN():
                     self.saver["lr"].save(self.sess, os.path.join(self.config.get("saver_path",SAVER_PATH),"lr-%f"%base_lr), global_step=i)
                     self.sess.run(tf.assign(self.net["lr"],new_lr))
                     base_lr = new_lr
-                data_x, data_y, _, data_id_of_image = self.sess.run([x, y, c, id_of_image])
-                params = {self.net["input"]:data_x, self.net["label"]:data_y, self.net["drop_prob"]:0.5}
-                self.sess.run(self.net["accum_gradient_accum"], feed_dict=params)
-                if i % self.accum_num == self.accum_num-1:
-                    _, _ = self.sess.run(self.net["accum_gradient_update"]), self.sess.run(self.net["accum_gradient_clean"])
+                if self.config.get("head_only", False):
+                    with self.monitor.timed("iterator_wait"): batch = next(batches)
+                    params = {self.net["feature"]:batch[FEATURE_LAYER].astype(np.float32), self.net["label"]:batch["label"], self.net["drop_prob"]:0.5}
+                else:
+                    with self.monitor.timed("iterator_wait"): data_x, data_y, _, data_id_of_image = self.sess.run([x, y, c, id_of_image])
+                    params = {self.net["input"]:data_x, self.net["label"]:data_y, self.net["drop_prob"]:0.5}
+                # a single session call per micro-step
+                update = i % self.accum_num == self.accum_num-1
+                with self.monitor.timed("apply" if update else "accumulate"): values = self.sess.run([self.net["accum_gradient_update"] if update else self.net["accum_gradient_accum"]]+([self.loss["norm"]] if sampler is not None else []), feed_dict=params)
+                if sampler is not None: sampler.update(data_id_of_image, values[1]) # the data loss of the step (no l2), the mean over the batch, fetched with it
+                self.monitor.step(i, batch_size)
                 if i%500 == 0:
                     summary, loss_cl, loss_am, loss_l2, loss_total, lr = self.sess.run([self.merged, self.loss["loss_cl"], self.loss["loss_am"], self.loss["l2"], self.loss["total"], self.net["lr"]], feed_dict=params)
                     print("{:.1f}th epoch, {}iters, lr={:.5f}, loss={:.5f}+{:.5f}+{:.5f}={:.5f}".format(epoch, i, lr, loss_cl, loss_am, weight_decay*loss_l2, loss_total))
@@ -284,15 +416,49 @@ class GAIN():
                     self.saver["norm"].save(self.sess, os.path.join(self.config.get("saver_path",SAVER_PATH),"norm"), global_step=i)
                 i+=1
                 epoch = i/iterations_per_epoch_train
+                if self.checkpointer.step(i, {"base_lr":base_lr, "seed":seed, "samples":i*batch_size}, force=epoch >= epoches) and sampler is not None: sampler.save(os.path.join(saver_path, "sampler.json"))
+            self.checkpointer.close()
+            if i%3000 != 0: self.saver["norm"].save(self.sess, os.path.join(self.config.get("saver_path",SAVER_PATH),"norm"), global_step=i-1) # the last weights, e.g. of a short fine-tuning
             end_time = time.time()
             print("end_time:{}\nduration time:{}".format(end_time, (end_time-start_time)))
+    def cache_features(self, gpu_frac, batch_size=16):
+        """Run the (frozen) backbone once over the dataset and cache its output for the head-only training"""
+        store = feature_store.create(self.config["feature_cache"], self.data.data_f["train"]["id"], {FEATURE_LAYER:((41,41,self.config.get("widths",{}).get("conv5_3",512)),"float16"), "label":((self.category_num,),"uint8")})
+        todo = store.todo()
+        print("feature cache {}: {} images to process".format(self.config["feature_cache"], len(todo)))
+        if len(todo) == 0: return
+        self.data.select(todo)
+        gpu_options = session_config(self.config, gpu_frac)
+        self.sess = tf.Session(config=gpu_options)
+        x, _, y, _, id_of_image, iterator = self.data.next_batch(category="train",batch_size=batch_size,epoches=1)
+        self.build()
+        self.saver["norm"] = tf.train.Saver(max_to_keep=2,var_list=self.trainable_list)
+        with self.sess.as_default():
+            self.sess.run(tf.global_variables_initializer())
+            self.sess.run(iterator.initializer)
+            if self.config.get("model_path",False) is not False: self.restore_from_model(self.saver["norm"], self.config.get("model_path"), checkpoint=False)
+            while True:
+                try: data_x, data_y, data_id = self.sess.run([x, y, id_of_image])
+                except tf.errors.OutOfRangeError: break
+                feature = self.sess.run(self.net[FEATURE_LAYER], feed_dict={self.net["input"]:data_x})
+                store.write([one.decode("utf-8") for one in data_id], **{FEATURE_LAYER:feature, "label":data_y})
+            store.flush()
     def inference(self, gpu_frac, eps=1e-5):
         if not os.path.exists(PRED_PATH): os.makedirs(PRED_PATH)
+        # the ids whose mask is cached for this checkpoint and config are not predicted again
+        cache = pred_cache(self.config["pred_cache"], max_mb=self.config.get("pred_cache_size",1024)) if self.config.get("pred_cache") else None
+        if cache is not None:
+            model_key = pred_cache.inference_key(__file__, self.config.get("model_path"), PRED_LAYER, eps, [self.h,self.w], widths=self.config.get("widths",{}), tta=self.config.get("tta"))
+            keys = {identy:cache.key(f, model_key) for identy, f in zip(self.data.data_f["train"]["id"], self.data.data_f["train"]["img"])}
+            self.data.select(cache.materialize(keys, PRED_PATH))
+            if self.data.get_data_len() == 0: return cache.finish({}, PRED_PATH)
         #Dump the predicted mask as numpy array to disk
-        gpu_options = tf.ConfigProto(gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_frac))
+        gpu_options = session_config(self.config, gpu_frac)
         self.sess = tf.Session(config=gpu_options)
         x, gt, _, _, id_of_image, iterator_train = self.data.next_batch(category="train",batch_size=1,epoches=-1)
         self.build()
+        # "tta": the views of the image are predicted in the same run and merged in the graph, e.g. {"scales":[1.0,0.75,1.25],"flip":true}
+        prediction = merge_views(self.net[PRED_LAYER], size=(self.h,self.w), **self.config["tta"]) if self.config.get("tta") else self.net[PRED_LAYER]
         self.saver["norm"] = tf.train.Saver(max_to_keep=2,var_list=self.trainable_list)
         with self.sess.as_default():
             self.sess.run(tf.global_variables_initializer())
@@ -303,7 +469,7 @@ class GAIN():
             while epoch < 1:
                 data_x, data_gt, img_id = self.sess.run([x, gt, id_of_image])
                 cimg_id = img_id[0].decode("utf-8")
-                preds = self.sess.run(self.net["gcam"], feed_dict={self.net["input"]:data_x, self.net["drop_prob"]:0.5})
+                preds = self.sess.run(prediction, feed_dict={self.net["tta_input" if self.config.get("tta") else "input"]:data_x, self.net["drop_prob"]:1.0 if self.config.get("tta") else 0.5}) # drop_prob is the keep probability: the views are merged without dropout
                 for pred in preds:
                     img = Image.open("data/VOCdevkit/VOC2012/JPEGImages/{}.jpg".format(cimg_id)).resize((321,321), Image.ANTIALIAS)
                     scores_exp = np.exp(pred-np.max(pred, axis=2, keepdims=True))
@@ -312,8 +478,10 @@ class GAIN():
                     probs[probs<eps] = eps
                     mask = np.argmax(probs, axis=2)
                     cPickle.dump(mask, open('{}/{}.pkl'.format(PRED_PATH, img_id[0].decode("utf-8")), 'wb'))
+                    if cache is not None: cache.put(keys[cimg_id], mask)
                 i+=1
                 epoch = i/iterations_per_epoch_train
+            if cache is not None: cache.finish({identy:keys[identy] for identy in self.data.data_f["train"]["id"]}, PRED_PATH)
 
 
 if __name__ == "__main__":
@@ -321,10 +489,20 @@ if __name__ == "__main__":
     os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
     batch_size = 1 # actual batch size=batch_size*accum_num
     input_size, category_num, epoches = (321,321), 21, 10
-    data = dataset({"batch_size":batch_size, "input_size":input_size, "epoches":epoches, "category_num":category_num, "categorys":["train"]})
+    overrides = json.loads(opt.overrides)
+    profile = load_profile(opt.thread_profile, "inference" if opt.action == "inference" else "train")
+    epoches = overrides.get("epoches", epoches)
+    data = dataset(dict({"batch_size":batch_size, "input_size":input_size, "epoches":epoches, "category_num":category_num, "categorys":["train"], "data_threads":profile.get("data_threads"), "exclude_held_out":opt.action in ['train','train_head','cache']}, **overrides))
     if opt.restore_iter_id == None: gain = GAIN({"data":data, "batch_size":batch_size, "input_size":input_size, "epoches":epoches, "category_num":category_num, "init_model_path":"./model/init.npy", "accum_num":16})
     else: gain = GAIN({"data":data, "batch_size":batch_size, "input_size":input_size, "epoches":epoches, "category_num":category_num, "model_path":"{}/norm-{}".format(SAVER_PATH, opt.restore_iter_id), "accum_num":16})
-    if opt.action == 'train':
-        gain.train(base_lr=1e-4, weight_decay=5e-5, momentum=0.9, batch_size=batch_size, epoches=epoches, gpu_frac=float(opt.gpu_frac))
+    gain.config.update({"resume":opt.resume, "checkpoint_interval":float(opt.ckpt_interval), "am_chunk":int(opt.am_chunk), "recompute":opt.recompute})
+    gain.config.update({"preflight":opt.preflight, "graph_cache":opt.graph_cache, "pred_cache":opt.pred_cache, "thread_profile":profile, "crf_workers":profile.get("crf_workers",1)})
+    gain.config.update(overrides)
+    gain.accum_num = gain.config["accum_num"]
+    gain.config.update({"feature_cache":opt.feature_cache if opt.feature_cache is not None else "gain_gcam-features", "head_only":opt.action == 'train_head'})
+    if opt.action in ['train','train_head']:
+        gain.train(base_lr=overrides.get("base_lr",1e-4), weight_decay=overrides.get("weight_decay",5e-5), momentum=overrides.get("momentum",0.9), batch_size=batch_size, epoches=epoches, gpu_frac=float(opt.gpu_frac))
     elif opt.action == 'inference':
-        gain.inference(gpu_frac=float(opt.gpu_frac))
\ No newline at end of file
+        gain.inference(gpu_frac=float(opt.gpu_frac))
+    elif opt.action == 'cache':
+        gain.cache_features(gpu_frac=float(opt.gpu_frac))
\ No newline at end of file
@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+import json
 from six.moves import cPickle
 import numpy as np
 import scipy.ndimage as nd
@@ -8,9 +9,31 @@ from PIL import Image
 import tensorflow as tf
 import optparse
 from dataset import dataset
-from crf import crf_inference
+from crf import crf_batch
+from checkpoint import checkpointer
+from recompute import split_blocks, block_name, recompute_grad
+from feature_cache import feature_store
+from telemetry import monitor
+from footprint import preflight
+from graph_cache import build_cached
+from pred_cache import pred_cache
+from tta import build_views, merge_views
+from sampler import loss_sampler
+from async_crf import crf_pipeline
+from utils import session_config, load_profile, pruned_shape
 
 SAVER_PATH, PRED_PATH = "sec-saver", "sec-preds"
+PRED_LAYER = "fc8-softmax" # layer used to predict the masks
+# layers of DeepLab-LargeFOV
+BLOCK_LAYERS = ["conv1_1","relu1_1","conv1_2","relu1_2","pool1",
+                "conv2_1","relu2_1","conv2_2","relu2_2","pool2",
+                "conv3_1","relu3_1","conv3_2","relu3_2","conv3_3","relu3_3","pool3",
+                "conv4_1","relu4_1","conv4_2","relu4_2","conv4_3","relu4_3","pool4",
+                "conv5_1","relu5_1","conv5_2","relu5_2","conv5_3","relu5_3","pool5","pool5a"]
+FC_LAYERS = ["fc6","relu6","drop6","fc7","relu7","drop7","fc8"]
+FEATURE_LAYER = "pool5a" # output of the backbone, cached to train the fc layers only
+OPTIMIZER_SLOTS = 1 # MomentumOptimizer: one slot per variable
+GRAPH_ATTRS = ("net","loss","trainable_list","loss_1","loss_2","loss_3") # python handles of the graph, restored by the graph cache
 
 def parse_arg():
     parser = optparse.OptionParser()
@@ -18,6 +41,15 @@ def parse_arg():
     parser.add_option('-f', dest='gpu_frac', default='0.49', help='specify the memory utilization of GPU')
     parser.add_option('-r', dest='restore_iter_id', default=None, help="continue training? default=False")
     parser.add_option('-a', dest='action', default='train', help="training or inference?")
+    parser.add_option('-s', dest='resume', action='store_true', default=False, help="resume the full training state from the latest checkpoint")
+    parser.add_option('-t', dest='ckpt_interval', default='1800', help="seconds between two training state checkpoints")
+    parser.add_option('-e', dest='feature_cache', default=None, help="directory of the backbone feature cache (-a cache | train_head)")
+    parser.add_option('-o', dest='overrides', default='{}', help="JSON of config and hyperparameter overrides, e.g. '{\"base_lr\":5e-4,\"accum_num\":8,\"crf_config\":{\"bi_srgb\":20}}'")
+    parser.add_option('-c', dest='graph_cache', default=None, help="directory of the graph cache: import the graph built by a previous launch with the same code and config")
+    parser.add_option('-j', dest='thread_profile', default=None, help="thread profile written by tune_threads.py (session threads, tf.data threads, crf workers, cores)")
+    parser.add_option('-d', dest='pred_cache', default=None, help="directory of the prediction cache (-a inference): only the images or checkpoints not seen yet are predicted")
+    parser.add_option('-p', dest='preflight', default='off', help="memory check before training: off, check (refuse a config that does not fit) or shrink (turn on the memory savings until it fits, this changes the config of the run)")
+    parser.add_option('-m', dest='recompute', action='store_true', default=False, help="gradient checkpointing: recompute the activations inside the VGG16 blocks in the backward pass")
     (options, args) = parser.parse_args()
     return options
 
@@ -39,6 +71,11 @@ class SEC():
         self.stride = {}
         self.stride["input"] = 1
         self.trainable_list = []
+        # weights used by each conv layer, and the ones to use while recomputing a block (gradient checkpointing)
+        self.block_params = {}
+        self.recompute_params = None
+        # performance telemetry, set while training
+        self.monitor = None
         # different lr for different variable
         self.lr_1_list = []
         self.lr_2_list = []
@@ -49,10 +86,17 @@ class SEC():
         if "output" not in self.net:
             with tf.name_scope("placeholder"):
                 self.net["input"] = tf.placeholder(tf.float32,[None,self.h,self.w,self.config.get("input_channel",3)])
+                if self.config.get("tta"): # test-time augmentation: the images are fed to `tta_input`, `input` is the batch of their views
+                    self.net["tta_input"], self.net["input"] = self.net["input"], build_views(self.net["input"],**self.config["tta"])
                 self.net["label"] = tf.placeholder(tf.int32,[None,self.category_num])
                 self.net["cues"] = tf.placeholder(tf.float32,[None,41,41,self.category_num])
                 self.net["gt"] = tf.placeholder(tf.int32,[None,self.h,self.w,1])
                 self.net["drop_prob"] = tf.placeholder(tf.float32)
+                if self.config.get("head_only",False): # frozen backbone: its output and the image for the crf come from the feature cache
+                    self.net["feature"] = tf.placeholder(tf.float32,[None,41,41,self.config.get("widths",{}).get("conv5_3",512)]) # conv5_3 may be pruned
+                    self.net["image_small"] = tf.placeholder(tf.float32,[None,41,41,3])
+                if self.config.get("distill"): # softmax of the teacher, from the store of distill.py
+                    self.net["teacher"] = tf.placeholder(tf.float32,[None,41,41,self.category_num])
 
             self.net["output"] = self.create_network()
 
@@ -62,33 +106,33 @@ class SEC():
         if "init_model_path" in self.config:
             self.load_init_model()
         with tf.name_scope("deeplab") as scope:
-            block = self.build_block("input",["conv1_1","relu1_1","conv1_2","relu1_2","pool1"])
-            block = self.build_block(block,["conv2_1","relu2_1","conv2_2","relu2_2","pool2"])
-            block = self.build_block(block,["conv3_1","relu3_1","conv3_2","relu3_2","conv3_3","relu3_3","pool3"])
-            block = self.build_block(block,["conv4_1","relu4_1","conv4_2","relu4_2","conv4_3","relu4_3","pool4"])
-            block = self.build_block(block,["conv5_1","relu5_1","conv5_2","relu5_2","conv5_3","relu5_3","pool5","pool5a"])
-            fc = self.build_fc(block,["fc6","relu6","drop6","fc7","relu7","drop7","fc8"])
+            block = self.build_block("input",BLOCK_LAYERS)
+            fc = self.build_fc(block if not self.config.get("head_only",False) else "feature",FC_LAYERS)
 
         with tf.name_scope("sec") as scope:
             softmax = self.build_sp_softmax(fc)
-            crf = self.build_crf(fc,"input")
+            if self.config.get("distill"): return self.net[softmax] # the teacher replaces the crf
+            crf = self.build_crf(fc,"input") if not self.config.get("head_only",False) else self.build_crf(fc,"image_small",zoomed=True)
 
         return self.net[crf]
 
-    def build_block(self,last_layer,layer_lists):
+    def build_block(self,last_layer,layer_lists,recompute=True):
+        if recompute and self.config.get("recompute",False): return self.build_block_recompute(last_layer,layer_lists)
         for layer in layer_lists:
             if layer.startswith("conv"):
                 if layer[4] != "5":
                     with tf.name_scope(layer) as scope:
                         self.stride[layer] = self.stride[last_layer]
-                        weights,bias = self.get_weights_and_bias(layer)
+                        weights,bias = self.recompute_params[layer] if self.recompute_params is not None else self.get_weights_and_bias(layer)
+                        self.block_params[layer] = (weights,bias)
                         self.net[layer] = tf.nn.conv2d( self.net[last_layer], weights, strides = [1,1,1,1], padding="SAME", name="conv")
                         self.net[layer] = tf.nn.bias_add( self.net[layer], bias, name="bias")
                         last_layer = layer
                 if layer[4] == "5":
                     with tf.name_scope(layer) as scope:
                         self.stride[layer] = self.stride[last_layer]
-                        weights,bias = self.get_weights_and_bias(layer)
+                        weights,bias = self.recompute_params[layer] if self.recompute_params is not None else self.get_weights_and_bias(layer)
+                        self.block_params[layer] = (weights,bias)
                         self.net[layer] = tf.nn.atrous_conv2d( self.net[last_layer], weights, rate=2, padding="SAME", name="conv")
                         self.net[layer] = tf.nn.bias_add( self.net[layer], bias, name="bias")
                         last_layer = layer
@@ -120,6 +164,29 @@ class SEC():
                         last_layer = layer
         return last_layer
 
+    def build_block_recompute(self,last_layer,layer_lists):
+        """
+        Gradient checkpointing: only the activations at the block boundaries (after the pooling layers) are kept
+        for backprop, the layers inside a block are recomputed during the backward pass.
+        config["recompute"]: True for all the blocks, or the list of blocks to recompute, e.g. ["pool4","pool5"]
+        """
+        recompute = self.config.get("recompute",False)
+        for block in split_blocks(layer_lists):
+            first = last_layer
+            last_layer = self.build_block(first,block,recompute=False)
+            if recompute is not True and block_name(block) not in recompute: continue
+            params = {layer:self.block_params[layer] for layer in block if layer.startswith("conv")}
+            def rebuild(first=first,block=block,params=params):
+                net,stride = dict(self.net),dict(self.stride)
+                self.recompute_params = params
+                y = self.net[self.build_block(first,block,recompute=False)]
+                self.recompute_params = None
+                self.net.update(net)
+                self.stride.update(stride)
+                return y
+            self.net[last_layer] = recompute_grad(self.net[last_layer],self.net[first],[t for layer in sorted(params) for t in params[layer]],rebuild)
+        return last_layer
+
     def build_fc(self,last_layer, layer_lists):
         for layer in layer_lists:
             if layer.startswith("fc"):
@@ -156,27 +223,33 @@ class SEC():
         return layer
 
 
-    def build_crf(self,featemap_layer,img_layer):
-        origin_image = self.net[img_layer] + self.data.img_mean
-        origin_image_zoomed = tf.image.resize_bilinear(origin_image,(41,41))
+    def build_crf(self,featemap_layer,img_layer,zoomed=False):
+        """zoomed: `img_layer` is already the 41x41 origin image (from the feature cache)"""
+        if zoomed:
+            origin_image_zoomed = self.net[img_layer]
+        else:
+            origin_image = self.net[img_layer] + self.data.img_mean
+            origin_image_zoomed = tf.image.resize_bilinear(origin_image,(41,41))
         featemap = self.net[featemap_layer]
-        def crf(featemap,image):
-            crf_config = {"g_sxy":3/12,"g_compat":3,"bi_sxy":80/12,"bi_srgb":13,"bi_compat":10,"iterations":5}
-            batch_size = featemap.shape[0]
-            image = image.astype(np.uint8)
-            ret = np.zeros(featemap.shape,dtype=np.float32)
-            for i in range(batch_size):
-                ret[i,:,:,:] = crf_inference(featemap[i],image[i],crf_config,self.category_num)
-
-            ret[ret < self.min_prob] = self.min_prob
-            ret /= np.sum(ret,axis=3,keepdims=True)
-            ret = np.log(ret)
-            return ret.astype(np.float32)
-
         layer = "crf"
-        self.net[layer] = tf.py_func(crf,[featemap,origin_image_zoomed],tf.float32) # shape [N, h, w, C], RGB or BGR doesn't matter for crf
+        if self.config.get("async_crf",False): # the target is computed by async_crf.crf_pipeline from these two tensors and fed back
+            self.net["crf_featemap"],self.net["crf_image"] = featemap,origin_image_zoomed
+            self.net[layer] = tf.placeholder(tf.float32,[None,41,41,self.category_num])
+            return layer
+        self.net[layer] = tf.py_func(self.run_crf,[featemap,origin_image_zoomed],tf.float32) # shape [N, h, w, C], RGB or BGR doesn't matter for crf
         return layer
 
+    def run_crf(self,featemap,image):
+        """crf of a batch, run by the py_func of `build_crf` (a method, so that the graph cache can bind it again)"""
+        start = time.time()
+        crf_config = dict({"g_sxy":3/12,"g_compat":3,"bi_sxy":80/12,"bi_srgb":13,"bi_compat":10,"iterations":5}, **self.config.get("crf_config",{}))
+        ret = crf_batch(featemap,image.astype(np.uint8),crf_config,self.category_num,workers=self.config.get("crf_workers",1)).astype(np.float32)
+        ret[ret < self.min_prob] = self.min_prob
+        ret /= np.sum(ret,axis=3,keepdims=True)
+        ret = np.log(ret)
+        if self.monitor is not None: self.monitor.add("crf",time.time()-start)
+        return ret.astype(np.float32)
+
     def load_init_model(self):
         model_path = self.config["init_model_path"]
         self.init_model = np.load(model_path,encoding="latin1").item()
@@ -208,7 +281,8 @@ class SEC():
                 shape = [1,1,1024,1024]
             if layer == "fc8": 
                 shape = [1,1,1024,self.category_num]
-        if "init_model_path" not in self.config:
+        shape = pruned_shape(layer,shape,self.config.get("widths",{}),BLOCK_LAYERS+FC_LAYERS)
+        if "init_model_path" not in self.config or self.config.get("widths"): # a pruned model is restored from its checkpoint
             init = tf.random_normal_initializer(stddev=0.01)
             weights = tf.get_variable(name="%s_weights" % layer,initializer=init, shape = shape)
             init = tf.constant_initializer(0)
@@ -239,7 +313,9 @@ class SEC():
     def getloss(self):
         seed_loss = self.get_seed_loss(self.net["fc8-softmax"],self.net["cues"])
         expand_loss = self.get_expand_loss(self.net["fc8-softmax"],self.net["label"])
-        constrain_loss = self.get_constrain_loss(self.net["fc8-softmax"],self.net["crf"])
+        if self.config.get("distill"): # distillation: the softmax of the teacher is the smoothed target instead of the crf
+            constrain_loss = self.config["distill"].get("weight",1.0)*self.get_constrain_loss(self.net["fc8-softmax"],tf.log(self.net["teacher"]))
+        else: constrain_loss = self.get_constrain_loss(self.net["fc8-softmax"],self.net["crf"])
         self.loss["seed"] = seed_loss
         self.loss["expand"] = expand_loss
         self.loss["constrain"] = constrain_loss
@@ -293,7 +369,7 @@ class SEC():
         tf.summary.scalar('l2', self.loss["total"]-self.loss["norm"])
         tf.summary.scalar('total', self.loss["total"])
         self.merged = tf.summary.merge_all()
-        self.writer = tf.summary.FileWriter(os.path.join(SAVER_PATH, 'sum'))
+        self.writer = tf.summary.FileWriter(os.path.join(self.config.get("saver_path",SAVER_PATH), 'sum'))
 
     def optimize(self,base_lr,momentum,weight_decay):
         self.loss["norm"] = self.getloss()
@@ -301,40 +377,65 @@ class SEC():
         self.loss["total"] = self.loss["norm"] + weight_decay*self.loss["l2"]
         self.net["lr"] = tf.Variable(base_lr, trainable=False, dtype=tf.float32)
         opt = tf.train.MomentumOptimizer(self.net["lr"],momentum)
-        gradients = opt.compute_gradients(self.loss["total"],var_list=self.trainable_list)
+        # with a frozen backbone only the fc layers are trained
+        var_list = self.trainable_list if not self.config.get("head_only",False) else [v for v in self.trainable_list if v.op.name.startswith("fc")]
+        gradients = opt.compute_gradients(self.loss["total"],var_list=var_list)
         self.grad = {}
+        # the lr factor of each variable and the 1/accum_num averaging are folded into a single multiplication
+        lr_mult = dict([(v.name,1) for v in self.lr_1_list] + [(v.name,2) for v in self.lr_2_list] + [(v.name,10) for v in self.lr_10_list] + [(v.name,20) for v in self.lr_20_list])
+        # the (large) weight accumulators may be kept in reduced precision, e.g. "accum_dtype":"float16"; biases stay in float32
+        accum_dtype = tf.as_dtype(self.config.get("accum_dtype","float32"))
         self.net["accum_gradient"] = []
-        self.net["accum_gradient_accum"] = []
-        new_gradients = []
+        accum, new_gradients = [], []
         for (g,v) in gradients:
-            if v in self.lr_2_list:
-                g = 2*g
-            if v in self.lr_10_list:
-                g = 10*g
-            if v in self.lr_20_list:
-                g = 20*g
-            self.net["accum_gradient"].append(tf.Variable(tf.zeros_like(g),trainable=False))
-            self.net["accum_gradient_accum"].append(self.net["accum_gradient"][-1].assign_add( g/self.accum_num, use_locking=True))
-            new_gradients.append((self.net["accum_gradient"][-1],v))
-
-        self.net["accum_gradient_clean"] = [g.assign(tf.zeros_like(g)) for g in self.net["accum_gradient"]]
-        self.net["accum_gradient_update"]  = opt.apply_gradients(new_gradients)
+            g = g*(lr_mult[v.name]/self.accum_num)
+            if self.accum_num == 1: # nothing to accumulate, apply the gradient directly
+                new_gradients.append((g,v))
+                continue
+            dtype = accum_dtype if len(v.shape) > 1 else tf.float32
+            self.net["accum_gradient"].append(tf.Variable(tf.zeros(v.shape,dtype=dtype),trainable=False))
+            accum.append(self.net["accum_gradient"][-1].assign_add(tf.cast(g,dtype), use_locking=True))
+            new_gradients.append((tf.cast(self.net["accum_gradient"][-1],tf.float32)+g,v))
+
+        # micro-step: accumulate only; last micro-step: accumulate, apply and reset the buffers in the same call
+        self.net["accum_gradient_accum"] = tf.group(*accum)
+        with tf.control_dependencies([opt.apply_gradients(new_gradients)]):
+            self.net["accum_gradient_update"] = tf.group(*[g.assign(tf.zeros_like(g)) for g in self.net["accum_gradient"]])
 
     def train(self, base_lr, weight_decay, momentum, batch_size, epoches, gpu_frac):
-        gpu_options = tf.ConfigProto(gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_frac))
+        # the threads of the session: the profile of tune_threads.py, else "threads" (0: one per core), e.g. for runs sharing the cores of a machine
+        gpu_options = session_config(self.config,gpu_frac)
         self.sess = tf.Session(config=gpu_options)
-        x,gt,y,c,id_of_image,iterator_train = self.data.next_batch(category="train",batch_size=batch_size,epoches=-1)
-        self.build()
-        self.optimize(base_lr,momentum,weight_decay)
+        batch_size = preflight(self,batch_size,gpu_frac)
+        saver_path = self.config.get("saver_path",SAVER_PATH)
+        state = checkpointer.latest_state(saver_path) if self.config.get("resume",False) else None
+        seed = state["seed"] if state is not None else int(np.random.randint(1<<31))
+        build_cached(self,__file__,base_lr,momentum,weight_decay,attrs=GRAPH_ATTRS) # the input pipeline is built after, it is not part of the cached graph
+        sampler = None
+        # "distill": {"store":<teacher store of distill.py>,"weight":1.0}, the teacher softmax of each image is read by id
+        teacher = feature_store(self.config["distill"]["store"]) if self.config.get("distill") else None
+        if teacher is not None:
+            if self.config.get("head_only",False) or self.config.get("augment"): raise Exception("the teacher store holds the softmax of the unaugmented images, distillation needs the image ids and no augmentation")
+            if len(set(self.data.data_f["train"]["id"])-(set(teacher.ids)-set(teacher.todo()))) > 0: raise Exception("the teacher store {} does not cover the training images".format(self.config["distill"]["store"]))
+        if self.config.get("head_only",False):
+            batches = feature_store(self.config["feature_cache"]).batches(batch_size,seed=seed,skip=state["samples"] if state is not None else 0)
+        else:
+            # "sampler": draw the images in proportion to their recent loss instead of uniformly, e.g. {"floor":0.2,"decay":0.7}
+            sampler = loss_sampler(self.data.data_f["train"]["id"],seed=seed,**self.config["sampler"]) if self.config.get("sampler") else None
+            if sampler is not None and state is not None: sampler.load(os.path.join(saver_path,"sampler.json"))
+            x,gt,y,c,id_of_image,iterator_train = self.data.next_batch(category="train",batch_size=batch_size,epoches=-1,seed=seed,skip=state["samples"] if state is not None else 0,augment=True,sampler=sampler)
         self.saver["norm"] = tf.train.Saver(max_to_keep=2,var_list=self.trainable_list)
         self.saver["lr"] = tf.train.Saver(var_list=self.trainable_list)
         self.saver["best"] = tf.train.Saver(var_list=self.trainable_list,max_to_keep=2)
         self.add_loss_summary()
+        self.monitor = monitor(self.writer,interval=self.config.get("telemetry_interval",100))
+        pipeline = crf_pipeline(self.sess,self,self.monitor) if self.config.get("async_crf",False) and teacher is None else None
+        self.checkpointer = checkpointer(self.sess, tf.global_variables(), saver_path, interval=self.config.get("checkpoint_interval",1800))
 
         with self.sess.as_default():
             self.sess.run(tf.global_variables_initializer())
             self.sess.run(tf.local_variables_initializer())
-            self.sess.run(iterator_train.initializer)
+            if not self.config.get("head_only",False): self.sess.run(iterator_train.initializer)
 
             if self.config.get("model_path",False) is not False:
                 print("[cur] before l2={} | load model from {}".format(self.sess.run(self.loss["l2"]), self.config.get("model_path")))
@@ -344,13 +445,18 @@ class SEC():
                 print("[cur] before lr={} | load lr from {}".format(self.sess.run(self.net["lr"]), self.config.get("lr_path")))
                 self.restore_from_model(self.saver["lr"],self.config.get("lr_path"),checkpoint=False)
                 print("[loaded] after lr={}".format(self.sess.run(self.net["lr"])))
-            
+
+            epoch,i = 0.0,0
+            iterations_per_epoch_train = self.data.get_data_len() // batch_size
+            if state is not None: # weights, optimizer slots, accumulated gradients and lr
+                self.checkpointer.restore(state)
+                i, base_lr = state["step"], state["base_lr"]
+                epoch = i / iterations_per_epoch_train
+
             start_time = time.time()
             print("start_time: %f" % start_time)
             print("config -- lr:%f weight_decay:%f momentum:%f batch_size:%f epoches:%f" % (base_lr,weight_decay,momentum,batch_size,epoches))
 
-            epoch,i = 0.0,0
-            iterations_per_epoch_train = self.data.get_data_len() // batch_size
             while epoch < epoches:
                 if i == 0: # in case for restoring
                     self.sess.run(tf.assign(self.net["lr"],base_lr))
@@ -366,13 +472,22 @@ class SEC():
                     self.saver["lr"].save(self.sess,os.path.join(self.config.get("saver_path",SAVER_PATH),"lr-%f" % base_lr),global_step=i)
                     self.sess.run(tf.assign(self.net["lr"],new_lr))
                     base_lr = new_lr
-                data_x,data_gt,data_y,data_c,data_id_of_image = self.sess.run([x,gt,y,c,id_of_image])
-                params = {self.net["input"]:data_x,self.net["gt"]:data_gt,self.net["label"]:data_y,self.net["cues"]:data_c,self.net["drop_prob"]:0.5}
-                self.sess.run(self.net["accum_gradient_accum"],feed_dict=params)
-                if i % self.accum_num == self.accum_num - 1:
-                    _ = self.sess.run(self.net["accum_gradient_update"])
-                    _ = self.sess.run(self.net["accum_gradient_clean"])
-                if i%500 == 0:
+                if self.config.get("head_only",False):
+                    with self.monitor.timed("iterator_wait"): batch = next(batches)
+                    params = {self.net["feature"]:batch[FEATURE_LAYER].astype(np.float32),self.net["image_small"]:batch["image"].astype(np.float32),self.net["label"]:batch["label"],self.net["cues"]:batch["cues"].astype(np.float32),self.net["drop_prob"]:0.5}
+                else:
+                    with self.monitor.timed("iterator_wait"): data_x,data_gt,data_y,data_c,data_id_of_image = self.sess.run([x,gt,y,c,id_of_image])
+                    params = {self.net["input"]:data_x,self.net["gt"]:data_gt,self.net["label"]:data_y,self.net["cues"]:data_c,self.net["drop_prob"]:0.5}
+                    if teacher is not None: params[self.net["teacher"]] = teacher["teacher"][[teacher.row[one.decode("utf-8")] for one in data_id_of_image]].astype(np.float32)
+                # a single session call per micro-step; "async_crf": the forward pass of this batch and the backward pass of the previous one
+                update = i % self.accum_num == self.accum_num - 1
+                fetches = [self.net["accum_gradient_update"] if update else self.net["accum_gradient_accum"]]+([self.loss["norm"]] if sampler is not None else [])
+                with self.monitor.timed("apply" if update else "accumulate"):
+                    if pipeline is not None: values,params,data_id_of_image = pipeline.run(fetches,params,data_id_of_image if sampler is not None else None)
+                    else: values = self.sess.run(fetches,feed_dict=params)
+                if sampler is not None and values is not None: sampler.update(data_id_of_image,values[1]) # the data loss of the step (no l2), the mean over the batch, fetched with it
+                self.monitor.step(i,batch_size)
+                if i%500 == 0 and params is not None:
                     summary, l1,l2,l3,seed_l,expand_l,constrain_l,loss,lr = self.sess.run([self.merged, self.loss_1,self.loss_2,self.loss_3,self.loss["seed"],self.loss["expand"],self.loss["constrain"],self.loss["total"],self.net["lr"]],feed_dict=params)
                     self.writer.add_summary(summary, global_step=i)
                     print("{:.1f}th epoch, {}iters, lr={:.5f}, loss={:.5f}+{:.5f}+{:.5f}={:.5f}".format(epoch,i,lr,seed_l,expand_l,constrain_l,loss))
@@ -381,17 +496,55 @@ class SEC():
                     self.saver["norm"].save(self.sess,os.path.join(self.config.get("saver_path",SAVER_PATH),"norm"),global_step=i)
                 i+=1
                 epoch = i / iterations_per_epoch_train
+                if pipeline is not None and epoch >= epoches: pipeline.flush() # the backward pass of the last batch
+                if self.checkpointer.step(i, {"base_lr":base_lr, "seed":seed, "samples":i*batch_size}, force=epoch >= epoches) and sampler is not None: sampler.save(os.path.join(saver_path,"sampler.json"))
+
+            self.checkpointer.close()
+            if i%3000 != 0: self.saver["norm"].save(self.sess,os.path.join(self.config.get("saver_path",SAVER_PATH),"norm"),global_step=i-1) # the last weights, e.g. of a short fine-tuning
 
             end_time = time.time()
             print("end_time:%f" % end_time)
             print("duration time:%f" %  (end_time-start_time))
+    def cache_features(self, gpu_frac, batch_size=16):
+        """Run the (frozen) backbone once over the dataset and cache its output for the head-only training"""
+        store = feature_store.create(self.config["feature_cache"],self.data.data_f["train"]["id"],{FEATURE_LAYER:((41,41,self.config.get("widths",{}).get("conv5_3",512)),"float16"),"image":((41,41,3),"uint8"),"label":((self.category_num,),"uint8"),"cues":((41,41,self.category_num),"uint8")})
+        todo = store.todo()
+        print("feature cache %s: %d images to process" % (self.config["feature_cache"],len(todo)))
+        if len(todo) == 0: return
+        self.data.select(todo)
+        gpu_options = session_config(self.config,gpu_frac)
+        self.sess = tf.Session(config=gpu_options)
+        x,_,y,c,id_of_image,iterator = self.data.next_batch(category="train",batch_size=batch_size,epoches=1)
+        self.build()
+        image = tf.cast(tf.image.resize_bilinear(self.net["input"]+self.data.img_mean,(41,41)),tf.uint8) # the image given to the crf
+        self.saver["norm"] = tf.train.Saver(max_to_keep=2,var_list=self.trainable_list)
+        with self.sess.as_default():
+            self.sess.run(tf.global_variables_initializer())
+            self.sess.run(iterator.initializer)
+            if self.config.get("model_path",False) is not False: self.restore_from_model(self.saver["norm"], self.config.get("model_path"), checkpoint=False)
+            while True:
+                try: data_x,data_y,data_c,data_id = self.sess.run([x,y,c,id_of_image])
+                except tf.errors.OutOfRangeError: break
+                feature,small = self.sess.run([self.net[FEATURE_LAYER],image],feed_dict={self.net["input"]:data_x})
+                store.write([one.decode("utf-8") for one in data_id],**{FEATURE_LAYER:feature,"image":small,"label":data_y,"cues":data_c})
+            store.flush()
+
     def inference(self, gpu_frac, eps=1e-5):
         if not os.path.exists(PRED_PATH): os.makedirs(PRED_PATH)
+        # the ids whose mask is cached for this checkpoint and config are not predicted again
+        cache = pred_cache(self.config["pred_cache"], max_mb=self.config.get("pred_cache_size",1024)) if self.config.get("pred_cache") else None
+        if cache is not None:
+            model_key = pred_cache.inference_key(__file__, self.config.get("model_path"), PRED_LAYER, eps, [self.h,self.w], widths=self.config.get("widths",{}), tta=self.config.get("tta"))
+            keys = {identy:cache.key(f, model_key) for identy, f in zip(self.data.data_f["train"]["id"], self.data.data_f["train"]["img"])}
+            self.data.select(cache.materialize(keys, PRED_PATH))
+            if self.data.get_data_len() == 0: return cache.finish({}, PRED_PATH)
         #Dump the predicted mask as numpy array to disk
-        gpu_options = tf.ConfigProto(gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_frac))
+        gpu_options = session_config(self.config,gpu_frac)
         self.sess = tf.Session(config=gpu_options)
         x, gt, _, _, id_of_image, iterator_train = self.data.next_batch(category="train",batch_size=1,epoches=-1)
         self.build()
+        # "tta": the views of the image are predicted in the same run and merged in the graph, e.g. {"scales":[1.0,0.75,1.25],"flip":true}
+        prediction = merge_views(self.net[PRED_LAYER], size=(self.h,self.w), **self.config["tta"]) if self.config.get("tta") else self.net[PRED_LAYER]
         self.saver["norm"] = tf.train.Saver(max_to_keep=2,var_list=self.trainable_list)
         with self.sess.as_default():
             self.sess.run(tf.global_variables_initializer())
@@ -402,7 +555,7 @@ class SEC():
             while epoch < 1:
                 data_x, data_gt, img_id = self.sess.run([x, gt, id_of_image])
                 cimg_id = img_id[0].decode("utf-8")
-                preds = self.sess.run(self.net["fc8-softmax"], feed_dict={self.net["input"]:data_x, self.net["drop_prob"]:0.5})
+                preds = self.sess.run(prediction, feed_dict={self.net["tta_input" if self.config.get("tta") else "input"]:data_x, self.net["drop_prob"]:1.0 if self.config.get("tta") else 0.5}) # drop_prob is the keep probability: the views are merged without dropout
                 for pred in preds:
                     img = Image.open("data/VOCdevkit/VOC2012/JPEGImages/{}.jpg".format(cimg_id)).resize((321,321), Image.ANTIALIAS)
                     scores_exp = np.exp(pred-np.max(pred, axis=2, keepdims=True))
@@ -411,8 +564,10 @@ class SEC():
                     probs[probs<eps] = eps
                     mask = np.argmax(probs, axis=2)
                     cPickle.dump(mask, open('{}/{}.pkl'.format(PRED_PATH, img_id[0].decode("utf-8")), 'wb'))
+                    if cache is not None: cache.put(keys[cimg_id], mask)
                 i+=1
                 epoch = i/iterations_per_epoch_train
+            if cache is not None: cache.finish({identy:keys[identy] for identy in self.data.data_f["train"]["id"]}, PRED_PATH)
 
 
 if __name__ == "__main__":
@@ -420,10 +575,20 @@ if __name__ == "__main__":
     os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
     batch_size = 1 # actual batch size=batch_size*accum_num
     input_size, category_num, epoches = (321,321), 21, 10
-    data = dataset({"batch_size":batch_size, "input_size":input_size, "epoches":epoches, "category_num":category_num, "categorys":["train"]})
+    overrides = json.loads(opt.overrides)
+    profile = load_profile(opt.thread_profile, "inference" if opt.action == "inference" else "train")
+    epoches = overrides.get("epoches", epoches)
+    data = dataset(dict({"batch_size":batch_size, "input_size":input_size, "epoches":epoches, "category_num":category_num, "categorys":["train"], "data_threads":profile.get("data_threads"), "exclude_held_out":opt.action in ['train','train_head','cache']}, **overrides))
     if opt.restore_iter_id == None: sec = SEC({"data":data, "batch_size":batch_size, "input_size":input_size, "epoches":epoches, "category_num":category_num, "init_model_path":"./model/init.npy", "accum_num":16})
     else: sec = SEC({"data":data, "batch_size":batch_size, "input_size":input_size, "epoches":epoches, "category_num":category_num, "model_path":"{}/norm-{}".format(SAVER_PATH, opt.restore_iter_id), "accum_num":16})
-    if opt.action == 'train':
-        sec.train(base_lr=1e-3, weight_decay=5e-5, momentum=0.9, batch_size=batch_size, epoches=epoches, gpu_frac=float(opt.gpu_frac))
+    sec.config.update({"resume":opt.resume, "checkpoint_interval":float(opt.ckpt_interval), "recompute":opt.recompute})
+    sec.config.update({"preflight":opt.preflight, "graph_cache":opt.graph_cache, "pred_cache":opt.pred_cache, "thread_profile":profile, "crf_workers":profile.get("crf_workers",1)})
+    sec.config.update(overrides)
+    sec.accum_num = sec.config["accum_num"]
+    sec.config.update({"feature_cache":opt.feature_cache if opt.feature_cache is not None else "sec-features", "head_only":opt.action == 'train_head'})
+    if opt.action in ['train','train_head']:
+        sec.train(base_lr=overrides.get("base_lr",1e-3), weight_decay=overrides.get("weight_decay",5e-5), momentum=overrides.get("momentum",0.9), batch_size=batch_size, epoches=epoches, gpu_frac=float(opt.gpu_frac))
     elif opt.action == 'inference':
-        sec.inference(gpu_frac=float(opt.gpu_frac))
\ No newline at end of file
+        sec.inference(gpu_frac=float(opt.gpu_frac))
+    elif opt.action == 'cache':
+        sec.cache_features(gpu_frac=float(opt.gpu_frac))
\ No newline at end of file
@@ -0,0 +1,110 @@
+import os
+import time
+import optparse
+import concurrent.futures
+import numpy as np
+import tensorflow as tf
+
+"""
+Pipelined CRF targets
+----------------------------------------------
+With config["async_crf"], `build_crf` makes the crf target a placeholder and the trainers run each step as two partial
+runs: the forward pass of batch k, then the backward pass of batch k-1 with its crf target. A side worker computes the
+crf of a batch while the network runs the forward pass of the next batch and the backward pass of the previous one, so
+the CRF no longer blocks the step. The target of a batch is exact (crf of its own prediction); its gradient is computed
+with the weights before the update of the previous micro-step, i.e. one step stale when that micro-step applied the
+accumulated gradients.
+     python async_crf.py -m SEC.py -n 300    # step time and loss curves, synchronous vs pipelined
+"""
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='model', default='SEC.py', help='model script (SEC.py or GAIN-SEC.py)')
+    parser.add_option('-n', dest='steps', default='200', help='number of training micro-steps of each mode')
+    parser.add_option('-b', dest='batch_size', default='1', help='batch size')
+    parser.add_option('-a', dest='accum_num', default='16', help='micro-steps per update')
+    parser.add_option('-l', dest='base_lr', default='1e-3', help='learning rate')
+    parser.add_option('-s', dest='seed', default='0', help='seed of the initialization and of the data order, shared by both modes')
+    parser.add_option('-o', dest='output', default='async_crf.tsv', help='loss of each step of both modes')
+    parser.add_option('-g', dest='gpu_id', default='0', help='specify to run on which GPU')
+    parser.add_option('-f', dest='gpu_frac', default='0.45', help='specify the memory utilization of GPU')
+    (options, args) = parser.parse_args()
+    return options
+
+class crf_pipeline():
+    """Runs the training steps of a model built with config["async_crf"]: forward of batch k, crf of batch k on the worker, backward of batch k-1"""
+    def __init__(self, sess, model, monitor=None):
+        self.sess, self.model, self.monitor = sess, model, monitor
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=1) # `run_crf` spreads a batch over the crf workers
+        self.pending = None
+
+    def run(self, fetches, params, tag=None):
+        """
+        Forward pass of the batch `params`, then backward pass (`fetches`) of the previous batch
+        return: the values of `fetches`, the feeds (with the crf target) and the `tag` of the previous batch, Nones on the first call
+        """
+        net = self.model.net
+        handle = self.sess.partial_run_setup([net["crf_featemap"], net["crf_image"]]+fetches, list(params)+[net["crf"]])
+        featemap, image = self.sess.partial_run(handle, [net["crf_featemap"], net["crf_image"]], feed_dict=params)
+        future = self.pool.submit(self.model.run_crf, featemap, image)
+        rst = self.flush()
+        self.pending = (handle, fetches, params, future, tag)
+        return rst
+
+    def flush(self):
+        """Backward pass of the pending batch (the last one, at the end of the training)"""
+        if self.pending is None: return None, None, None
+        handle, fetches, params, future, tag = self.pending
+        self.pending = None
+        start = time.time()
+        target = future.result()
+        if self.monitor is not None: self.monitor.add("crf_wait", time.time()-start)
+        return self.sess.partial_run(handle, fetches, feed_dict={self.model.net["crf"]:target}), dict(params, **{self.model.net["crf"]:target}), tag
+
+def bench(module, model_class, async_crf, opt):
+    """Step times and loss of each micro-step of `opt.steps` training steps"""
+    from dataset import dataset
+    tf.reset_default_graph()
+    tf.set_random_seed(int(opt.seed))
+    batch_size, accum_num = int(opt.batch_size), int(opt.accum_num)
+    data = dataset({"input_size":(321,321), "category_num":21, "categorys":["train"]})
+    config = {"data":data, "input_size":(321,321), "category_num":21, "accum_num":accum_num, "async_crf":async_crf}
+    if os.path.exists(os.path.join("model","init.npy")): config["init_model_path"] = os.path.join("model","init.npy")
+    model = model_class(config)
+    x, gt, y, c, _, iterator = data.next_batch(category="train", batch_size=batch_size, epoches=-1, seed=int(opt.seed))
+    model.build()
+    model.optimize(float(opt.base_lr), 0.9, 5e-5)
+    times, losses = [], []
+    with tf.Session(config=tf.ConfigProto(gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=float(opt.gpu_frac)))) as sess:
+        model.sess = sess
+        sess.run(tf.global_variables_initializer())
+        sess.run(iterator.initializer)
+        sess.run(tf.assign(model.net["lr"], float(opt.base_lr)))
+        pipeline = crf_pipeline(sess, model) if async_crf else None
+        for i in range(int(opt.steps)):
+            data_x, data_gt, data_y, data_c = sess.run([x, gt, y, c])
+            params = {model.net["input"]:data_x, model.net["label"]:data_y, model.net["cues"]:data_c, model.net["drop_prob"]:0.5}
+            if "gt" in model.net: params[model.net["gt"]] = data_gt
+            fetches = [model.net["accum_gradient_update"] if i % accum_num == accum_num-1 else model.net["accum_gradient_accum"], model.loss["total"]]
+            start = time.time()
+            values = pipeline.run(fetches, params)[0] if pipeline is not None else sess.run(fetches, feed_dict=params)
+            times.append(time.time()-start)
+            if values is not None: losses.append(values[1])
+        if pipeline is not None: losses.append(pipeline.flush()[0][1])
+    return times[2:], losses # the first steps allocate the memory
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+    from utils import load_model
+    module, model_class = load_model(opt.model)
+    rst = {mode:bench(module, model_class, mode == "async", opt) for mode in ["sync", "async"]}
+    with open(opt.output, "w") as f:
+        f.write("step\tsync\tasync\n")
+        for i, (a, b) in enumerate(zip(rst["sync"][1], rst["async"][1])): f.write("{}\t{}\t{}\n".format(i, a, b))
+    window = max(len(rst["sync"][1])//10, 1)
+    print("{:>6} {:>10} {:>10} {:>12} {:>12}".format("mode", "step p50", "step p90", "first loss", "last loss"))
+    for mode, (times, losses) in rst.items():
+        print("{:>6} {:>9.3f}s {:>9.3f}s {:>12.5f} {:>12.5f}".format(mode, np.percentile(times, 50), np.percentile(times, 90), np.mean(losses[:window]), np.mean(losses[-window:])))
+    print("speedup {:.2f}x, loss curves (mean of {} steps) differ by at most {:.5f}, written to {}".format(np.median(rst["sync"][0])/np.median(rst["async"][0]), window,
+          max(abs(np.mean(rst["sync"][1][k:k+window])-np.mean(rst["async"][1][k:k+window])) for k in range(0, len(rst["sync"][1]), window)), opt.output))
@@ -0,0 +1,64 @@
+import os
+import time
+import optparse
+import numpy as np
+import tensorflow as tf
+from recompute import split_blocks, block_name
+from utils import load_model
+
+"""
+Memory/time tradeoff of gradient checkpointing
+----------------------------------------------
+For each block of the backbone, time one forward+backward pass of the whole network (backbone and fc layers) and
+measure its peak memory, with only that block recomputed; the first line is the baseline without recomputation.
+  python bench_recompute.py -m SEC.py -b 2
+"""
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='model', default='SEC.py', help='model script')
+    parser.add_option('-b', dest='batch_size', default='1', help='batch size')
+    parser.add_option('-n', dest='iterations', default='5', help='number of timed iterations')
+    parser.add_option('-g', dest='gpu_id', default='0', help='specify to run on which GPU')
+    (options, args) = parser.parse_args()
+    return options
+
+def peak_memory(run_metadata):
+    """Peak memory (bytes) over the allocators of a traced run"""
+    peak = 0
+    for dev in run_metadata.step_stats.dev_stats:
+        for node in dev.node_stats:
+            for mem in node.memory: peak = max(peak, mem.allocator_bytes_in_use, mem.peak_bytes)
+    return peak
+
+def bench(module, model_class, recompute, batch_size, iterations):
+    tf.reset_default_graph()
+    model = model_class({"input_size":(321,321), "category_num":21, "recompute":recompute})
+    model.net["input"] = tf.placeholder(tf.float32, [None,model.h,model.w,3])
+    model.net["drop_prob"] = tf.placeholder_with_default(0.5, [])
+    fc = model.build_fc(model.build_block("input", module.BLOCK_LAYERS), module.FC_LAYERS)
+    loss = tf.reduce_sum(model.net[fc])
+    grads = tf.gradients(loss, model.trainable_list)
+    feed = {model.net["input"]:np.random.uniform(-128, 128, (batch_size,model.h,model.w,3))}
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(grads, feed_dict=feed) # warm up
+        run_metadata = tf.RunMetadata()
+        sess.run(grads, feed_dict=feed, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+        times = []
+        for i in range(iterations):
+            start = time.time()
+            sess.run(grads, feed_dict=feed)
+            times.append(time.time()-start)
+    return np.median(times), peak_memory(run_metadata)
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+    module, model_class = load_model(opt.model)
+    base_time, base_memory = bench(module, model_class, False, int(opt.batch_size), int(opt.iterations))
+    print("{:>10} {:>10} {:>12} {:>10} {:>12}".format("recompute", "time(s)", "peak(MB)", "time", "memory"))
+    print("{:>10} {:>10.3f} {:>12.1f} {:>10} {:>12}".format("none", base_time, base_memory/2**20, "-", "-"))
+    for name in [block_name(block) for block in split_blocks(module.BLOCK_LAYERS)]+[True]:
+        t, m = bench(module, model_class, True if name is True else [name], int(opt.batch_size), int(opt.iterations))
+        print("{:>10} {:>10.3f} {:>12.1f} {:>+9.1f}% {:>+11.1f}%".format("all" if name is True else name, t, m/2**20, 100*(t/base_time-1), 100*(m/max(base_memory,1)-1)))
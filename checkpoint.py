@@ -0,0 +1,80 @@
+import os
+import re
+import json
+import time
+import queue
+import threading
+import numpy as np
+
+class checkpointer():
+    """
+    Asynchronous, time-based checkpointing of the full training state
+    ------------------------------------------------------------------------
+    The variables (weights, optimizer slots, accumulated gradients, lr) are fetched by the training thread
+    between two steps so that the snapshot is consistent, then a background thread serializes them to
+    `<saver_path>/state-<step>.npz`. The python-side state (step, lr schedule, data position, ...) goes to
+    `<saver_path>/state-<step>.json`, which is written last and marks the checkpoint as complete.
+    """
+    def __init__(self, sess, var_list, saver_path, interval=1800, max_to_keep=2):
+        self.sess, self.var_list, self.saver_path = sess, var_list, saver_path
+        self.interval, self.max_to_keep, self.last_time = interval, max_to_keep, time.time()
+        if not os.path.exists(saver_path): os.makedirs(saver_path)
+        # at most one snapshot waits while another one is written to disk
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def list_states(saver_path):
+        if not os.path.exists(saver_path): return []
+        steps = [int(m.group(1)) for m in [re.match(r"^state-(\d+)\.json$", f) for f in os.listdir(saver_path)] if m is not None]
+        return sorted(s for s in steps if os.path.exists(os.path.join(saver_path, "state-{}.npz".format(s))))
+
+    @staticmethod
+    def latest_state(saver_path):
+        """Return the python-side state of the latest complete checkpoint, or None"""
+        steps = checkpointer.list_states(saver_path)
+        if len(steps) == 0: return None
+        with open(os.path.join(saver_path, "state-{}.json".format(steps[-1])), "r") as f: return json.load(f)
+
+    def step(self, i, state, force=False):
+        """Snapshot the training state if `interval` seconds passed since the last one; returns True if saved"""
+        if not force and time.time()-self.last_time < self.interval: return False
+        self.last_time = time.time()
+        values = self.sess.run(self.var_list)
+        state = dict(state, step=i, time=self.last_time, names=[v.name for v in self.var_list])
+        self.queue.put((i, values, state))
+        return True
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            i, values, state = item
+            try: self.write(i, values, state)
+            except Exception as e: print("[checkpoint] failed to save step {}: {}".format(i, e))
+
+    def write(self, i, values, state):
+        path = os.path.join(self.saver_path, "state-{}".format(i))
+        np.savez(path+".tmp.npz", **{"v{}".format(k):v for k,v in enumerate(values)})
+        os.replace(path+".tmp.npz", path+".npz")
+        with open(path+".tmp.json", "w") as f: json.dump(state, f)
+        os.replace(path+".tmp.json", path+".json")
+        for old in checkpointer.list_states(self.saver_path)[:-self.max_to_keep]:
+            for ext in [".json", ".npz"]: os.remove(os.path.join(self.saver_path, "state-{}{}".format(old, ext)))
+        print("[checkpoint] saved state of step {} to {}.npz".format(i, path))
+
+    def restore(self, state):
+        """Load the variables saved with `state` (as returned by `latest_state`) into the session"""
+        values = np.load(os.path.join(self.saver_path, "state-{}.npz".format(state["step"])))
+        saved = {name:"v{}".format(k) for k,name in enumerate(state["names"])}
+        for v in self.var_list:
+            if v.name not in saved:
+                print("[checkpoint] {} not found in the checkpoint, keep its initial value".format(v.name))
+                continue
+            v.load(values[saved[v.name]], self.sess)
+        print("[checkpoint] restored state of step {}".format(state["step"]))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
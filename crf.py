@@ -7,6 +7,7 @@ import time
 import numpy as np 
 import skimage
 import skimage.io as imgio
+import multiprocessing
 import pydensecrf.densecrf as dcrf
 
 def crf_inference(feat, img, crf_config, categorys_num, gt_prob=0.7, use_log=False):
@@ -36,3 +37,16 @@ def crf_inference(feat, img, crf_config, categorys_num, gt_prob=0.7, use_log=Fal
     crf.addPairwiseBilateral(sxy=crf_config["bi_sxy"], srgb=crf_config["bi_srgb"], rgbim=img, compat=crf_config["bi_compat"])
     Q = np.transpose(np.array(crf.inference(crf_config["iterations"])).reshape((categorys_num,h,w)), axes=[1,2,0]) # new shape: [h,w,c]
     return Q
+
+_pools = {}
+def _crf_one(args):
+    return crf_inference(*args)
+
+def crf_batch(feats, imgs, crf_config, categorys_num, workers=1):
+    """
+    crf_inference of each image of a batch, shape [N,h,w,c]; with `workers` > 1 the images are spread over a pool of
+    processes (pydensecrf holds the GIL), started once per process on the first call
+    """
+    if workers <= 1 or len(feats) <= 1: return np.stack([crf_inference(feat, img, crf_config, categorys_num) for feat, img in zip(feats, imgs)])
+    if workers not in _pools: _pools[workers] = multiprocessing.get_context("spawn").Pool(workers) # not fork: the threads of the session would be copied in a random state
+    return np.stack(_pools[workers].map(_crf_one, [(feat, img, crf_config, categorys_num) for feat, img in zip(feats, imgs)]))
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import optparse
+import multiprocessing
+import numpy as np
+from crf import crf_inference
+from feature_cache import feature_store
+from npinfer import resize_bilinear
+from sweep import points
+
+"""
+CRF hyperparameter search
+----------------------------------------------
+Run the network once over the held-out ids and cache its unaries (the `fc8` scores given to the crf by `build_crf`),
+the 41x41 images and the gts in a memory-mapped store, then score a grid of `crf_config` on a pool of processes: each
+config only costs crf time, its mIoU is accumulated chunk by chunk and printed as soon as all its chunks are done
+     python crf_search.py -m SEC.py -r sec-saver/norm-104999 -j 16
+     python crf_search.py -m SEC.py -r sec-saver/norm-104999 -s crf_grid.json    # {"grid":{"bi_srgb":[5,13,20]}} or a random search, as sweep.py
+ * the values of the spec override the defaults of `run_crf`; the mask of a config is the argmax of the crf output
+   resized to the input size, as in evaluate.py, and "none" is the network alone
+ * `<out>/crf_search.tsv`: mIoU and pixel accuracy of each config, the best first; use it with `-o '{"crf_config":...}'`
+"""
+
+CRF_CONFIG = {"g_sxy":3/12, "g_compat":3, "bi_sxy":80/12, "bi_srgb":13, "bi_compat":10, "iterations":5} # the defaults of `run_crf`
+GRID = {"grid":{"bi_sxy":[40/12, 80/12, 120/12], "bi_srgb":[5, 13, 20, 30], "bi_compat":[5, 10, 15]}}
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='model', default='SEC.py', help='model script (SEC.py or GAIN-SEC.py)')
+    parser.add_option('-r', dest='model_path', default=None, help='checkpoint of the trained model, e.g. sec-saver/norm-104999')
+    parser.add_option('-w', dest='widths', default=None, help='widths.json of a pruned or distilled model')
+    parser.add_option('-s', dest='spec', default=None, help='json of the configs to score: {"grid":{...}} or {"random":{...},"trials":n} (default: bi_sxy x bi_srgb x bi_compat)')
+    parser.add_option('-o', dest='output', default=None, help='directory of the unary store and of the results (default: crf-<model>)')
+    parser.add_option('-i', dest='id_list', default=None, help='file of the held-out ids, one per line (default: the first -n ids of data/held_out.txt, which the trainers leave out)')
+    parser.add_option('-n', dest='num', default='300', help='number of held-out ids (the size of data/held_out.txt when it is drawn)')
+    parser.add_option('-c', dest='chunk', default='25', help='images per task of the pool')
+    parser.add_option('-j', dest='workers', default=str(os.cpu_count()), help='crf processes')
+    parser.add_option('-b', dest='batch_size', default='4', help='batch size of the network')
+    parser.add_option('-g', dest='gpu_id', default='0', help='specify to run on which GPU, "" for the CPU')
+    parser.add_option('-f', dest='gpu_frac', default='0.2', help='specify the memory utilization of GPU')
+    (options, args) = parser.parse_args()
+    return options
+
+def cache_unaries(module, model_class, path, opt):
+    """Write the unaries, the 41x41 images and the gts of the held-out ids to the store `path` (only the rows not written yet)"""
+    import tensorflow as tf
+    from dataset import dataset
+    from evaluate import held_out
+    batch_size = int(opt.batch_size)
+    data = dataset({"batch_size":batch_size, "input_size":(321,321), "category_num":21, "categorys":["train"]})
+    store = feature_store.create(path, held_out(data, opt), {"unary":((41,41,21),"float32"), "image":((41,41,3),"uint8"), "gt":((321,321),"uint8")})
+    todo = store.todo()
+    print("unary store %s: %d images to process" % (path, len(todo)))
+    if len(todo) == 0: return store
+    data.select(todo)
+    config = {"data":data, "input_size":(321,321), "category_num":21}
+    if opt.widths is not None:
+        with open(opt.widths, "r") as f: config["widths"] = json.load(f)["widths"]
+    with tf.Graph().as_default():
+        model = model_class(config)
+        x, gt, y, _, id_of_image, iterator = data.next_batch(category="train", batch_size=batch_size, epoches=1)
+        model.build()
+        if "crf" not in model.net: raise Exception("{} has no crf".format(opt.model))
+        image = tf.image.resize_bilinear(model.net["input"]+data.img_mean, (41,41)) # the image of `build_crf`
+        with tf.Session(config=tf.ConfigProto(gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=float(opt.gpu_frac)))) as sess:
+            model.sess = sess
+            sess.run(tf.global_variables_initializer())
+            model.restore_from_model(tf.train.Saver(var_list=model.trainable_list), opt.model_path, checkpoint=False)
+            sess.run(iterator.initializer)
+            while True:
+                try: data_x, data_gt, data_y, data_id = sess.run([x, gt, y, id_of_image])
+                except tf.errors.OutOfRangeError: break
+                feed = {model.net["input"]:data_x, model.net["drop_prob"]:1.0}
+                if "label" in model.net: feed[model.net["label"]] = data_y
+                unary, small = sess.run([model.net[module.FC_LAYERS[-1]], image], feed_dict=feed)
+                store.write([one.decode("utf-8") for one in data_id], unary=unary, image=small.astype(np.uint8), gt=data_gt[...,0])
+    store.flush()
+    return store
+
+_store = None
+def score_chunk(args):
+    """Confusion matrix of the config `crf_config` (None: no crf) on the rows `start:stop` of the store, run by the pool"""
+    global _store
+    path, k, crf_config, start, stop = args
+    if _store is None or _store.path != path: _store = feature_store(path) # opened once per process, read through the page cache
+    conf = np.zeros((21,21), dtype=np.int64)
+    for row in range(start, stop):
+        unary = _store["unary"][row]
+        if crf_config is None:
+            probs = np.exp(unary-np.max(unary, axis=2, keepdims=True))
+            probs /= np.sum(probs, axis=2, keepdims=True)
+        else: probs = crf_inference(unary, _store["image"][row], crf_config, 21)
+        mask, gt = np.argmax(resize_bilinear(probs[None].astype(np.float32), (321,321))[0], axis=2), _store["gt"][row].astype(np.int64)
+        valid = gt != 255 # as evaluate.confusion, without loading tensorflow in the workers
+        conf += np.bincount(21*gt[valid]+mask[valid], minlength=21**2).reshape(21, 21)
+    return k, conf
+
+def miou(conf):
+    inter, union = np.diag(conf), conf.sum(axis=0)+conf.sum(axis=1)-np.diag(conf)
+    return (inter/np.maximum(union, 1))[union > 0].mean(), inter.sum()/max(conf.sum(), 1)
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+    from utils import load_model
+    module, model_class = load_model(opt.model)
+    output = opt.output if opt.output is not None else "crf-{}".format(os.path.splitext(os.path.basename(opt.model))[0])
+    store = cache_unaries(module, model_class, os.path.join(output, "unaries"), opt)
+    spec = GRID
+    if opt.spec is not None:
+        with open(opt.spec, "r") as f: spec = json.load(f)
+    configs = [None, CRF_CONFIG]+[dict(CRF_CONFIG, **point) for point in points(spec) if dict(CRF_CONFIG, **point) != CRF_CONFIG]
+    chunk, n = int(opt.chunk), len(store)
+    tasks = [(store.path, k, config, start, min(start+chunk, n)) for k, config in enumerate(configs) for start in range(0, n, chunk)]
+    left, conf, rst = {k:len(range(0, n, chunk)) for k in range(len(configs))}, {k:0 for k in range(len(configs))}, []
+    print("{} configs on {} images, {} crf processes".format(len(configs), n, opt.workers))
+    begin = time.time()
+    with multiprocessing.get_context("spawn").Pool(int(opt.workers)) as pool: # processes, pydensecrf holds the GIL; not fork: the threads of the session would be copied in a random state
+        for k, c in pool.imap_unordered(score_chunk, tasks):
+            conf[k], left[k] = conf[k]+c, left[k]-1
+            if left[k] > 0: continue
+            rst.append((miou(conf[k]), configs[k]))
+            print("[{}/{}] mIoU={:.4f} pixel_acc={:.4f} {} ({:.0f}s)".format(len(rst), len(configs), rst[-1][0][0], rst[-1][0][1], "none" if configs[k] is None else json.dumps(configs[k], sort_keys=True), time.time()-begin))
+    rst.sort(key=lambda one: -one[0][0])
+    with open(os.path.join(output, "crf_search.tsv"), "w") as f:
+        f.write("mIoU\tpixel_acc\tcrf_config\n")
+        for (m, acc), config in rst: f.write("{:.4f}\t{:.4f}\t{}\n".format(m, acc, "none" if config is None else json.dumps(config, sort_keys=True)))
+    default = next(m for (m, _), config in rst if config == CRF_CONFIG)
+    best = next((one for one in rst if one[1] is not None))
+    print("best crf_config: {} mIoU={:.4f} (default {:.4f}, no crf {:.4f})".format(json.dumps(best[1], sort_keys=True), best[0][0], default, next(m for (m, _), config in rst if config is None)))
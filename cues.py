@@ -0,0 +1,135 @@
+import os
+import sys
+import glob
+import time
+import threading
+import subprocess
+import optparse
+import numpy as np
+
+"""
+Localization cues
+----------------------
+ * `cues_store`: indexed store of localization cues, a drop-in replacement of `data/localization_cues.pickle`
+   (same `<id>_labels` / `<id>_cues` keys), written as shards of npz files plus one append-only index per worker
+ * generator: run a trained model over `input_list.txt` in large batches, threshold the attention map
+   (`fc8-softmax` for SEC/GAIN-SEC, `gcam` for GAIN-GCAM) of each labeled class and write the cues to a store
+     python cues.py -m GAIN-GCAM.py -r gain_gcam-saver/norm-104999 -o data/cues-gcam -j 2 -g 0,1
+   the job is resumable: rerunning the same command skips the ids that are already in the store
+"""
+
+class cues_store():
+    def __init__(self, path):
+        self.path, self.shards, self.lock = path, {}, threading.Lock()
+        self.index = {}
+        for f in glob.glob(os.path.join(path, "index-*.txt")):
+            with open(f, "r") as index:
+                for line in index.readlines():
+                    identy, shard = line.split()
+                    self.index[identy] = shard
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key.rsplit("_", 1)[0] in self.index
+
+    def __getitem__(self, key):
+        """key: `<id>_labels` or `<id>_cues`, as in localization_cues.pickle"""
+        shard = self.index[key.rsplit("_", 1)[0]]
+        with self.lock:
+            if shard not in self.shards: self.shards[shard] = np.load(os.path.join(self.path, shard))
+            return self.shards[shard][key]
+
+    @staticmethod
+    def write(path, worker, cues):
+        """Write the cues {`<id>_labels`:..., `<id>_cues`:...} to a new shard, then append its ids to the index of `worker`"""
+        if not os.path.exists(path): os.makedirs(path)
+        shard = "shard-{}-{}.npz".format(worker, int(time.time()*1000))
+        np.savez(os.path.join(path, shard+".tmp.npz"), **cues)
+        os.replace(os.path.join(path, shard+".tmp.npz"), os.path.join(path, shard))
+        with open(os.path.join(path, "index-{}.txt".format(worker)), "a") as index:
+            for key in sorted(cues):
+                if key.endswith("_labels"): index.write("{} {}\n".format(key[:-len("_labels")], shard))
+
+def attention_to_cues(att, label, th=0.5):
+    """
+    att: attention maps [N,41,41,#class], label: image-level labels [N,#class]
+    return: for each image the labeled classes and the cues [3,#cues] (class, row, col); a pixel gets the labeled class with
+            the highest normalized attention, if this one is at least `th` of the maximum of the class's map
+    """
+    att = np.maximum(att, 0) * (label[:,np.newaxis,np.newaxis,:] > 0)
+    att = att / np.maximum(np.max(att, axis=(1,2), keepdims=True), 1e-12)
+    cls, score = np.argmax(att, axis=3), np.max(att, axis=3)
+    rst = []
+    for i in range(att.shape[0]):
+        rows, cols = np.nonzero(score[i] >= th)
+        rst.append((np.nonzero(label[i])[0], np.stack([cls[i][rows,cols], rows, cols]).astype(np.int64)))
+    return rst
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='model', default='GAIN-GCAM.py', help='model script')
+    parser.add_option('-r', dest='model_path', default=None, help='checkpoint of the trained model, e.g. gain_gcam-saver/norm-104999')
+    parser.add_option('-o', dest='output', default=os.path.join("data","cues"), help='directory of the cue store')
+    parser.add_option('-l', dest='layer', default=None, help='attention map: fc8-softmax or gcam (default: the prediction of the model)')
+    parser.add_option('-c', dest='th', default='0.5', help='threshold, relative to the maximum of each class map')
+    parser.add_option('-b', dest='batch_size', default='16', help='batch size')
+    parser.add_option('-s', dest='shard_size', default='500', help='number of images per shard')
+    parser.add_option('-j', dest='jobs', default='1', help='number of parallel workers')
+    parser.add_option('-k', dest='worker', default=None, help='index of this worker (set by the launcher)')
+    parser.add_option('-g', dest='gpu_id', default='0', help='GPUs, assigned to the workers in turn, e.g. 0,1')
+    parser.add_option('-f', dest='gpu_frac', default='0.9', help='specify the memory utilization of GPU')
+    (options, args) = parser.parse_args()
+    return options
+
+def generate(opt):
+    import tensorflow as tf
+    from dataset import dataset
+    from utils import load_model
+    worker, jobs, batch_size = int(opt.worker), int(opt.jobs), int(opt.batch_size)
+    module, model_class = load_model(opt.model)
+    layer = opt.layer if opt.layer is not None else module.PRED_LAYER
+    data = dataset({"batch_size":batch_size, "input_size":(321,321), "category_num":21, "categorys":["train"]})
+    done = cues_store(opt.output).index if os.path.exists(opt.output) else {}
+    ids = [identy for k,identy in enumerate(data.data_f["train"]["id_for_slice"]) if k % jobs == worker and identy not in done]
+    print("[worker {}] {} images to process, {} already done".format(worker, len(ids), len(done)))
+    if len(ids) == 0: return
+    data.select(ids, key="id_for_slice")
+    if layer == "gcam" and batch_size > 1: print("[worker {}] warning: Grad-CAM normalizes the gradients over the batch".format(worker))
+    model = model_class({"data":data, "input_size":(321,321), "category_num":21})
+    x, _, y, _, id_of_image, iterator = data.next_batch(category="train", batch_size=batch_size, epoches=1)
+    identy_of = dict(zip(data.data_f["train"]["id"], data.data_f["train"]["id_for_slice"]))
+    model.build()
+    saver = tf.train.Saver(var_list=model.trainable_list)
+    sess = tf.Session(config=tf.ConfigProto(gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=float(opt.gpu_frac))))
+    sess.run(tf.global_variables_initializer())
+    sess.run(iterator.initializer)
+    saver.restore(sess, opt.model_path)
+    cues, count, start = {}, 0, time.time()
+    while True:
+        try: data_x, data_y, data_id = sess.run([x, y, id_of_image])
+        except tf.errors.OutOfRangeError: break
+        feed = {model.net["input"]:data_x, model.net["drop_prob"]:1.0}
+        if "label" in model.net: feed[model.net["label"]] = data_y
+        att = sess.run(model.net[layer], feed_dict=feed)
+        for id_, (labels, c) in zip(data_id, attention_to_cues(att, data_y, float(opt.th))):
+            identy = identy_of[id_.decode("utf-8")]
+            cues["{}_labels".format(identy)], cues["{}_cues".format(identy)] = labels, c
+        count += len(data_x)
+        if len(cues) >= 2*int(opt.shard_size):
+            cues_store.write(opt.output, worker, cues)
+            cues = {}
+            print("[worker {}] {}/{} images, {:.1f} images/s".format(worker, count, len(ids), count/(time.time()-start)))
+    if len(cues) > 0: cues_store.write(opt.output, worker, cues)
+    print("[worker {}] done: {} images in {:.1f}s".format(worker, count, time.time()-start))
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    if opt.worker is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+        generate(opt)
+    else: # launch one process per worker, each one on a GPU of the list
+        gpus, jobs = opt.gpu_id.split(","), int(opt.jobs)
+        procs = [subprocess.Popen([sys.executable]+sys.argv+["-k", str(k), "-g", gpus[k % len(gpus)]]) for k in range(jobs)]
+        sys.exit(max([p.wait() for p in procs]))
@@ -9,6 +9,18 @@ import tensorflow as tf
 import skimage.io as imgio
 from datetime import datetime
 import skimage.transform as imgtf
+from cues import cues_store
+from feature_cache import feature_store
+
+IMG_MEAN = np.array([104.00698793,116.66876762,122.67891434],dtype=np.float32) # per channel (BGR), broadcast over the images
+HELD_OUT = os.path.join("data","held_out.txt") # ids kept out of the training, scored by evaluate.py, prune.py, distill.py, crf_search.py and tta.py
+
+def held_out_ids(ids,num=300,path=HELD_OUT):
+    """The first `num` held-out ids of `path` that are in `ids`; the file is drawn once from `ids` (seed 0, `num` ids) if it does not exist"""
+    if not os.path.exists(path):
+        with open(path,"w") as f: f.write("".join("%s\n" % one for one in sorted(np.random.RandomState(0).choice(ids,min(num,len(ids)),replace=False).tolist())))
+    known = set(ids)
+    with open(path,"r") as f: return [line.strip() for line in f if line.strip() in known][:num]
 
 class dataset():
     def __init__(self,config={}):
@@ -19,17 +31,22 @@ class dataset():
         self.main_path = self.config.get("main_path",os.path.join("data","VOCdevkit","VOC2012"))
         self.ignore_label = self.config.get("ignore_label",255)
         self.default_category = self.config.get("default_category",self.categorys[0])
-        self.img_mean = np.ones((self.w,self.h,3))
-        self.img_mean[:,:,0] *= 104.00698793
-        self.img_mean[:,:,1] *= 116.66876762
-        self.img_mean[:,:,2] *= 122.67891434
+        self.img_mean = IMG_MEAN
         self.data_f,self.data_len = self.get_data_f()
+        # "exclude_held_out": train without the ids of data/held_out.txt, so the held-out scores are not on training images
+        if self.config.get("exclude_held_out",False):
+            held = set(held_out_ids(self.data_f["train"]["id"]))
+            self.select([one for one in self.data_f["train"]["id"] if one not in held])
+        # images and gts decoded once by `write_decoded`, read through a read-only memory map shared by the processes
+        self.decoded = feature_store(self.config["decoded_cache"]) if self.config.get("decoded_cache") else None
 
     def get_data_len(self,category=None):
         return self.data_len[category if category is not None else self.default_category]
 
     def get_data_f(self):
-        self.cues_data = pickle.load(open("data/localization_cues.pickle","rb"),encoding="iso-8859-1")
+        cues_path = self.config.get("cues_path",os.path.join("data","localization_cues.pickle"))
+        # either the original pickle or a directory written by cues.py, both indexed by `<id>_labels` and `<id>_cues`
+        self.cues_data = cues_store(cues_path) if os.path.isdir(cues_path) else pickle.load(open(cues_path,"rb"),encoding="iso-8859-1")
         data_f, data_len = {}, {}
         for category in self.categorys:
             data_f[category] = {"img":[],"gt":[],"label":[],"id":[],"id_for_slice":[]}
@@ -58,13 +75,31 @@ class dataset():
         print("len:%s" % str(data_len))
         return data_f,data_len
 
-    def next_batch(self,category=None,batch_size=None,epoches=-1):
+    def select(self,ids,category=None,key="id"):
+        """Keep only the images whose `key` ("id" or "id_for_slice") is in `ids`"""
+        category = self.default_category if category is None else category
+        ids = set(ids)
+        keep = [k for k,one in enumerate(self.data_f[category][key]) if one in ids]
+        for field in ["id","id_for_slice","img","gt"]:
+            self.data_f[category][field] = [self.data_f[category][field][k] for k in keep]
+        self.data_len[category] = len(keep)
+
+    def next_batch(self,category=None,batch_size=None,epoches=-1,seed=None,skip=0,augment=False,sampler=None):
+        """
+        `seed` makes the shuffling order reproducible, `skip` drops the first samples (used to resume the iterator position)
+        `sampler`: a generator of the indexes of the samples (e.g. sampler.loss_sampler), replaces the uniform shuffling
+        `augment`: apply the augmentations of config["augment"] to the batches, e.g. {"flip":True,"random_scale":(0.75,1.25),"rotate":10}
+        """
         category = self.default_category if category is None else category
         batch_size = self.config.get("batch_size",1) if batch_size is None else batch_size
         dataset = tf.data.Dataset.from_tensor_slices({"id":self.data_f[category]["id"], "id_for_slice":self.data_f[category]["id_for_slice"], "img_f":self.data_f[category]["img"], "gt_f":self.data_f[category]["gt"]})
         def m(x):
-            img, gt = self.image_preprocess(tf.image.decode_image(tf.read_file(x["img_f"])), tf.image.decode_image(tf.read_file(x["gt_f"])), random_scale=False, flip=False, rotate=False)
-            #img = self.image_preprocess(img,random_scale=True,flip=True,rotate=False)
+            if self.decoded is not None:
+                def get_image(identy):
+                    row = self.decoded.row[identy.decode()]
+                    return self.decoded["image"][row].astype(np.float32), self.decoded["gt"][row]
+                img, gt = tf.py_func(get_image, [x["id"]], [tf.float32,tf.uint8])
+            else: img, gt = self.image_preprocess(tf.image.decode_image(tf.read_file(x["img_f"])), tf.image.decode_image(tf.read_file(x["gt_f"])))
             img, gt = tf.reshape(img,[self.h,self.w,3]), tf.reshape(gt,[self.h,self.w,1])
             def get_data(identy):
                 identy, label, cues = identy.decode(), np.zeros([self.category_num]), np.zeros([41,41,21])
@@ -76,14 +111,71 @@ class dataset():
             label.set_shape([21])
             cues.set_shape([41,41,21])
             return img, gt, label, cues, x["id"]
-        iterator = dataset.repeat(epoches).shuffle(self.data_len[category]).map(m).batch(batch_size).make_initializable_iterator()
+        options = dict(self.config.get("augment",{}), seed=seed) if augment else {}
+        def a(img, gt, label, cues, id_):
+            img, gt, cues = self.batch_preprocess(img, gt, cues, **options)
+            return img, gt, label, cues, id_
+        # only the decoding and the resizing run per sample, the rest runs once per batch; "data_threads": samples decoded in parallel (None: one at a time)
+        if sampler is not None:
+            fields = {k:tf.constant(self.data_f[category][v]) for k,v in [("id","id"),("id_for_slice","id_for_slice"),("img_f","img"),("gt_f","gt")]}
+            dataset = tf.data.Dataset.from_generator(sampler,tf.int64,tf.TensorShape([])).map(lambda k: {f:tf.gather(fields[f],k) for f in fields})
+        else: dataset = dataset.repeat(epoches).shuffle(self.data_len[category], seed=seed).skip(skip)
+        iterator = dataset.map(m,num_parallel_calls=self.config.get("data_threads")).batch(batch_size).map(a).make_initializable_iterator()
         img, gt, label, cues, id_ = iterator.get_next()
         return img, gt, label, cues, id_, iterator
 
-    def image_preprocess(self,img,gt,random_scale=True,flip=False,rotate=False):
+    def write_decoded(self,path,category=None,batch_size=16):
+        """Decode and resize the images and gts of `category` once into a memory-mapped store (uint8), for config["decoded_cache"]"""
+        category = self.default_category if category is None else category
+        store = feature_store.create(path, self.data_f[category]["id"], {"image":((self.h,self.w,3),"uint8"), "gt":((self.h,self.w,1),"uint8")})
+        todo = set(store.todo())
+        print("decoded cache %s: %d images to decode" % (path,len(todo)))
+        if len(todo) == 0: return
+        keep = [k for k,one in enumerate(self.data_f[category]["id"]) if one in todo]
+        with tf.Graph().as_default():
+            dataset = tf.data.Dataset.from_tensor_slices({field:[self.data_f[category][field][k] for k in keep] for field in ["id","img","gt"]})
+            def m(x):
+                img, gt = self.image_preprocess(tf.image.decode_image(tf.read_file(x["img"])), tf.image.decode_image(tf.read_file(x["gt"])))
+                return tf.cast(tf.round(tf.reshape(img,[self.h,self.w,3])),tf.uint8), tf.reshape(gt,[self.h,self.w,1]), x["id"]
+            img, gt, id_ = dataset.map(m).batch(batch_size).make_one_shot_iterator().get_next()
+            with tf.Session() as sess:
+                while True:
+                    try: data_img, data_gt, data_id = sess.run([img,gt,id_])
+                    except tf.errors.OutOfRangeError: break
+                    store.write([one.decode("utf-8") for one in data_id], image=data_img, gt=data_gt)
+        store.flush()
+
+    def image_preprocess(self,img,gt):
         img = tf.squeeze(tf.image.resize_bilinear(tf.expand_dims(img, axis=0),(self.h, self.w)), axis=0)
         gt = tf.squeeze(tf.image.resize_nearest_neighbor(tf.expand_dims(gt, axis=0),(self.h, self.w)), axis=0)
-        r,g,b = tf.split(axis=2,num_or_size_splits=3,value=img)
-        img = tf.cast(tf.concat([b,g,r], 2), dtype=tf.float32)
-        img -= self.img_mean
         return img, gt
+
+    def batch_preprocess(self,img,gt,cues,random_scale=False,flip=False,rotate=False,seed=None):
+        """
+        Vectorized preprocessing of a batch: RGB->BGR and mean subtraction, then the augmentations, drawn for each image and
+        applied in the same way to the image [N,h,w,3], the gt [N,h,w,1] and the cues [N,41,41,C]
+         * flip: random horizontal flip
+         * random_scale: (min,max) zoom factor, the image is cropped (>1) or padded (<1) with the mean color, the ignore label and no cue
+         * rotate: maximum angle in degrees, the corners are filled in the same way
+        """
+        img = tf.reverse(img,axis=[3]) - self.img_mean
+        n, dtype, gt = tf.shape(img)[0], gt.dtype, tf.cast(gt,tf.float32)
+        seeds = iter([None]*5 if seed is None else range(seed,seed+5)) # one op seed per random draw, otherwise the draws are equal
+        if flip:
+            f = tf.random_uniform([n],seed=next(seeds)) < 0.5
+            img, gt, cues = [tf.where(f,tf.reverse(one,axis=[2]),one) for one in [img,gt,cues]]
+        if random_scale:
+            side = 1.0/tf.random_uniform([n],random_scale[0],random_scale[1],seed=next(seeds))
+            # a box of the zoomed size at a random position, inside the image when zooming in and around it when zooming out
+            y, x = [tf.random_uniform([n],seed=next(seeds))*(1-side) for _ in range(2)]
+            boxes, box_ind = tf.stack([y,x,y+side,x+side],axis=1), tf.range(n)
+            img = tf.image.crop_and_resize(img,boxes,box_ind,(self.h,self.w),extrapolation_value=0)
+            gt = tf.image.crop_and_resize(gt,boxes,box_ind,(self.h,self.w),method="nearest",extrapolation_value=self.ignore_label)
+            cues = tf.image.crop_and_resize(cues,boxes,box_ind,(41,41),method="nearest",extrapolation_value=0)
+        if rotate:
+            angles = tf.random_uniform([n],-rotate,rotate,seed=next(seeds))*math.pi/180
+            img = tf.contrib.image.rotate(img,angles,interpolation="BILINEAR")
+            gt = tf.contrib.image.rotate(gt+1,angles,interpolation="NEAREST") # the corners are filled with 0, i.e. the ignore label
+            gt = tf.where(tf.equal(gt,0),self.ignore_label*tf.ones_like(gt),gt-1)
+            cues = tf.contrib.image.rotate(cues,angles,interpolation="NEAREST")
+        return img, tf.cast(gt,dtype), cues
@@ -0,0 +1,107 @@
+import os
+import json
+import types
+import optparse
+import numpy as np
+import tensorflow as tf
+from dataset import dataset
+from feature_cache import feature_store
+from evaluate import held_out
+from prune import layer_order, session, calibrate, importance, prune, write, finetune, measure
+from utils import load_model
+
+"""
+Knowledge distillation into a narrow student
+----------------------------------------------
+A trained SEC or GAIN-SEC checkpoint is the teacher: its `fc8-softmax` of each training image is computed once into a
+memory-mapped store, then a narrow DeepLab-LargeFOV (SEC.py with `widths`) is trained with the seed and expand losses
+of SEC and, instead of the crf constraint, the KL divergence to the teacher softmax (config["distill"])
+     python distill.py -m GAIN-SEC.py -r gain-saver/norm-104999 -k 0.35 -e 4
+ * `<out>/teacher`: the teacher store (feature_cache.feature_store, float16), resumed if interrupted
+ * `<out>/student`: `norm-0`, the student initialized with the best channels of the teacher (as prune.py), the distilled
+   `norm-<iter>` and `widths.json`; the student is an SEC model, its masks are predicted by the usual `inference()`:
+     python SEC.py -a inference -o '{"widths":<widths.json>, "model_path":"<out>/student/norm-<iter>"}'
+ * `<out>/distill.tsv`: parameters, images/s and mIoU on the held-out ids of the teacher and of the student
+"""
+
+STUDENT = "SEC.py" # model script of the student
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='model', default='SEC.py', help='model script of the teacher (SEC.py or GAIN-SEC.py)')
+    parser.add_option('-r', dest='model_path', default=None, help='checkpoint of the teacher, e.g. sec-saver/norm-104999')
+    parser.add_option('-k', dest='keep', default='0.35', help='fraction of the channels of each layer kept in the student')
+    parser.add_option('-w', dest='widths', default=None, help='widths.json of the student (written by prune.py or distill.py), instead of -k')
+    parser.add_option('-d', dest='weight', default='1.0', help='weight of the distillation loss')
+    parser.add_option('-c', dest='calibration', default='200', help='number of calibration images ranking the channels of the teacher')
+    parser.add_option('-e', dest='epoches', default='4', help='epoches of distillation')
+    parser.add_option('-l', dest='base_lr', default='1e-3', help='learning rate of the distillation')
+    parser.add_option('-o', dest='output', default=None, help='directory of the teacher store and of the student (default: distilled-<model>)')
+    parser.add_option('-i', dest='id_list', default=None, help='file of the held-out ids, one per line (default: the first -n ids of data/held_out.txt, which the trainers leave out)')
+    parser.add_option('-n', dest='num', default='300', help='number of held-out ids (the size of data/held_out.txt when it is drawn)')
+    parser.add_option('-b', dest='batch_size', default='4', help='batch size of the teacher, the scoring and the timing')
+    parser.add_option('-t', dest='iterations', default='10', help='number of timed forward passes')
+    parser.add_option('-j', dest='threads', default='0', help='intra/inter op threads of the sessions (0: one per core)')
+    parser.add_option('-g', dest='gpu_id', default='0', help='specify to run on which GPU, "" for the CPU')
+    parser.add_option('-f', dest='gpu_frac', default='0.45', help='specify the memory utilization of GPU')
+    (options, args) = parser.parse_args()
+    return options
+
+def cache_teacher(module, model_class, path, opt):
+    """Write the `fc8-softmax` of the teacher of each training image to the store `path` (only the rows not written yet)"""
+    if module.PRED_LAYER != "fc8-softmax": raise Exception("the prediction {} cannot be distilled, only fc8-softmax".format(module.PRED_LAYER))
+    batch_size = int(opt.batch_size)
+    data = dataset({"batch_size":batch_size, "input_size":(321,321), "category_num":21, "categorys":["train"]})
+    store = feature_store.create(path, data.data_f["train"]["id"], {"teacher":((41,41,21),"float16")})
+    todo = store.todo()
+    print("teacher store %s: %d images to process" % (path, len(todo)))
+    if len(todo) == 0: return store
+    data.select(todo)
+    with tf.Graph().as_default():
+        model = model_class({"data":data, "input_size":(321,321), "category_num":21})
+        x, _, y, _, id_of_image, iterator = data.next_batch(category="train", batch_size=batch_size, epoches=1)
+        model.build()
+        with session(opt) as sess:
+            model.sess = sess
+            sess.run(tf.global_variables_initializer())
+            model.restore_from_model(tf.train.Saver(var_list=model.trainable_list), opt.model_path, checkpoint=False)
+            sess.run(iterator.initializer)
+            while True:
+                try: data_x, data_y, data_id = sess.run([x, y, id_of_image])
+                except tf.errors.OutOfRangeError: break
+                feed = {model.net["input"]:data_x, model.net["drop_prob"]:1.0}
+                if "label" in model.net: feed[model.net["label"]] = data_y
+                store.write([one.decode("utf-8") for one in data_id], teacher=sess.run(model.net[module.PRED_LAYER], feed_dict=feed))
+    store.flush()
+    return store
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+    module, model_class = load_model(opt.model)
+    student_module, student_class = load_model(STUDENT)
+    output = opt.output if opt.output is not None else "distilled-{}".format(os.path.splitext(os.path.basename(opt.model))[0])
+    store = cache_teacher(module, model_class, os.path.join(output, "teacher"), opt)
+    # the student starts from the channels of the teacher ranked as in prune.py, the full classifier is kept
+    order = layer_order(module)
+    ids = store.ids
+    evaluation = set(held_out(types.SimpleNamespace(data_f={"train":{"id":ids}}), opt))
+    calibration = np.random.RandomState(1).choice([one for one in ids if one not in evaluation], int(opt.calibration), replace=False).tolist()
+    weights, activations = calibrate(module, model_class, order[:-1], calibration, opt)
+    if opt.widths is not None:
+        with open(opt.widths, "r") as f: keep = json.load(f)["widths"]
+    else: keep = float(opt.keep)
+    student, widths = prune(weights, importance(weights, activations, order), keep, order)
+    path = os.path.join(output, "student")
+    miou_init, _ = measure(student_module, student_class, write(path, student_class, student, widths), widths, opt)
+    prefix = finetune(path, widths, opt, script=STUDENT, distill={"store":os.path.join(output, "teacher"), "weight":float(opt.weight)})
+    rows = [("teacher", sum(w.size+b.size for w, b in weights.values()))+measure(module, model_class, opt.model_path, {}, opt)]
+    rows.append(("student", sum(w.size+b.size for w, b in student.values()))+measure(student_module, student_class, prefix, widths, opt))
+    header = ("model", "params(M)", "images/s", "speedup", "mIoU")
+    with open(os.path.join(output, "distill.tsv"), "w") as f:
+        f.write("\t".join(header)+"\n")
+        for name, params, miou, speed in rows: f.write("{}\t{:.3f}\t{:.2f}\t{:.2f}\t{:.4f}\n".format(name, params/1e6, speed, speed/rows[0][3], miou))
+    print("{:>8} {:>10} {:>9} {:>8} {:>7}".format(*header))
+    for name, params, miou, speed in rows: print("{:>8} {:>10.3f} {:>9.2f} {:>7.2f}x {:>7.4f}".format(name, params/1e6, speed, speed/rows[0][3], miou))
+    print("student mIoU {:.4f} before the distillation, {:.4f} after; predict its masks with:".format(miou_init, rows[1][2]))
+    print("python {} -a inference -o '{}'".format(STUDENT, json.dumps({"widths":widths, "model_path":prefix})))
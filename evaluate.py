@@ -0,0 +1,138 @@
+import os
+import re
+import glob
+import json
+import time
+import optparse
+import numpy as np
+import tensorflow as tf
+from dataset import dataset, held_out_ids
+from utils import load_model
+
+"""
+Background validation
+----------------------
+Run next to the training: watch the saver directory for new `norm-<iter>` checkpoints and score each one (mIoU against
+SegmentationClassAug) on a fixed held-out subset of the ids, with its own GPU fraction and thread budget
+     python GAIN-SEC.py -g 0 -f 0.45 &
+     python evaluate.py -m GAIN-SEC.py -g 0 -f 0.1 -j 2
+ * the scores go to the summaries of the training (`[model]-saver/sum`) as `eval/*` at the iteration of the checkpoint
+ * the best checkpoint is kept with `saver["best"]` as `[model]-saver/best-<iter>`
+ * GAIN-GCAM is scored one image per run (`-b` is ignored): its Grad-CAM is normalized over the batch
+ * `[model]-saver/eval.txt` logs `<iter> <mIoU>`, so a restarted evaluator skips the checkpoints already scored
+"""
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='model', default='SEC.py', help='model script')
+    parser.add_option('-s', dest='saver_path', default=None, help='directory of the checkpoints (default: the SAVER_PATH of the model)')
+    parser.add_option('-l', dest='id_list', default=None, help='file of the held-out ids, one per line (default: the first -n ids of data/held_out.txt, which the trainers leave out)')
+    parser.add_option('-n', dest='num', default='300', help='number of held-out ids (the size of data/held_out.txt when it is drawn)')
+    parser.add_option('-b', dest='batch_size', default='4', help='batch size (1 for GAIN-GCAM, whose Grad-CAM depends on the batch)')
+    parser.add_option('-j', dest='threads', default='2', help='intra/inter op threads of the session')
+    parser.add_option('-i', dest='interval', default='60', help='seconds between two scans of the saver directory')
+    parser.add_option('-o', dest='once', action='store_true', default=False, help='score the checkpoints found and exit')
+    parser.add_option('-w', dest='widths', default=None, help='widths.json of a pruned model (prune.py)')
+    parser.add_option('-g', dest='gpu_id', default='0', help='specify to run on which GPU, "" for the CPU')
+    parser.add_option('-f', dest='gpu_frac', default='0.1', help='specify the memory utilization of GPU')
+    (options, args) = parser.parse_args()
+    return options
+
+def confusion(pred, gt, category_num, ignore_label=255):
+    """Confusion matrix [gt,pred] of the label maps `pred` and `gt`, the pixels of `ignore_label` are left out"""
+    valid = gt != ignore_label
+    return np.bincount(category_num*gt[valid].astype(np.int64)+pred[valid], minlength=category_num**2).reshape(category_num, category_num)
+
+def scores(conf):
+    """return: IoU of each class, mIoU (over the classes present in gt or pred) and pixel accuracy"""
+    inter, union = np.diag(conf), conf.sum(axis=0)+conf.sum(axis=1)-np.diag(conf)
+    iou = inter/np.maximum(union, 1)
+    return iou, iou[union > 0].mean(), inter.sum()/max(conf.sum(), 1)
+
+def held_out(data, opt):
+    ids = data.data_f["train"]["id"]
+    if opt.id_list is not None:
+        known = set(ids)
+        with open(opt.id_list, "r") as f: return [line.strip() for line in f if line.strip() in known]
+    return held_out_ids(ids, int(opt.num)) # data/held_out.txt, excluded from the training by the model scripts
+
+def checkpoints(saver_path):
+    """[(iter, prefix)] of the `norm-<iter>` checkpoints, the oldest first"""
+    rst = []
+    for f in glob.glob(os.path.join(saver_path, "norm-*.index")):
+        m = re.match(r"^norm-(\d+)\.index$", os.path.basename(f))
+        if m: rst.append((int(m.group(1)), f[:-len(".index")]))
+    return sorted(rst)
+
+class evaluator():
+    def __init__(self, module, model_class, opt, config={}):
+        self.module, self.opt = module, opt
+        self.saver_path = opt.saver_path if opt.saver_path is not None else module.SAVER_PATH
+        # the Grad-CAM of GAIN-GCAM is normalized over the batch: one image per run, as `inference()`
+        self.batch_size = 1 if module.PRED_LAYER == "gcam" else int(opt.batch_size)
+        self.data = dataset({"batch_size":self.batch_size, "input_size":(321,321), "category_num":21, "categorys":["train"]})
+        self.data.select(held_out(self.data, opt))
+        self.model = model_class(dict({"data":self.data, "input_size":(321,321), "category_num":21}, **config))
+        self.x, self.gt, self.y, _, _, self.iterator = self.data.next_batch(category="train", batch_size=self.batch_size, epoches=1)
+        self.model.build()
+        # the class of each pixel, as in `inference`: softmax of the prediction, zoomed to the input size
+        pred = self.model.net[module.PRED_LAYER]
+        self.mask = tf.argmax(tf.image.resize_bilinear(tf.nn.softmax(pred), (self.model.h, self.model.w)), axis=3)
+        self.model.saver["norm"] = tf.train.Saver(var_list=self.model.trainable_list)
+        self.model.saver["best"] = tf.train.Saver(var_list=self.model.trainable_list, max_to_keep=2)
+        threads = int(opt.threads)
+        self.sess = tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads, gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=float(opt.gpu_frac))))
+        self.model.sess = self.sess
+        self.sess.run(tf.global_variables_initializer())
+        self.writer = tf.summary.FileWriter(os.path.join(self.saver_path, "sum"))
+        self.log = os.path.join(self.saver_path, "eval.txt")
+        self.done = {}
+        if os.path.exists(self.log):
+            with open(self.log, "r") as f:
+                for line in f.readlines():
+                    i, miou = line.split()
+                    self.done[int(i)] = float(miou)
+        print("[eval] {} held-out images, {} checkpoints already scored".format(self.data.get_data_len(), len(self.done)))
+
+    def score(self, prefix):
+        self.model.restore_from_model(self.model.saver["norm"], prefix, checkpoint=False)
+        self.sess.run(self.iterator.initializer)
+        conf = 0
+        while True:
+            try: data_x, data_gt, data_y = self.sess.run([self.x, self.gt, self.y])
+            except tf.errors.OutOfRangeError: break
+            feed = {self.model.net["input"]:data_x, self.model.net["drop_prob"]:1.0}
+            if "label" in self.model.net: feed[self.model.net["label"]] = data_y
+            mask = self.sess.run(self.mask, feed_dict=feed)
+            conf = conf + confusion(mask.reshape(-1), data_gt.reshape(-1), self.model.category_num, self.data.ignore_label)
+        return scores(conf)
+
+    def run(self, i, prefix):
+        start = time.time()
+        iou, miou, acc = self.score(prefix)
+        value = [tf.Summary.Value(tag="eval/mIoU", simple_value=miou), tf.Summary.Value(tag="eval/pixel_acc", simple_value=acc)]
+        value += [tf.Summary.Value(tag="eval/IoU_{:02d}".format(c), simple_value=iou[c]) for c in range(len(iou))]
+        self.writer.add_summary(tf.Summary(value=value), global_step=i)
+        self.writer.flush()
+        if len(self.done) == 0 or miou > max(self.done.values()):
+            self.model.saver["best"].save(self.sess, os.path.join(self.saver_path, "best"), global_step=i)
+            print("[eval] new best checkpoint")
+        self.done[i] = miou
+        with open(self.log, "a") as f: f.write("{} {}\n".format(i, miou))
+        print("[eval] {}: mIoU={:.4f} pixel_acc={:.4f} ({:.1f}s)".format(prefix, miou, acc, time.time()-start))
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+    module, model_class = load_model(opt.model)
+    config = {}
+    if opt.widths is not None:
+        with open(opt.widths, "r") as f: config["widths"] = json.load(f)["widths"]
+    ev = evaluator(module, model_class, opt, config)
+    while True:
+        for i, prefix in checkpoints(ev.saver_path):
+            if i in ev.done: continue
+            try: ev.run(i, prefix)
+            except (tf.errors.NotFoundError, tf.errors.DataLossError): print("[eval] {} is gone or incomplete, skipped".format(prefix)) # rotated by max_to_keep, or being written
+        if opt.once: break
+        time.sleep(float(opt.interval))
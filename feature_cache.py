@@ -0,0 +1,62 @@
+import os
+import json
+import numpy as np
+
+class feature_store():
+    """
+    Memory-mapped store of per-image arrays
+    ------------------------------------------------------------------------
+    One `.npy` file per field, opened with np.memmap so that only the rows that are read are loaded, plus `index.json`
+    holding the image ids (the row order) and the fields. Float features are kept in float16 to halve the size on disk
+    and the IO; the `done` field marks the rows that are written, so that an interrupted job can be resumed.
+    """
+    def __init__(self, path, mode="r"):
+        self.path, self.mode = path, mode
+        with open(os.path.join(path, "index.json"), "r") as f: self.index = json.load(f)
+        self.ids = self.index["ids"]
+        self.row = {one:k for k,one in enumerate(self.ids)}
+        self.fields = {name:np.load(os.path.join(path, "{}.npy".format(name)), mmap_mode=mode) for name in self.index["fields"]}
+
+    @staticmethod
+    def create(path, ids, fields):
+        """fields: {name: (shape of one row, dtype)}; reopen the store if it exists with the same ids and fields"""
+        if os.path.exists(os.path.join(path, "index.json")):
+            store = feature_store(path, mode="r+")
+            if store.ids == list(ids) and sorted(store.index["fields"]) == sorted(list(fields)+["done"]): return store
+            raise Exception("a different feature store already exists in {}".format(path))
+        if not os.path.exists(path): os.makedirs(path)
+        fields = dict(fields, done=((), "uint8"))
+        for name,(shape,dtype) in fields.items():
+            np.lib.format.open_memmap(os.path.join(path, "{}.npy".format(name)), mode="w+", dtype=dtype, shape=tuple([len(ids)]+list(shape))).flush()
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump({"ids":list(ids), "fields":{name:{"shape":list(shape), "dtype":dtype} for name,(shape,dtype) in fields.items()}}, f)
+        return feature_store(path, mode="r+")
+
+    def __getitem__(self, name):
+        return self.fields[name]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def todo(self):
+        """ids of the rows not written yet"""
+        return [one for one,done in zip(self.ids, self.fields["done"]) if not done]
+
+    def write(self, ids, **values):
+        rows = [self.row[one] for one in ids]
+        for name,value in values.items(): self.fields[name][rows] = value
+        self.fields["done"][rows] = 1
+
+    def flush(self):
+        for field in self.fields.values(): field.flush()
+
+    def batches(self, batch_size, seed=0, skip=0, epoches=-1):
+        """Iterate over shuffled batches of rows {field: array}, `skip` drops the first samples (to resume a position)"""
+        per_epoch = len(self.ids)//batch_size*batch_size # the last incomplete batch of an epoch is dropped
+        epoch, position = skip // per_epoch, skip % per_epoch
+        while epoches < 0 or epoch < epoches:
+            order = np.random.RandomState(seed+epoch).permutation(len(self.ids))
+            for start in range(position, per_epoch, batch_size):
+                rows = np.sort(order[start:start+batch_size]) # sorted rows read the memory map sequentially
+                yield {name:field[rows] for name,field in self.fields.items() if name != "done"}
+            epoch, position = epoch+1, 0
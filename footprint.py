@@ -0,0 +1,163 @@
+import os
+import sys
+import math
+import subprocess
+import optparse
+from recompute import split_blocks
+
+"""
+Memory footprint of a model config
+----------------------------------------------
+Walk the layer lists of a model script (`BLOCK_LAYERS`, `FC_LAYERS`) with the shape rules of `build_block`/`build_fc`,
+and sum the memory of the parameters, gradients, optimizer slots, gradient accumulators and of the activations kept
+for backprop (both streams for the GAIN models). It is an estimate: cuDNN workspaces and allocator fragmentation are
+covered by a margin.
+  python footprint.py -m GAIN-SEC.py -b 1 -a 16 -f 0.45
+"""
+
+MARGIN = 0.15 # share of the budget kept for the workspaces and the fragmentation
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='model', default='SEC.py', help='model script')
+    parser.add_option('-b', dest='batch_size', default='1', help='batch size')
+    parser.add_option('-a', dest='accum_num', default='16', help='number of accumulated micro-batches')
+    parser.add_option('-i', dest='input_size', default='321', help='input size')
+    parser.add_option('-c', dest='category_num', default='21', help='number of classes')
+    parser.add_option('-k', dest='am_chunk', default='0', help="GAIN: complement images per attention mining chunk, 0: all at once")
+    parser.add_option('-r', dest='recompute', action='store_true', default=False, help="gradient checkpointing of the VGG16 blocks")
+    parser.add_option('-f', dest='gpu_frac', default=None, help='memory fraction of the GPU, to check that the config fits')
+    parser.add_option('-g', dest='gpu_id', default='0', help='GPU to check against')
+    (options, args) = parser.parse_args()
+    return options
+
+def walk(layer_lists, shape, category_num, stride=1):
+    """
+    shape: (h, w, c) of the input of the layers
+    return: [(layer, output shape, #params)], following the shape rules of `build_block` and `build_fc`
+    """
+    h, w, c = shape
+    rst = []
+    for layer in layer_lists:
+        params = 0
+        if layer.startswith("conv"):
+            out = min(64*stride, 512)
+            params, c = 3*3*c*out+out, out
+        elif layer.startswith("pool") and not layer.startswith("pool5a") and layer[4] not in ["4","5"]:
+            h, w, stride = int(math.ceil(h/2)), int(math.ceil(w/2)), 2*stride
+        elif layer.startswith("fc"):
+            out = category_num if layer == "fc8" else 1024
+            params, c = (3*3 if layer == "fc6" else 1)*c*out+out, out
+        elif layer == "sum": h, w = 1, 1 # GAIN-GCAM: the fc7 maps are summed before fc8
+        elif layer.startswith("batch_norm"): params = 2*c
+        rst.append((layer, (h, w, c), params))
+    return rst
+
+def activations(layers, recompute=False, block_layers=()):
+    """Bytes per image of the activations kept for backprop; with gradient checkpointing only the block outputs are kept, plus the largest block being recomputed"""
+    size = dict((layer, 4*h*w*c) for layer,(h,w,c),_ in layers)
+    if not recompute: return sum(size.values())
+    kept, largest = sum(size.values()), 0
+    for block in split_blocks(list(block_layers)):
+        if recompute is not True and not any(layer in recompute for layer in block): continue
+        inner = sum(size[layer] for layer in block[:-1])
+        kept, largest = kept-inner, max(largest, inner)
+    return kept+largest
+
+def estimate(module, config, batch_size):
+    """
+    module: model script (BLOCK_LAYERS, FC_LAYERS, OPTIMIZER_SLOTS; a GAIN model has the attention mining stream)
+    return: {item: bytes} and the per layer walk
+    """
+    h, w = config.get("input_size", (321,321))
+    category_num, accum_num = config.get("category_num", 21), config.get("accum_num", 1)
+    head = module.FC_LAYERS if "fc8" in module.FC_LAYERS else list(module.FC_LAYERS)+["sum","fc8"]
+    block = walk(module.BLOCK_LAYERS, (h, w, 3), category_num)
+    fc = walk(head, block[-1][1], category_num)
+    layers = block+fc
+    weights = sum(p-shape[2] for _,shape,p in layers if p > 0) # the biases are the last dimension of each layer
+    params = sum(p for _,_,p in layers)
+    trained = params if not config.get("head_only", False) else sum(p for _,_,p in fc)
+    accum_bytes = {"float16":2, "bfloat16":2}.get(config.get("accum_dtype", "float32"), 4)
+    rst = {"params":4*params, "gradients":4*trained, "optimizer":4*trained*getattr(module, "OPTIMIZER_SLOTS", 1)}
+    rst["accumulators"] = 0 if accum_num == 1 else (accum_bytes*weights+4*(params-weights))*trained//params
+    recompute = config.get("recompute", False)
+    if config.get("head_only", False): rst["activations"] = batch_size*activations(fc)
+    else: rst["activations"] = batch_size*activations(layers, recompute, module.BLOCK_LAYERS)
+    rst["workspace"] = 2*batch_size*max(4*s[0]*s[1]*s[2] for _,s,_ in layers) # gradients of two consecutive layers
+    if hasattr(module, "GAIN") and not config.get("head_only", False):
+        n, chunk = batch_size*category_num, config.get("am_chunk", 0)
+        rst["input_c"] = 2*n*4*321*321*3 # complement images and their gradient
+        rst["am_stream"] = (chunk if chunk else n)*activations(walk(module.BLOCK_LAYERS, (321,321,3), category_num)+walk(head, block[-1][1], category_num), recompute, module.BLOCK_LAYERS)
+        if chunk: rst["am_stream"] += 4*trained # gradients summed over the chunks
+    rst["total"] = sum(rst.values())
+    return rst, layers
+
+def gpu_memory(gpu_id=None):
+    """Total memory (bytes) of the GPU, None if nvidia-smi is not available"""
+    gpu_id = gpu_id if gpu_id is not None else os.environ.get("CUDA_VISIBLE_DEVICES", "0").split(",")[0]
+    try: out = subprocess.check_output(["nvidia-smi", "--query-gpu=memory.total", "--format=csv,noheader,nounits", "-i", gpu_id])
+    except (OSError, subprocess.CalledProcessError): return None
+    return int(out.decode("utf-8").split()[0])*2**20
+
+def fit(module, config, batch_size, budget, shrink=True):
+    """
+    Pre-flight check of a training config against `budget` bytes: with `shrink`, turn on gradient checkpointing, then the
+    attention mining chunks (GAIN), then halve the batch size and double accum_num, until the estimate fits
+    return: the config updates and the batch size; raise an Exception if the config does not fit
+    """
+    updates, config = {}, dict(config)
+    steps = [{"recompute":True}] + ([{"am_chunk":config.get("category_num", 21)}, {"am_chunk":1}] if hasattr(module, "GAIN") else [])
+    while True:
+        total = estimate(module, config, batch_size)[0]["total"]
+        if total <= (1-MARGIN)*budget: return updates, batch_size
+        if not shrink: raise Exception("the config needs ~{:.0f}MB, only {:.0f}MB are available".format(total/2**20, (1-MARGIN)*budget/2**20))
+        step = next((one for one in steps if saves(config, one)), None)
+        if step is not None:
+            steps = steps[steps.index(step)+1:]
+            config.update(step)
+            updates.update(step)
+        elif batch_size % 2 == 0:
+            batch_size //= 2
+            config["accum_num"] = 2*config.get("accum_num", 1)
+            updates["accum_num"] = config["accum_num"]
+        else: raise Exception("the config needs ~{:.0f}MB even with batch_size={} and all the memory savings, only {:.0f}MB are available".format(total/2**20, batch_size, (1-MARGIN)*budget/2**20))
+
+def saves(config, step):
+    """Whether a step of `fit` lowers the memory of `config`"""
+    if "recompute" in step: return config.get("recompute", False) is not True
+    return not config.get("am_chunk", 0) or step["am_chunk"] < config["am_chunk"]
+
+def preflight(model, batch_size, gpu_frac):
+    """
+    Called by the trainers before building the graph: fit the config of `model` to gpu_frac of the GPU memory
+    (`model.config["preflight"]`: "off" (default), "check" or "shrink"); return the batch size to use
+    """
+    mode = model.config.get("preflight", "off")
+    budget = gpu_memory() if model.config.get("gpu_memory") is None else model.config["gpu_memory"]*2**20
+    if mode == "off" or budget is None: return batch_size
+    module = sys.modules[type(model).__module__]
+    updates, new_batch_size = fit(module, model.config, batch_size, gpu_frac*budget, shrink=mode == "shrink")
+    if len(updates) > 0 or new_batch_size != batch_size:
+        print("[preflight] the config does not fit in {:.0f}MB: batch_size {} -> {}, {}".format(gpu_frac*budget/2**20, batch_size, new_batch_size, updates))
+        model.config.update(updates)
+        model.accum_num = model.config.get("accum_num", 1)
+    return new_batch_size
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    from utils import load_model
+    module, model_class = load_model(opt.model)
+    config = {"input_size":(int(opt.input_size),)*2, "category_num":int(opt.category_num), "accum_num":int(opt.accum_num), "am_chunk":int(opt.am_chunk), "recompute":opt.recompute}
+    total, layers = estimate(module, config, int(opt.batch_size))
+    print("{:>10} {:>16} {:>12} {:>14}".format("layer", "output", "params(MB)", "act/image(MB)"))
+    for layer, shape, params in layers: print("{:>10} {:>16} {:>12.2f} {:>14.2f}".format(layer, "x".join(map(str, shape)), 4*params/2**20, 4*shape[0]*shape[1]*shape[2]/2**20))
+    for k in sorted(total, key=lambda k: k == "total"): print("{:>12}: {:>10.1f}MB".format(k, total[k]/2**20))
+    if opt.gpu_frac is not None:
+        budget = gpu_memory(opt.gpu_id)
+        if budget is None: print("nvidia-smi is not available, no budget to check against")
+        else:
+            try:
+                updates, batch_size = fit(module, config, int(opt.batch_size), float(opt.gpu_frac)*budget)
+                print("fits in {:.0f}MB with batch_size={} {}".format(float(opt.gpu_frac)*budget/2**20, batch_size, updates))
+            except Exception as e: print(e)
@@ -0,0 +1,138 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import optparse
+import tensorflow as tf
+from tensorflow.python.ops import script_ops
+
+"""
+Graph cache
+----------------------
+The graph of a model (build() and optimize(): the layers, the 21 Grad-CAM gradients, the complement images, the losses
+and the gradient accumulation) is exported once as a MetaGraph, keyed by the code of the scripts, the config and the
+hyperparameters; later launches import it instead of rebuilding it in Python.
+ * the Python handles of the model (`net`, `loss`, `trainable_list`, ...) are saved by tensor/op/variable name
+ * a py_func is a token in a registry of the process: the functions must be methods of an owner (e.g. the model),
+   they are registered again at import and the tokens of the graph are rewritten to the new ones
+     python graph_cache.py -m GAIN-GCAM.py   # cold and warm start times
+"""
+
+PYFUNC_OPS = ["PyFunc", "PyFuncStateless", "EagerPyFunc"]
+# config entries which do not change the graph
+IGNORE = ["data", "resume", "checkpoint_interval", "preflight", "model_path", "feature_cache", "graph_cache", "telemetry_interval", "threads", "saver_path", "decoded_cache", "augment", "thread_profile", "crf_workers", "pred_cache", "pred_cache_size", "sampler"]
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='model', default='GAIN-GCAM.py', help='model script')
+    parser.add_option('-c', dest='path', default='graph-cache', help='directory of the cache')
+    parser.add_option('-g', dest='gpu_id', default='', help='specify to run on which GPU ("": CPU)')
+    (options, args) = parser.parse_args()
+    return options
+
+def encode(obj):
+    if isinstance(obj, tf.Variable): return {"variable":obj.op.name}
+    if isinstance(obj, tf.Tensor): return {"tensor":obj.name}
+    if isinstance(obj, tf.Operation): return {"op":obj.name}
+    if isinstance(obj, dict): return {"dict":{k:encode(v) for k,v in obj.items()}}
+    if isinstance(obj, (list, tuple)): return {"list":[encode(v) for v in obj]}
+    return {"value":obj}
+
+def decode(obj, graph, variables):
+    if "variable" in obj: return variables[obj["variable"]]
+    if "tensor" in obj: return graph.get_tensor_by_name(obj["tensor"])
+    if "op" in obj: return graph.get_operation_by_name(obj["op"])
+    if "dict" in obj: return {k:decode(v, graph, variables) for k,v in obj["dict"].items()}
+    if "list" in obj: return [decode(v, graph, variables) for v in obj["list"]]
+    return obj["value"]
+
+class graph_cache():
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path): os.makedirs(path)
+
+    @staticmethod
+    def key(script, config, **params):
+        """Hash of the code (every .py next to the script), of the config entries that change the graph and of `params`"""
+        h = hashlib.sha1()
+        for f in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(script)), "*.py"))):
+            with open(f, "rb") as src: h.update(src.read())
+        settings = {}
+        for k, v in config.items():
+            if k in IGNORE: continue
+            try: settings[k] = json.loads(json.dumps(v))
+            except TypeError: raise Exception("config[{}] cannot be part of the key of the graph cache".format(k))
+        if "init_model_path" in config: params["init_model"] = os.path.getmtime(config["init_model_path"]) # the initial weights are constants of the graph
+        h.update(json.dumps([os.path.basename(script), settings, params, tf.__version__], sort_keys=True).encode("utf-8"))
+        return h.hexdigest()[:16]
+
+    def save(self, key, model, attrs, owners):
+        """Export the default graph and the handles `attrs` of `model`; owners: {name: object} of the methods run by the py_funcs"""
+        pyfuncs = {}
+        for op in tf.get_default_graph().get_operations():
+            if op.type not in PYFUNC_OPS: continue
+            token = op.get_attr("token")
+            token = token.decode("utf-8") if isinstance(token, bytes) else token
+            func = script_ops._py_funcs._funcs[token]
+            owner = next((name for name, one in owners.items() if getattr(func, "__self__", None) is one), None)
+            if owner is None: raise Exception("the py_func {} is not a method of {}, it cannot be cached".format(func, sorted(owners)))
+            pyfuncs[token] = (owner, func.__name__)
+        tmp = os.path.join(self.path, "{}.tmp".format(key))
+        tf.train.export_meta_graph(filename=tmp+".meta", clear_devices=True)
+        with open(tmp+".json", "w") as f: json.dump({"attrs":{attr:encode(getattr(model, attr)) for attr in attrs}, "pyfuncs":pyfuncs}, f)
+        os.replace(tmp+".meta", os.path.join(self.path, key+".meta"))
+        os.replace(tmp+".json", os.path.join(self.path, key+".json")) # written last: marks a complete entry
+
+    def load(self, key, model, owners):
+        """Import the graph `key` into the default graph and set the handles of `model`; return False if it is not cached"""
+        if not os.path.exists(os.path.join(self.path, key+".json")): return False
+        with open(os.path.join(self.path, key+".json"), "r") as f: manifest = json.load(f)
+        meta = tf.MetaGraphDef()
+        with open(os.path.join(self.path, key+".meta"), "rb") as f: meta.ParseFromString(f.read())
+        graph = tf.get_default_graph()
+        nodes = list(meta.graph_def.node) + [node for function in meta.graph_def.library.function for node in function.node_def]
+        for node in nodes:
+            if node.op not in PYFUNC_OPS: continue
+            owner, method = manifest["pyfuncs"][node.attr["token"].s.decode("utf-8")]
+            func = getattr(owners[owner], method)
+            node.attr["token"].s = script_ops._py_funcs.insert(func).encode("utf-8")
+            # the registry may only hold weak references: the graph keeps the functions alive, as tf.py_func does
+            if hasattr(graph, "_py_funcs_used_in_graph"): graph._py_funcs_used_in_graph.append(func)
+            else: self.funcs = getattr(self, "funcs", []) + [func]
+        tf.train.import_meta_graph(meta, clear_devices=True)
+        variables = {v.op.name:v for v in tf.global_variables()}
+        for attr, value in manifest["attrs"].items(): setattr(model, attr, decode(value, graph, variables))
+        return True
+
+def build_cached(model, script, base_lr, momentum, weight_decay, attrs=("net", "loss", "trainable_list")):
+    """
+    model.build() and model.optimize(), or their graph imported from the cache `model.config["graph_cache"]` (directory)
+    return: "cold" or "warm" and the time it took
+    """
+    start = time.time()
+    cache = graph_cache(model.config["graph_cache"]) if model.config.get("graph_cache") else None
+    key = graph_cache.key(script, model.config, base_lr=base_lr, momentum=momentum, weight_decay=weight_decay) if cache is not None else None
+    if cache is not None and cache.load(key, model, {"model":model}): mode = "warm"
+    else:
+        model.build()
+        model.optimize(base_lr, momentum, weight_decay)
+        if cache is not None: cache.save(key, model, attrs, {"model":model})
+        mode = "cold"
+    print("[graph] {} start in {:.1f}s{}".format(mode, time.time()-start, "" if cache is None else " (cache {})".format(key)))
+    return mode, time.time()-start
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+    import types
+    from dataset import IMG_MEAN
+    from utils import load_model
+    module, model_class = load_model(opt.model)
+    times = {}
+    for _ in range(2): # the first one builds and saves the graph if it is not cached yet
+        tf.reset_default_graph()
+        model = model_class({"data":types.SimpleNamespace(img_mean=IMG_MEAN), "input_size":(321,321), "category_num":21, "accum_num":16, "graph_cache":opt.path})
+        mode, t = build_cached(model, opt.model, 1e-3, 0.9, 5e-5, attrs=getattr(module, "GRAPH_ATTRS", ("net", "loss", "trainable_list")))
+        times[mode] = t
+    print("cold start: {}, warm start: {:.1f}s".format("{:.1f}s".format(times["cold"]) if "cold" in times else "- (already cached)", times["warm"]))
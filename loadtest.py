@@ -0,0 +1,60 @@
+import os
+import glob
+import json
+import time
+import threading
+import optparse
+import urllib.request
+import numpy as np
+
+"""
+Load test of the inference server (serve.py)
+----------------------------------------------
+`-c` clients post the images of `-i` in a loop (each one waits for its answer before the next request) until `-n`
+requests are done, then print the latency percentiles, the throughput and the batching of the server
+     python loadtest.py -u http://127.0.0.1:8000 -i data/VOCdevkit/VOC2012/JPEGImages -c 8 -n 400
+"""
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-u', dest='url', default='http://127.0.0.1:8000', help='address of the server')
+    parser.add_option('-i', dest='images', default=os.path.join("data","VOCdevkit","VOC2012","JPEGImages"), help='directory of the images to post')
+    parser.add_option('-c', dest='clients', default='8', help='number of concurrent clients')
+    parser.add_option('-n', dest='requests', default='200', help='total number of requests')
+    parser.add_option('-w', dest='warmup', default='4', help='requests sent before the measure')
+    (options, args) = parser.parse_args()
+    return options
+
+def post(url, data):
+    start = time.time()
+    with urllib.request.urlopen(urllib.request.Request(url+"/predict", data=data, headers={"Content-Type":"application/octet-stream"})) as r: r.read()
+    return time.time()-start
+
+def stats(url):
+    with urllib.request.urlopen(url+"/stats") as r: return json.loads(r.read().decode("utf-8"))
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    images = []
+    for f in sorted(glob.glob(os.path.join(opt.images, "*.jpg")))[:100]:
+        with open(f, "rb") as img: images.append(img.read())
+    assert len(images) > 0, "no image in {}".format(opt.images)
+    for k in range(int(opt.warmup)): post(opt.url, images[k % len(images)])
+    before = stats(opt.url)
+    latencies, lock, count = [], threading.Lock(), [0]
+    def client():
+        while True:
+            with lock:
+                if count[0] >= int(opt.requests): return
+                k, count[0] = count[0], count[0]+1
+            t = post(opt.url, images[k % len(images)])
+            with lock: latencies.append(t)
+    start = time.time()
+    clients = [threading.Thread(target=client) for _ in range(int(opt.clients))]
+    for one in clients: one.start()
+    for one in clients: one.join()
+    duration, after = time.time()-start, stats(opt.url)
+    batches = max(after["batches"]-before["batches"], 1)
+    print("{} requests, {} clients: {:.1f} images/s".format(len(latencies), opt.clients, len(latencies)/duration))
+    print("latency p50={:.1f}ms p90={:.1f}ms p99={:.1f}ms max={:.1f}ms".format(*[1000*np.percentile(latencies, p) for p in [50, 90, 99, 100]]))
+    print("mean batch size {:.2f}".format((after["requests"]-before["requests"])/batches))
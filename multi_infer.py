@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import optparse
+import concurrent.futures
+from six.moves import cPickle
+import numpy as np
+import scipy.ndimage as nd
+import tensorflow as tf
+from dataset import dataset
+from pred_cache import pred_cache
+from utils import load_model, session_config
+
+"""
+Multi-model inference
+----------------------------------------------
+Predict the masks of several models (e.g. for monitor.ipynb) in one pass: each batch is decoded and preprocessed once
+and given to every model, each model runs in its own graph and session on its own thread, so the wall time is close to
+the one of the slowest model instead of the sum of the `inference()` runs
+     python multi_infer.py -m SEC.py:sec-saver/norm-104999 -m GAIN-SEC.py:gain_sec-saver/norm-104999 -m GAIN-GCAM.py:gain_gcam-saver/norm-104999
+ * a model is `script:checkpoint` or `script:checkpoint:widths.json` (a pruned or distilled model), with `@outdir` the
+   directory of its masks, e.g. `-m SEC.py:sec-saver/norm-104999@sec-a-preds -m SEC.py:runs/b/norm-104999@sec-b-preds`
+ * without `@outdir` the masks of a model are written to the PRED_PATH of its script, as its `inference()` does; two
+   models cannot write to the same directory
+ * with `-d` the prediction cache of `inference()` is shared: each model only predicts the images it has not cached yet
+ * the Grad-CAM of GAIN-GCAM is normalized over the batch: a `gcam` model predicts one image per run, as `inference()`
+"""
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='models', action='append', default=[], help='script:checkpoint[:widths.json][@outdir], once per model')
+    parser.add_option('-b', dest='batch_size', default='4', help='batch size')
+    parser.add_option('-d', dest='pred_cache', default=None, help='directory of the prediction cache')
+    parser.add_option('-c', dest='pred_cache_size', default='1024', help='size of the prediction cache in MB')
+    parser.add_option('-j', dest='threads', default='0', help='intra/inter op threads of the session of each model (0: one per core)')
+    parser.add_option('-g', dest='gpu_id', default='0', help='specify to run on which GPU, "" for the CPU')
+    parser.add_option('-f', dest='gpu_frac', default='0.45', help='memory utilization of GPU, shared by the models')
+    (options, args) = parser.parse_args()
+    return options
+
+def mask_of(pred, eps=1e-5, size=(321,321)):
+    """The mask written by `inference()` from the prediction [h,w,C] of an image"""
+    scores_exp = np.exp(pred-np.max(pred, axis=2, keepdims=True))
+    probs = scores_exp/np.sum(scores_exp, axis=2, keepdims=True)
+    probs = nd.zoom(probs, (size[0]/probs.shape[0], size[1]/probs.shape[1], 1.0), order=1)
+    probs[probs<eps] = eps
+    return np.argmax(probs, axis=2)
+
+class member():
+    """One model of the pass: its graph, its session and the ids it has to predict"""
+    def __init__(self, spec, data, opt, gpu_frac, eps=1e-5):
+        spec, outdir = (spec.split("@", 1)+[None])[:2]
+        script, checkpoint, widths = (spec.split(":")+[None, None])[:3]
+        self.module, model_class = load_model(script)
+        self.name, self.checkpoint, self.eps, self.elapsed = os.path.splitext(os.path.basename(script))[0], checkpoint, eps, 0.0
+        if widths is not None:
+            with open(widths, "r") as f: widths = json.load(f)["widths"]
+        self.pred_path = outdir if outdir is not None else self.module.PRED_PATH
+        if not os.path.exists(self.pred_path): os.makedirs(self.pred_path)
+        # the same keys as `inference()` of the script, so both share the cached masks
+        self.cache = pred_cache(opt.pred_cache, max_mb=int(opt.pred_cache_size)) if opt.pred_cache else None
+        self.todo = set(data.data_f["train"]["id"])
+        if self.cache is not None:
+            model_key = pred_cache.inference_key(self.module.__file__, checkpoint, self.module.PRED_LAYER, eps, [321,321], widths=widths)
+            self.keys = {identy:self.cache.key(f, model_key) for identy, f in zip(data.data_f["train"]["id"], data.data_f["train"]["img"])}
+            self.todo = set(self.cache.materialize(self.keys, self.pred_path))
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.model = model_class({"data":data, "input_size":(321,321), "category_num":21, "widths":widths or {}})
+            self.model.build()
+            self.sess = tf.Session(graph=self.graph, config=session_config({"threads":int(opt.threads)}, gpu_frac))
+            self.model.sess = self.sess
+            self.sess.run(tf.global_variables_initializer())
+            if checkpoint is not None: self.model.restore_from_model(tf.train.Saver(var_list=self.model.trainable_list), checkpoint, checkpoint=False)
+
+    def predict(self, data_x, ids):
+        """Predict and write the masks of the images of the batch that this model has to predict"""
+        rows = [k for k, identy in enumerate(ids) if identy in self.todo]
+        if len(rows) == 0: return
+        start = time.time()
+        # one image per run for the Grad-CAM, its weights are normalized over the batch
+        parts = [[k] for k in rows] if self.module.PRED_LAYER == "gcam" else [rows]
+        preds = np.concatenate([self.sess.run(self.model.net[self.module.PRED_LAYER], feed_dict={self.model.net["input"]:data_x[part], self.model.net["drop_prob"]:0.5}) for part in parts])
+        for k, pred in zip(rows, preds):
+            mask = mask_of(pred, self.eps)
+            cPickle.dump(mask, open(os.path.join(self.pred_path, "{}.pkl".format(ids[k])), "wb"))
+            if self.cache is not None: self.cache.put(self.keys[ids[k]], mask)
+        self.elapsed += time.time()-start
+
+    def close(self):
+        if self.cache is not None: self.cache.finish(self.keys, self.pred_path)
+        self.sess.close()
+
+def run(members, data, batch_size):
+    """Decode each batch of `data` once and give it to every member, each on its own thread"""
+    with tf.Graph().as_default():
+        x, _, _, _, id_of_image, iterator = data.next_batch(category="train", batch_size=batch_size, epoches=1)
+        with tf.Session() as sess, concurrent.futures.ThreadPoolExecutor(max_workers=len(members)) as pool:
+            sess.run(iterator.initializer)
+            pending = []
+            while True:
+                try: data_x, data_id = sess.run([x, id_of_image]) # decoded while the models predict the previous batch
+                except tf.errors.OutOfRangeError: data_x = None
+                for future in pending: future.result()
+                if data_x is None: break
+                ids = [one.decode("utf-8") for one in data_id]
+                pending = [pool.submit(m.predict, data_x, ids) for m in members]
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+    if len(opt.models) == 0: raise Exception("no model given, e.g. -m SEC.py:sec-saver/norm-104999")
+    data = dataset({"input_size":(321,321), "category_num":21, "categorys":["train"]})
+    outdirs = [os.path.normpath(spec.split("@", 1)[1] if "@" in spec else load_model(spec.split(":")[0])[0].PRED_PATH) for spec in opt.models]
+    for path in set(outdirs):
+        if outdirs.count(path) > 1: raise Exception("{} models write their masks to {}, give each one its own directory with @outdir".format(outdirs.count(path), path))
+    members = [member(spec, data, opt, float(opt.gpu_frac)/len(opt.models)) for spec in opt.models]
+    data.select(set().union(*[m.todo for m in members]))
+    print("{} images to predict by {} models".format(data.get_data_len(), len(members)))
+    start = time.time()
+    if data.get_data_len() > 0: run(members, data, int(opt.batch_size))
+    wall = time.time()-start
+    for m in members:
+        m.close()
+        print("[{}] {} masks to {} in {:.1f}s".format(m.name, len(m.todo), m.pred_path, m.elapsed))
+    slowest = max(members, key=lambda m: m.elapsed)
+    print("wall time {:.1f}s, slowest model {} {:.1f}s, sum of the models {:.1f}s".format(wall, slowest.name, slowest.elapsed, sum(m.elapsed for m in members)))
@@ -0,0 +1,190 @@
+import os
+import glob
+import json
+import time
+import optparse
+import numpy as np
+from PIL import Image
+
+"""
+NumPy inference runtime
+----------------------------------------------
+Predict the masks of a trained SEC/GAIN-SEC checkpoint without TensorFlow: `-a export` writes the conv/fc weights to a
+flat float32 file (memory-mapped at load, so a worker starts in milliseconds) with an index of the layers, and the
+runtime runs the DeepLab-LargeFOV forward pass (atrous conv5 and fc6, pool5a, `build_sp_softmax`) with NumPy/BLAS
+     python npinfer.py -a export -m SEC.py -r sec-saver/norm-104999 -o sec-np
+     python npinfer.py -a check -m SEC.py -r sec-saver/norm-104999 -o sec-np    # largest difference to the TF path
+     python npinfer.py -a predict -o sec-np -i data/VOCdevkit/VOC2012/JPEGImages -p sec-np-preds
+ * `<out>/weights.npy`: all the weights and biases, `<out>/index.json`: the layers, the offset and shape of each
+   weight in the flat array, the mean of the images and `min_prob`
+ * the dropout layers are the identity, as in the TF path with drop_prob=1.0 (serve.py, evaluate.py)
+ * the prediction of GAIN-GCAM is a Grad-CAM map, it needs the gradients of the network and cannot be exported
+"""
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-a', dest='action', default='predict', help='export, check or predict')
+    parser.add_option('-m', dest='model', default='SEC.py', help='model script (export, check)')
+    parser.add_option('-r', dest='model_path', default=None, help='checkpoint of the trained model, e.g. sec-saver/norm-104999 (export, check)')
+    parser.add_option('-o', dest='path', default=None, help='directory of the exported model (default: np-<model>)')
+    parser.add_option('-i', dest='images', default=os.path.join("data","VOCdevkit","VOC2012","JPEGImages"), help='directory of the images (check, predict)')
+    parser.add_option('-p', dest='pred_path', default=None, help='directory of the predicted masks, png (default: <path>-preds)')
+    parser.add_option('-n', dest='num', default='8', help='number of images compared to the TF path (check)')
+    parser.add_option('-b', dest='batch_size', default='4', help='batch size')
+    parser.add_option('-g', dest='gpu_id', default='', help='GPU of the TF path ("": CPU)')
+    (options, args) = parser.parse_args()
+    return options
+
+def export(module, model_path, path, min_prob=0.0001, input_size=(321,321)):
+    """Write the weights of the checkpoint `model_path` of the model script `module` to `path`"""
+    import tensorflow as tf
+    from dataset import IMG_MEAN
+    if module.PRED_LAYER != "fc8-softmax": raise Exception("the prediction {} cannot be exported, only fc8-softmax".format(module.PRED_LAYER))
+    layers = module.BLOCK_LAYERS+module.FC_LAYERS
+    reader = tf.train.load_checkpoint(model_path)
+    params, offset, arrays = {}, 0, []
+    for layer in [one for one in layers if one.startswith("conv") or one.startswith("fc")]:
+        params[layer] = {}
+        for k, suffix in [("w","weights"), ("b","bias")]:
+            value = reader.get_tensor("{}_{}".format(layer, suffix)).astype(np.float32)
+            params[layer][k] = [offset, list(value.shape)]
+            arrays.append(value.reshape(-1))
+            offset += value.size
+    if not os.path.exists(path): os.makedirs(path)
+    flat = np.lib.format.open_memmap(os.path.join(path, "weights.npy"), mode="w+", dtype=np.float32, shape=(offset,))
+    flat[:] = np.concatenate(arrays)
+    flat.flush()
+    index = {"model":os.path.basename(module.__file__), "checkpoint":model_path, "layers":layers+[module.PRED_LAYER], "params":params, "min_prob":min_prob, "img_mean":[float(v) for v in IMG_MEAN], "input_size":list(input_size)}
+    with open(os.path.join(path, "index.json"), "w") as f: json.dump(index, f, indent=1)
+    return index
+
+def conv(x, w, b, rate=1):
+    """conv2d / atrous_conv2d with SAME padding and stride 1: one GEMM per offset of the kernel"""
+    kh, kw, c, o = w.shape
+    ph, pw = rate*(kh-1)//2, rate*(kw-1)//2
+    n, h, wd, _ = x.shape
+    xp = np.pad(x, ((0,0),(ph,ph),(pw,pw),(0,0)), mode="constant") if ph+pw > 0 else x
+    out = np.empty((n*h*wd, o), dtype=np.float32)
+    out[:] = b
+    for i in range(kh):
+        for j in range(kw):
+            out += np.dot(xp[:,i*rate:i*rate+h,j*rate:j*rate+wd,:].reshape(-1, c), w[i,j])
+    return out.reshape(n, h, wd, o)
+
+def pool(x, stride, op="max", k=3):
+    """max_pool / avg_pool with SAME padding as in TF: the padding is not counted in the average"""
+    n, h, w, c = x.shape
+    oh, ow = -(-h//stride), -(-w//stride)
+    ph, pw = max((oh-1)*stride+k-h, 0), max((ow-1)*stride+k-w, 0)
+    pad = ((0,0),(ph//2,ph-ph//2),(pw//2,pw-pw//2),(0,0))
+    window = lambda xp, i, j: xp[:,i:i+stride*(oh-1)+1:stride,j:j+stride*(ow-1)+1:stride,:]
+    if op == "max":
+        xp = np.pad(x, pad, mode="constant", constant_values=-np.inf)
+        out = window(xp, 0, 0).copy()
+        for i in range(k):
+            for j in range(k): np.maximum(out, window(xp, i, j), out=out)
+        return out
+    xp, ones = np.pad(x, pad, mode="constant"), np.pad(np.ones((1,h,w,1), dtype=np.float32), pad, mode="constant")
+    total, count = np.zeros((n,oh,ow,c), dtype=np.float32), np.zeros((1,oh,ow,1), dtype=np.float32)
+    for i in range(k):
+        for j in range(k):
+            total += window(xp, i, j)
+            count += window(ones, i, j)
+    return total/count
+
+def resize_bilinear(x, size):
+    """tf.image.resize_bilinear (align_corners=False) of a batch [N,h,w,C]"""
+    n, h, w, c = x.shape
+    def axis(out, size):
+        src = np.arange(out)*size/out
+        low = np.floor(src).astype(np.int64)
+        return low, np.minimum(low+1, size-1), (src-low).astype(np.float32)
+    (y0, y1, fy), (x0, x1, fx) = axis(size[0], h), axis(size[1], w)
+    top = x[:,y0][:,:,x0]*(1-fx)[None,None,:,None]+x[:,y0][:,:,x1]*fx[None,None,:,None]
+    bottom = x[:,y1][:,:,x0]*(1-fx)[None,None,:,None]+x[:,y1][:,:,x1]*fx[None,None,:,None]
+    return top*(1-fy)[None,:,None,None]+bottom*fy[None,:,None,None]
+
+class runtime():
+    """The exported model, its weights memory-mapped (read on first use and shared with the other processes through the page cache)"""
+    def __init__(self, path):
+        with open(os.path.join(path, "index.json"), "r") as f: self.index = json.load(f)
+        flat = np.load(os.path.join(path, "weights.npy"), mmap_mode="r")
+        view = lambda offset, shape: flat[offset:offset+int(np.prod(shape))].reshape(shape)
+        self.params = {layer:(view(*p["w"]), view(*p["b"])) for layer, p in self.index["params"].items()}
+        self.img_mean = np.array(self.index["img_mean"], dtype=np.float32)
+        self.h, self.w = self.index["input_size"]
+
+    def forward(self, x):
+        """`fc8-softmax` of a batch of preprocessed images [N,h,w,3] (BGR, mean subtracted)"""
+        x = x.astype(np.float32)
+        for layer in self.index["layers"]:
+            if layer.startswith("conv"): x = conv(x, *self.params[layer], rate=2 if layer[4] == "5" else 1)
+            elif layer.startswith("fc8-softmax"):
+                e = np.exp(x-np.max(x, axis=3, keepdims=True))
+                x = e/np.sum(e, axis=3, keepdims=True)+self.index["min_prob"]
+                x = x/np.sum(x, axis=3, keepdims=True)
+            elif layer.startswith("fc"): x = conv(x, *self.params[layer], rate=12 if layer == "fc6" else 1)
+            elif layer.startswith("relu"): x = np.maximum(x, 0)
+            elif layer.startswith("pool5a"): x = pool(x, 1, op="avg")
+            elif layer.startswith("pool"): x = pool(x, 1 if layer[4] in ["4","5"] else 2)
+            elif layer.startswith("drop"): continue
+            else: raise Exception("Unimplemented layer: {}".format(layer))
+        return x
+
+    def preprocess(self, f):
+        """Image file -> input of the model, size of the image (as serve.py)"""
+        img = Image.open(f).convert("RGB")
+        return np.asarray(img.resize((self.w, self.h), Image.BILINEAR), dtype=np.float32)[:,:,::-1]-self.img_mean, img.size
+
+    def predict(self, x):
+        """uint8 masks [N,h,w] at the input size"""
+        return np.argmax(resize_bilinear(self.forward(x), (self.h, self.w)), axis=3).astype(np.uint8)
+
+def check(module, model_class, model_path, path, files, batch_size):
+    """Largest difference between the `fc8-softmax` of the TF path and of the runtime, share of equal mask pixels"""
+    import types
+    import tensorflow as tf
+    rt = runtime(path)
+    widths = {layer:p["w"][1][-1] for layer, p in rt.index["params"].items() if layer != "fc8"} # a pruned model has its own widths
+    model = model_class({"data":types.SimpleNamespace(img_mean=rt.img_mean), "input_size":(rt.h, rt.w), "category_num":21, "widths":widths})
+    model.build()
+    with tf.Session() as sess:
+        model.sess = sess
+        sess.run(tf.global_variables_initializer())
+        model.restore_from_model(tf.train.Saver(var_list=model.trainable_list), model_path, checkpoint=False)
+        diff, same, total = 0.0, 0, 0
+        for k in range(0, len(files), batch_size):
+            x = np.stack([rt.preprocess(f)[0] for f in files[k:k+batch_size]])
+            feed = {model.net["input"]:x, model.net["drop_prob"]:1.0}
+            if "label" in model.net: feed[model.net["label"]] = np.ones((len(x),21), dtype=np.int32)
+            ref, out = sess.run(model.net[module.PRED_LAYER], feed_dict=feed), rt.forward(x)
+            diff = max(diff, float(np.max(np.abs(ref-out))))
+            same, total = same+int(np.sum(np.argmax(ref, axis=3) == np.argmax(out, axis=3))), total+ref[...,0].size
+    return diff, same/max(total, 1)
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+    path = opt.path if opt.path is not None else "np-{}".format(os.path.splitext(os.path.basename(opt.model))[0])
+    files = sorted(glob.glob(os.path.join(opt.images, "*.jpg")))
+    if opt.action in ["export", "check"]:
+        from utils import load_model
+        module, model_class = load_model(opt.model)
+    if opt.action == "export":
+        index = export(module, opt.model_path, path)
+        print("exported {} layers of {} to {}".format(len(index["params"]), opt.model_path, path))
+    elif opt.action == "check":
+        diff, same = check(module, model_class, opt.model_path, path, files[:int(opt.num)], int(opt.batch_size))
+        print("max |tf - numpy| of {}: {:.2e}, same class on {:.4%} of the pixels".format(module.PRED_LAYER, diff, same))
+    elif opt.action == "predict":
+        start = time.time()
+        rt = runtime(path)
+        print("loaded {} in {:.1f}ms".format(path, 1000*(time.time()-start)))
+        pred_path = opt.pred_path if opt.pred_path is not None else path+"-preds"
+        if not os.path.exists(pred_path): os.makedirs(pred_path)
+        batch_size = int(opt.batch_size)
+        for k in range(0, len(files), batch_size):
+            inputs = [rt.preprocess(f) for f in files[k:k+batch_size]]
+            for f, (_, size), mask in zip(files[k:k+batch_size], inputs, rt.predict(np.stack([x for x, _ in inputs]))):
+                Image.fromarray(mask).resize(size, Image.NEAREST).save(os.path.join(pred_path, os.path.splitext(os.path.basename(f))[0]+".png"))
+        print("{} masks written to {} in {:.1f}s".format(len(files), pred_path, time.time()-start))
@@ -0,0 +1,115 @@
+import os
+import glob
+import json
+import pickle
+import hashlib
+import numpy as np
+
+class pred_cache():
+    """
+    Content-addressed cache of the predicted masks
+    ------------------------------------------------------------------------
+    The key of a mask is the sha1 of the bytes of the image and of the model key (checkpoint files, model script and
+    inference config), so a new checkpoint or a changed image only misses its own entries. An entry is
+    `<path>/<key[:2]>/<key>.npy` (uint8 mask); the least recently used entries are removed when the cache is larger
+    than `max_mb`. `PRED_PATH/cache_keys.json` records the key each prediction file was written from, so the files
+    which are still valid are left as they are.
+    """
+    def __init__(self, path, max_mb=1024):
+        self.path, self.max_bytes = path, max_mb*2**20
+        self.hits, self.misses, self.written, self.evicted = 0, 0, 0, 0
+        self.stored = set() # the keys `put` by this run
+        if not os.path.exists(path): os.makedirs(path)
+
+    @staticmethod
+    def model_key(script, checkpoint, **config):
+        """Hash of the files of the checkpoint, of the model script and of the inference `config`"""
+        h = hashlib.sha1()
+        for f in sorted(glob.glob(checkpoint+".*")) if checkpoint else []:
+            with open(f, "rb") as src:
+                for chunk in iter(lambda: src.read(1<<20), b""): h.update(chunk)
+        with open(script, "rb") as src: h.update(src.read())
+        h.update(json.dumps(config, sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    @staticmethod
+    def inference_key(script, checkpoint, pred_layer, eps, input_size, widths=None, tta=None):
+        """The model key of the masks of `inference()` of a model script, shared by multi_infer.py"""
+        config = {"pred_layer":pred_layer, "eps":eps, "input_size":list(input_size), "widths":widths or {}}
+        if tta: config["tta"] = dict(tta, keep_prob=1.0) # the views are predicted without dropout
+        return pred_cache.model_key(script, checkpoint, **config)
+
+    def key(self, image_file, model_key):
+        h = hashlib.sha1(model_key.encode("utf-8"))
+        with open(image_file, "rb") as f: h.update(f.read())
+        return h.hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.path, key[:2], key+".npy")
+
+    def get(self, key):
+        """The cached mask of `key` (and mark it as recently used), None if it is not cached"""
+        try: mask = np.load(self.entry(key))
+        except (IOError, ValueError): return None
+        os.utime(self.entry(key))
+        return mask
+
+    def put(self, key, mask):
+        if not os.path.exists(os.path.dirname(self.entry(key))): os.makedirs(os.path.dirname(self.entry(key)))
+        tmp = self.entry(key)+".tmp"
+        with open(tmp, "wb") as f: np.save(f, mask.astype(np.uint8))
+        os.replace(tmp, self.entry(key))
+        self.written += 1
+        self.stored.add(key)
+
+    def materialize(self, keys, pred_path):
+        """
+        Write the cached masks of `keys` ({id: key}) to `pred_path` as `<id>.pkl`, except the files already written from
+        the same key; return the ids to predict
+        """
+        manifest = self.manifest(pred_path)
+        misses = []
+        for identy, key in keys.items():
+            pred = os.path.join(pred_path, "{}.pkl".format(identy))
+            if manifest.get(identy) == key and os.path.exists(pred) and os.path.exists(self.entry(key)):
+                os.utime(self.entry(key))
+                self.hits += 1
+                continue
+            mask = self.get(key)
+            if mask is None:
+                misses.append(identy)
+                self.misses += 1
+                continue
+            with open(pred, "wb") as f: pickle.dump(mask.astype(np.int64), f)
+            manifest[identy] = key
+            self.hits += 1
+        self.save_manifest(pred_path, manifest)
+        return misses
+
+    def manifest(self, pred_path):
+        if not os.path.exists(os.path.join(pred_path, "cache_keys.json")): return {}
+        with open(os.path.join(pred_path, "cache_keys.json"), "r") as f: return json.load(f)
+
+    def save_manifest(self, pred_path, manifest):
+        with open(os.path.join(pred_path, "cache_keys.json.tmp"), "w") as f: json.dump(manifest, f)
+        os.replace(os.path.join(pred_path, "cache_keys.json.tmp"), os.path.join(pred_path, "cache_keys.json"))
+
+    def finish(self, keys, pred_path):
+        """
+        Record the keys of `keys` ({id: key}) whose prediction was written by the run (`put` after its `<id>.pkl`), evict
+        the least recently used entries, print the report; the ids of an interrupted run that were not predicted keep
+        their former key, if any, so they are predicted again
+        """
+        written = set(f for f in os.listdir(pred_path) if f.endswith(".pkl"))
+        self.save_manifest(pred_path, dict(self.manifest(pred_path), **{identy:key for identy, key in keys.items() if key in self.stored and identy+".pkl" in written}))
+        entries = sorted([(os.path.getmtime(f), os.path.getsize(f), f) for f in glob.glob(os.path.join(self.path, "*", "*.npy"))])
+        total = sum(size for _, size, _ in entries)
+        for _, size, f in entries:
+            if total <= self.max_bytes: break
+            os.remove(f)
+            total, self.evicted = total-size, self.evicted+1
+        print(self.report(total))
+
+    def report(self, total=None):
+        lookups = max(self.hits+self.misses, 1)
+        return "[pred cache] {} hits, {} misses ({:.1%} hit rate), {} written, {} evicted{}".format(self.hits, self.misses, self.hits/lookups, self.written, self.evicted, "" if total is None else ", {:.1f}MB in {}".format(total/2**20, self.path))
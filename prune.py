@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import time
+import types
+import subprocess
+import optparse
+import numpy as np
+import tensorflow as tf
+from dataset import dataset, IMG_MEAN
+from evaluate import evaluator, held_out, checkpoints
+from utils import load_model
+
+"""
+Structured channel pruning
+----------------------------------------------
+Rank the output channels of the conv layers and of fc6/fc7 of a trained model on a calibration set, keep the best `-k`
+fraction of each layer, fine-tune the slimmer model briefly with its own losses, and report accuracy against speed
+     python prune.py -m SEC.py -r sec-saver/norm-104999 -k 0.75,0.5,0.35 -e 1
+ * importance of a channel: its mean activation (after the ReLU) on the calibration images times the L2 norm of its
+   weights in the next layer
+ * `<out>/keep-<k>/`: `norm-0` (pruned), `norm-<iter>` (fine-tuned) and `widths.json`, the output width of each
+   layer; the model scripts, evaluate.py and serve.py build the pruned model from it (`-o '{"widths":...}'`, `-w`)
+ * `<out>/curve.tsv`: parameters, images/s and mIoU on the held-out ids of each operating point, the full model first
+"""
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='model', default='SEC.py', help='model script')
+    parser.add_option('-r', dest='model_path', default=None, help='checkpoint of the trained model, e.g. sec-saver/norm-104999')
+    parser.add_option('-k', dest='keep', default='0.75,0.5,0.35,0.25', help='fractions of the channels to keep, one operating point each')
+    parser.add_option('-p', dest='layers', default=None, help='layers to prune, e.g. conv5_1,conv5_2,fc6,fc7 (default: every conv layer, fc6 and fc7)')
+    parser.add_option('-c', dest='calibration', default='200', help='number of calibration images (not in the held-out ids)')
+    parser.add_option('-e', dest='epoches', default='1', help='epoches of fine-tuning of each pruned model (0: none)')
+    parser.add_option('-l', dest='base_lr', default='1e-4', help='learning rate of the fine-tuning')
+    parser.add_option('-o', dest='output', default=None, help='directory of the pruned models (default: pruned-<model>)')
+    parser.add_option('-i', dest='id_list', default=None, help='file of the held-out ids, one per line (default: the first -n ids of data/held_out.txt, which the trainers leave out)')
+    parser.add_option('-n', dest='num', default='300', help='number of held-out ids (the size of data/held_out.txt when it is drawn)')
+    parser.add_option('-b', dest='batch_size', default='4', help='batch size of the calibration, the scoring and the timing (GAIN-GCAM is scored one image per run)')
+    parser.add_option('-t', dest='iterations', default='10', help='number of timed forward passes')
+    parser.add_option('-j', dest='threads', default='0', help='intra/inter op threads of the sessions (0: one per core)')
+    parser.add_option('-g', dest='gpu_id', default='0', help='specify to run on which GPU, "" for the CPU')
+    parser.add_option('-f', dest='gpu_frac', default='0.45', help='specify the memory utilization of GPU')
+    (options, args) = parser.parse_args()
+    return options
+
+def layer_order(module):
+    """The conv/fc layers of the model, in order, and the classifier last"""
+    order = [layer for layer in module.BLOCK_LAYERS+module.FC_LAYERS if layer.startswith("conv") or layer.startswith("fc")]
+    return order if "fc8" in order else order+["fc8"]
+
+def relu_of(layer):
+    return "relu"+layer[4:] if layer.startswith("conv") else "relu"+layer[2:]
+
+def session(opt):
+    threads = int(opt.threads)
+    return tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads, gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=float(opt.gpu_frac))))
+
+def calibrate(module, model_class, layers, ids, opt):
+    """Weights {layer:(w,b)} of the checkpoint and mean activation of each output channel of `layers` on the images `ids`"""
+    batch_size = int(opt.batch_size)
+    with tf.Graph().as_default():
+        data = dataset({"batch_size":batch_size, "input_size":(321,321), "category_num":21, "categorys":["train"]})
+        data.select(ids)
+        model = model_class({"data":data, "input_size":(321,321), "category_num":21})
+        x, _, y, _, _, iterator = data.next_batch(category="train", batch_size=batch_size, epoches=1)
+        model.build()
+        means = {layer:tf.reduce_mean(model.net[relu_of(layer)], axis=[0,1,2]) for layer in layers}
+        with session(opt) as sess:
+            model.sess = sess
+            sess.run(tf.global_variables_initializer())
+            model.restore_from_model(tf.train.Saver(var_list=model.trainable_list), opt.model_path, checkpoint=False)
+            weights = sess.run(model.weights)
+            sess.run(iterator.initializer)
+            total, n = {layer:0 for layer in layers}, 0
+            while True:
+                try: data_x, data_y = sess.run([x, y])
+                except tf.errors.OutOfRangeError: break
+                feed = {model.net["input"]:data_x, model.net["drop_prob"]:1.0}
+                if "label" in model.net: feed[model.net["label"]] = data_y
+                for layer, value in sess.run(means, feed_dict=feed).items(): total[layer] = total[layer]+value*len(data_x)
+                n += len(data_x)
+    return weights, {layer:total[layer]/n for layer in layers}
+
+def importance(weights, activations, order):
+    """Score of each output channel of the layers of `activations`"""
+    rst = {}
+    for layer, mean in activations.items():
+        w = weights[order[order.index(layer)+1]][0]
+        rst[layer] = mean*np.sqrt(np.sum(np.square(np.moveaxis(w, -2, 0).reshape(w.shape[-2], -1)), axis=1))
+    return rst
+
+def prune(weights, scores, keep, order):
+    """
+    Keep the `keep` best channels of each layer of `scores` (a fraction, or {layer: width}): the output channels of the
+    layer and the input channels of the next one
+    """
+    pruned, widths = {layer:list(wb) for layer, wb in weights.items()}, {}
+    for layer, score in scores.items():
+        kept = np.sort(np.argsort(-score)[:keep.get(layer, len(score)) if isinstance(keep, dict) else max(1, int(round(keep*len(score))))])
+        widths[layer] = len(kept)
+        pruned[layer] = [pruned[layer][0][...,kept], pruned[layer][1][kept]]
+        following = order[order.index(layer)+1]
+        pruned[following][0] = np.take(pruned[following][0], kept, axis=-2)
+    return pruned, widths
+
+def write(path, model_class, weights, widths):
+    """Checkpoint `<path>/norm-0` of the pruned model, with the variable names of the model scripts"""
+    if not os.path.exists(path): os.makedirs(path)
+    with tf.Graph().as_default():
+        model = model_class({"data":types.SimpleNamespace(img_mean=IMG_MEAN), "input_size":(321,321), "category_num":21, "widths":widths})
+        model.build()
+        with tf.Session() as sess:
+            model.sess = sess
+            sess.run(tf.global_variables_initializer())
+            for layer, (w, b) in model.weights.items():
+                w.load(weights[layer][0], sess)
+                b.load(weights[layer][1], sess)
+            tf.train.Saver(var_list=model.trainable_list).save(sess, os.path.join(path, "norm"), global_step=0)
+    with open(os.path.join(path, "widths.json"), "w") as f: json.dump({"widths":widths}, f, indent=1, sort_keys=True)
+    return os.path.join(path, "norm-0")
+
+def finetune(path, widths, opt, script=None, **overrides):
+    """Train the pruned model for `-e` epoches with the trainer of `script` (default: the model script), return its last checkpoint"""
+    done = [prefix for i, prefix in checkpoints(path) if i > 0]
+    if len(done) > 0: return done[-1]
+    overrides = dict({"widths":widths, "model_path":os.path.join(path, "norm-0"), "saver_path":path, "epoches":float(opt.epoches), "base_lr":float(opt.base_lr)}, **overrides)
+    cmd = [sys.executable, script if script is not None else opt.model, "-g", opt.gpu_id, "-f", opt.gpu_frac, "-o", json.dumps(overrides)]
+    with open(os.path.join(path, "finetune.txt"), "w") as log: subprocess.check_call(cmd, stdout=log, stderr=subprocess.STDOUT)
+    return [prefix for i, prefix in checkpoints(path) if i > 0][-1]
+
+def measure(module, model_class, prefix, widths, opt):
+    """mIoU on the held-out ids (scored as evaluate.py, one image per run for GAIN-GCAM) and images/s of the forward pass at `-b` of the checkpoint `prefix`"""
+    batch_size = int(opt.batch_size)
+    with tf.Graph().as_default():
+        ev = evaluator(module, model_class, types.SimpleNamespace(saver_path=os.path.dirname(prefix), id_list=opt.id_list, num=opt.num, batch_size=opt.batch_size, threads=opt.threads, gpu_frac=opt.gpu_frac), {"widths":widths})
+        _, miou, _ = ev.score(prefix) # at ev.batch_size: 1 for the Grad-CAM, which is normalized over the batch
+        feed = {ev.model.net["input"]:np.random.uniform(-128, 128, (batch_size,321,321,3)), ev.model.net["drop_prob"]:1.0}
+        if "label" in ev.model.net: feed[ev.model.net["label"]] = np.ones((batch_size,21), dtype=np.int32)
+        ev.sess.run(ev.mask, feed_dict=feed) # warm up
+        times = []
+        for _ in range(int(opt.iterations)):
+            start = time.time()
+            ev.sess.run(ev.mask, feed_dict=feed)
+            times.append(time.time()-start)
+        ev.sess.close()
+    return miou, batch_size/np.median(times)
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+    module, model_class = load_model(opt.model)
+    output = opt.output if opt.output is not None else "pruned-{}".format(os.path.splitext(os.path.basename(opt.model))[0])
+    order = layer_order(module)
+    layers = opt.layers.split(",") if opt.layers is not None else order[:-1]
+    ids = dataset({"input_size":(321,321), "category_num":21, "categorys":["train"]}).data_f["train"]["id"]
+    evaluation = set(held_out(types.SimpleNamespace(data_f={"train":{"id":ids}}), opt))
+    calibration = np.random.RandomState(1).choice([one for one in ids if one not in evaluation], int(opt.calibration), replace=False).tolist()
+    weights, activations = calibrate(module, model_class, layers, calibration, opt)
+    scores = importance(weights, activations, order)
+    miou, speed = measure(module, model_class, opt.model_path, {}, opt)
+    rows = [(1.0, sum(w.size+b.size for w, b in weights.values()), speed, miou, miou)]
+    for keep in [float(k) for k in opt.keep.split(",")]:
+        pruned, widths = prune(weights, scores, keep, order)
+        path = os.path.join(output, "keep-{:.2f}".format(keep))
+        prefix = write(path, model_class, pruned, widths)
+        miou_pruned, speed = measure(module, model_class, prefix, widths, opt)
+        miou = measure(module, model_class, finetune(path, widths, opt), widths, opt)[0] if float(opt.epoches) > 0 else miou_pruned
+        rows.append((keep, sum(w.size+b.size for w, b in pruned.values()), speed, miou_pruned, miou))
+        print("[prune] keep {:.2f}: {:.1f} images/s, mIoU {:.4f} -> {:.4f} after fine-tuning".format(keep, speed, miou_pruned, miou))
+    header = ("keep", "params(M)", "images/s", "speedup", "mIoU_pruned", "mIoU")
+    with open(os.path.join(output, "curve.tsv"), "w") as f:
+        f.write("\t".join(header)+"\n")
+        for keep, params, speed, miou_pruned, miou in rows: f.write("{}\t{:.3f}\t{:.2f}\t{:.3f}\t{:.4f}\t{:.4f}\n".format(keep, params/1e6, speed, speed/rows[0][2], miou_pruned, miou))
+    print("{:>6} {:>10} {:>9} {:>8} {:>12} {:>7}".format(*header))
+    for keep, params, speed, miou_pruned, miou in rows: print("{:>6.2f} {:>10.3f} {:>9.2f} {:>7.2f}x {:>12.4f} {:>7.4f}".format(keep, params/1e6, speed, speed/rows[0][2], miou_pruned, miou))
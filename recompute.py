@@ -0,0 +1,35 @@
+import re
+import tensorflow as tf
+
+def split_blocks(layer_lists):
+    """Split a list of layers into blocks ending with a pooling layer (`pool1`...`pool5`), trailing layers join the last block"""
+    blocks, block = [], []
+    for layer in layer_lists:
+        block.append(layer)
+        if re.match(r"^pool\d$", layer): blocks, block = blocks+[block], []
+    if len(block) > 0:
+        if len(blocks) > 0: blocks[-1] += block
+        else: blocks.append(block)
+    return blocks
+
+def block_name(block):
+    """A block is named after its first pooling layer, e.g. `pool3`"""
+    return next((layer for layer in block if layer.startswith("pool")), block[-1])
+
+def recompute_grad(y, x, params, rebuild):
+    """
+    Gradient checkpointing of a sub-graph
+    ---------------------------------------------
+    y: output of the sub-graph built from the input `x` with the weights `params`
+    rebuild: function() -> y', building the same sub-graph again from `x` and `params`
+    return: a tensor equal to `y`, whose gradients w.r.t. `x` and `params` are computed on a copy of the sub-graph
+            rebuilt in the backward pass, so the activations inside the sub-graph are freed after the forward pass
+    """
+    @tf.custom_gradient
+    def checkpoint(x, *params):
+        def grad(dy):
+            # the control dependency keeps the recomputation from being scheduled before the backward pass reaches it
+            with tf.control_dependencies([dy]): y_ = rebuild()
+            return tf.gradients(y_, [x]+list(params), grad_ys=dy)
+        return tf.identity(y), grad
+    return checkpoint(x, *params)
@@ -0,0 +1,123 @@
+import os
+import glob
+import time
+import hashlib
+import optparse
+import multiprocessing
+from six.moves import cPickle
+import numpy as np
+from PIL import Image, ImageDraw
+
+"""
+Comparison report
+----------------------------------------------
+The mosaics of monitor.ipynb (image | one mask per prediction directory | gt) for every image predicted by all the
+models, rendered by a pool of processes into paginated HTML and/or PNG sheets
+     python report.py -p sec-preds,gain_sec-preds -j 8 -o report    # then open report/index.html
+ * the ids come from one listing of each prediction directory, no per-image lookups
+ * the tiles are cached in `<out>/thumbs`, keyed by the file, its mtime and the tile size: a new run only renders
+   the masks that changed, e.g. after a new `inference()`
+ * the JPEG is decoded at a reduced scale (`Image.draft`), the masks and the gt are resized with nearest neighbour
+"""
+
+# colors of the classes, as the colormap of monitor.ipynb; the ignore label is white
+PALETTE = np.array([(0.0, 0.0, 0.0), (0.5, 0.0, 0.0), (0.0, 0.5, 0.0), (0.5, 0.5, 0.0), (0.0, 0.0, 0.5), (0.5, 0.0, 0.5), (0.0, 0.5, 0.5), (0.5, 0.5, 0.5), (0.25, 0.0, 0.0), (0.75, 0.0, 0.0), (0.25, 0.5, 0.0), (0.75, 0.5, 0.0),
+                    (0.25, 0.0, 0.5), (0.75, 0.0, 0.5), (0.25, 0.5, 0.5), (0.75, 0.5, 0.5), (0.0, 0.25, 0.0), (0.5, 0.25, 0.0), (0.0, 0.75, 0.0), (0.5, 0.75, 0.0), (0.0, 0.25, 0.5)]+[(1.0, 1.0, 1.0)]*235)
+PALETTE = (PALETTE*255).astype(np.uint8)
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-p', dest='preds', default=None, help='prediction directories, comma separated (default: every *-preds directory)')
+    parser.add_option('-d', dest='main_path', default=os.path.join("data","VOCdevkit","VOC2012"), help='VOC2012 directory (JPEGImages, SegmentationClassAug)')
+    parser.add_option('-o', dest='output', default='report', help='directory of the report')
+    parser.add_option('-f', dest='format', default='html', help='html, png or both')
+    parser.add_option('-s', dest='size', default='160', help='side of a tile in pixels')
+    parser.add_option('-r', dest='rows', default='50', help='images per page')
+    parser.add_option('-l', dest='id_list', default=None, help='file of the ids to show, one per line (default: every id predicted by all the models)')
+    parser.add_option('-n', dest='num', default='0', help='show only the first n ids (0: all)')
+    parser.add_option('-j', dest='workers', default=str(os.cpu_count()), help='rendering processes')
+    (options, args) = parser.parse_args()
+    return options
+
+def tile(src, kind, size, thumbs):
+    """Name of the cached tile of the file `src` (image, mask or gt) in `thumbs`, rendered if needed; return (name, rendered)"""
+    stat = os.stat(src)
+    name = hashlib.sha1("{}:{}:{}:{}".format(os.path.abspath(src), stat.st_mtime, stat.st_size, size).encode("utf-8")).hexdigest()+".png"
+    if os.path.exists(os.path.join(thumbs, name)): return name, False
+    if kind == "image":
+        img = Image.open(src)
+        img.draft("RGB", (size, size)) # the JPEG is decoded at 1/2, 1/4 or 1/8 of its size when it is large enough
+        img = img.convert("RGB").resize((size, size), Image.BILINEAR)
+    else:
+        if kind == "mask":
+            with open(src, "rb") as f: label = cPickle.load(f)
+        else: label = np.asarray(Image.open(src)) # the label png of the gt, 255: ignored
+        img = Image.fromarray(PALETTE[np.asarray(label).astype(np.uint8)]).resize((size, size), Image.NEAREST)
+    tmp = os.path.join(thumbs, "{}.{}.tmp".format(name, os.getpid()))
+    img.save(tmp, format="PNG")
+    os.replace(tmp, os.path.join(thumbs, name))
+    return name, True
+
+def render_page(args):
+    """Tiles of the ids of a page, the PNG sheet if asked; return the tile names of each id and the number of tiles rendered"""
+    k, ids, preds, opt = args
+    size, thumbs = int(opt.size), os.path.join(opt.output, "thumbs")
+    rows, rendered = [], 0
+    for identy in ids:
+        sources = [(os.path.join(opt.main_path, "JPEGImages", "{}.jpg".format(identy)), "image")]
+        sources += [(os.path.join(path, "{}.pkl".format(identy)), "mask") for path in preds]
+        sources += [(os.path.join(opt.main_path, "SegmentationClassAug", "{}.png".format(identy)), "gt")]
+        row = []
+        for src, kind in sources:
+            name, new = tile(src, kind, size, thumbs) if os.path.exists(src) else (None, False)
+            row.append(name)
+            rendered += new
+        rows.append(row)
+    if opt.format in ["png", "both"]:
+        head, pad = 16, 2
+        sheet = Image.new("RGB", ((size+pad)*(len(preds)+2), (size+pad+head)*len(ids)), (255, 255, 255))
+        draw = ImageDraw.Draw(sheet)
+        for r, (identy, row) in enumerate(zip(ids, rows)):
+            for c, (name, title) in enumerate(zip(row, [identy]+titles(preds)+["gt"])):
+                x, y = c*(size+pad), r*(size+pad+head)
+                draw.text((x+2, y+2), title, fill=(0, 0, 0))
+                if name is not None: sheet.paste(Image.open(os.path.join(thumbs, name)), (x, y+head))
+        sheet.save(os.path.join(opt.output, "page-{:04d}.png".format(k)))
+    return k, rows, rendered
+
+def titles(preds):
+    return [os.path.basename(os.path.normpath(path)).replace("-preds", "") for path in preds]
+
+def write_html(output, k, pages, ids, rows, preds):
+    cells = lambda row: "".join("<td>{}</td>".format('<img src="thumbs/{}">'.format(name) if name is not None else "-") for name in row)
+    with open(os.path.join(output, "page-{:04d}.html".format(k)), "w") as f:
+        f.write("<html><body><p>page {} of {} | <a href=\"index.html\">index</a>{}{}</p><table>\n".format(k+1, pages, " | <a href=\"page-{:04d}.html\">previous</a>".format(k-1) if k > 0 else "", " | <a href=\"page-{:04d}.html\">next</a>".format(k+1) if k+1 < pages else ""))
+        f.write("<tr><th>id</th><th>image</th>{}<th>gt</th></tr>\n".format("".join("<th>{}</th>".format(t) for t in titles(preds))))
+        for identy, row in zip(ids, rows): f.write("<tr><td>{}</td>{}</tr>\n".format(identy, cells(row)))
+        f.write("</table></body></html>\n")
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    preds = opt.preds.split(",") if opt.preds is not None else sorted(path for path in glob.glob("*-preds") if os.path.isdir(path))
+    if len(preds) == 0: raise Exception("no prediction directory, run `inference()` or give -p")
+    # the ids predicted by every model: one listing per directory
+    ids = set.intersection(*[set(os.path.splitext(f)[0] for f in os.listdir(path) if f.endswith(".pkl")) for path in preds])
+    if opt.id_list is not None:
+        with open(opt.id_list, "r") as f: ids = ids & set(line.strip() for line in f)
+    ids = sorted(ids)[:int(opt.num) if int(opt.num) > 0 else None]
+    if not os.path.exists(os.path.join(opt.output, "thumbs")): os.makedirs(os.path.join(opt.output, "thumbs"))
+    per_page = int(opt.rows)
+    pages = [ids[start:start+per_page] for start in range(0, len(ids), per_page)]
+    print("{} images of {} in {} pages".format(len(ids), ", ".join(titles(preds)), len(pages)))
+    start, rendered = time.time(), 0
+    with multiprocessing.Pool(int(opt.workers)) as pool:
+        for k, rows, new in pool.imap_unordered(render_page, [(k, page, preds, opt) for k, page in enumerate(pages)]):
+            rendered += new
+            if opt.format in ["html", "both"]: write_html(opt.output, k, len(pages), pages[k], rows, preds)
+    if opt.format in ["html", "both"]:
+        with open(os.path.join(opt.output, "index.html"), "w") as f:
+            f.write("<html><body><p>{} images: image | {} | gt</p><ul>\n".format(len(ids), " | ".join(titles(preds))))
+            for k, page in enumerate(pages): f.write("<li><a href=\"page-{:04d}.html\">{} .. {}</a></li>\n".format(k, page[0], page[-1]))
+            f.write("</ul></body></html>\n")
+    tiles = len(ids)*(len(preds)+2)
+    print("{} pages written to {} in {:.1f}s, {} of {} tiles rendered, the others from the cache".format(len(pages), opt.output, time.time()-start, rendered, tiles))
@@ -0,0 +1,62 @@
+import os
+import json
+import threading
+import numpy as np
+
+class loss_sampler():
+    """
+    Loss-aware sampling of the training images
+    ------------------------------------------------------------------------
+    Replaces the uniform shuffling of `dataset.next_batch`: the ids are drawn (with replacement) in proportion to an
+    exponential moving average of their recent training loss, and never below `floor` times the mean loss, so that no
+    image starves. The ids not seen yet weigh as the largest loss, so each image is seen early. The probabilities are
+    recomputed every `refresh` draws. An "epoch" is still `len(ids)` draws; the ids not drawn in it are reported as
+    skipped. The loss of a step is the data loss of the model (`loss["norm"]`, without the weight decay, which is the
+    same for every image): it is the mean over the batch, so with batch_size > 1 each id of the batch gets the batch mean.
+    """
+    def __init__(self, ids, floor=0.2, decay=0.7, refresh=256, seed=None):
+        self.ids, self.floor, self.decay, self.refresh = list(ids), floor, decay, refresh
+        self.row = {identy:k for k, identy in enumerate(self.ids)}
+        self.loss = np.full(len(self.ids), np.nan)
+        self.rng, self.lock = np.random.RandomState(seed), threading.Lock()
+        self.epoch, self.skipped = 0, []
+
+    def update(self, ids, loss):
+        """Record the loss of a training step on the images `ids` (bytes or str)"""
+        with self.lock:
+            for identy in ids:
+                k = self.row[identy.decode("utf-8") if isinstance(identy, bytes) else identy]
+                self.loss[k] = loss if np.isnan(self.loss[k]) else self.decay*self.loss[k]+(1-self.decay)*loss
+
+    def probabilities(self):
+        with self.lock:
+            seen = ~np.isnan(self.loss)
+            if not seen.any(): return np.full(len(self.ids), 1.0/len(self.ids))
+            w = np.where(seen, self.loss, np.max(self.loss[seen]))
+            w = np.maximum(w, self.floor*np.mean(self.loss[seen]))
+        return w/np.sum(w)
+
+    def __call__(self):
+        """Generator of the indexes of the ids, one epoch after the other (run by tf.data)"""
+        while True:
+            drawn = np.zeros(len(self.ids), dtype=bool)
+            for start in range(0, len(self.ids), self.refresh):
+                for k in self.rng.choice(len(self.ids), min(self.refresh, len(self.ids)-start), p=self.probabilities()):
+                    drawn[k] = True
+                    yield k
+            self.skipped.append(int(len(self.ids)-np.sum(drawn)))
+            print("[sampler] epoch {}: {} of {} images skipped ({:.1%})".format(self.epoch, self.skipped[-1], len(self.ids), self.skipped[-1]/len(self.ids)))
+            self.epoch += 1
+
+    def save(self, path):
+        with self.lock: state = {"ids":self.ids, "loss":[None if np.isnan(v) else float(v) for v in self.loss], "epoch":self.epoch, "skipped":self.skipped}
+        with open(path+".tmp", "w") as f: json.dump(state, f)
+        os.replace(path+".tmp", path)
+
+    def load(self, path):
+        """The loss history saved with the training state, the ids which are no longer in the dataset are dropped"""
+        if not os.path.exists(path): return
+        with open(path, "r") as f: state = json.load(f)
+        for identy, loss in zip(state["ids"], state["loss"]):
+            if identy in self.row and loss is not None: self.loss[self.row[identy]] = loss
+        self.epoch, self.skipped = state["epoch"], state["skipped"]
@@ -0,0 +1,145 @@
+import io
+import os
+import json
+import time
+import queue
+import threading
+import optparse
+import socketserver
+import http.server
+import types
+import numpy as np
+from PIL import Image
+
+"""
+Inference server
+----------------------
+Load a trained model once and predict the masks of the images posted to a local HTTP endpoint; the concurrent requests
+are gathered into batches of up to `-b` images, waiting at most `-d` ms after the first one. Runs on the CPU by default.
+     python serve.py -m SEC.py -r sec-saver/norm-104999 -p 8000
+     curl --data-binary @2007_000032.jpg http://127.0.0.1:8000/predict > mask.png
+ * POST /predict: body = jpg/png bytes, response = the mask (uint8 class ids) at the size of the image, as a png,
+   or as raw bytes with `/predict?format=raw` (shape in the header X-Shape)
+ * a failed prediction answers 500 with the error to the requests of its batch, the batching thread keeps serving
+ * GET /stats: requests, batches, mean batch size and failed batches
+The Grad-CAM map of GAIN-GCAM is normalized over the batch, use `-b 1` to get the same masks as single requests.
+"""
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='model', default='SEC.py', help='model script')
+    parser.add_option('-r', dest='model_path', default=None, help='checkpoint of the trained model, e.g. sec-saver/norm-104999')
+    parser.add_option('-H', dest='host', default='127.0.0.1', help='address to listen on')
+    parser.add_option('-p', dest='port', default='8000', help='port to listen on')
+    parser.add_option('-b', dest='max_batch', default='8', help='maximum number of images per batch')
+    parser.add_option('-d', dest='max_delay', default='10', help='maximum wait (ms) of the first request of a batch for the next ones')
+    parser.add_option('-j', dest='threads', default='0', help='intra/inter op threads of the session (0: one per core)')
+    parser.add_option('-w', dest='widths', default=None, help='widths.json of a pruned model (prune.py)')
+    parser.add_option('-g', dest='gpu_id', default='', help='specify to run on which GPU ("": CPU)')
+    parser.add_option('-f', dest='gpu_frac', default='0.2', help='specify the memory utilization of GPU')
+    (options, args) = parser.parse_args()
+    return options
+
+class predictor():
+    """The model restored once, predicting the masks of a batch of preprocessed images"""
+    def __init__(self, module, model_class, model_path, threads=0, gpu_frac=0.2, input_size=(321,321), widths={}):
+        import tensorflow as tf
+        from dataset import IMG_MEAN
+        self.h, self.w = input_size
+        # the model only needs the mean of the dataset, to give the origin image to the crf
+        self.model = model_class({"data":types.SimpleNamespace(img_mean=IMG_MEAN), "input_size":input_size, "category_num":21, "widths":widths})
+        self.model.build()
+        pred = self.model.net[module.PRED_LAYER]
+        self.mask = tf.cast(tf.argmax(tf.image.resize_bilinear(tf.nn.softmax(pred), input_size), axis=3), tf.uint8)
+        self.sess = tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads, gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_frac)))
+        self.model.sess = self.sess
+        self.sess.run(tf.global_variables_initializer())
+        self.model.restore_from_model(tf.train.Saver(var_list=self.model.trainable_list), model_path, checkpoint=False)
+        self.img_mean = IMG_MEAN
+
+    def preprocess(self, data):
+        """jpg/png bytes -> input of the model (BGR, mean subtracted), size of the image"""
+        img = Image.open(io.BytesIO(data)).convert("RGB")
+        return np.asarray(img.resize((self.w, self.h), Image.BILINEAR), dtype=np.float32)[:,:,::-1] - self.img_mean, img.size
+
+    def __call__(self, x):
+        return self.sess.run(self.mask, feed_dict={self.model.net["input"]:x, self.model.net["drop_prob"]:1.0})
+
+class batcher():
+    """Gather the requests of the threads of the server into batches: a batch is run when it is full or when its first request waited `max_delay` seconds"""
+    def __init__(self, predict, max_batch=8, max_delay=0.01):
+        self.predict, self.max_batch, self.max_delay = predict, max_batch, max_delay
+        self.queue, self.requests, self.batches, self.errors = queue.Queue(), 0, 0, 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, x):
+        one = {"x":x, "time":time.time(), "done":threading.Event()}
+        self.queue.put(one)
+        one["done"].wait()
+        if "error" in one: raise one["error"]
+        if "y" not in one: raise Exception("no prediction for the image of the request")
+        return one["y"]
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                timeout = batch[0]["time"]+self.max_delay-time.time()
+                if timeout <= 0: break
+                try: batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty: break
+            try:
+                for one, y in zip(batch, self.predict(np.stack([one["x"] for one in batch]))): one["y"] = y
+            except Exception as e: # given to the waiting requests, the thread goes on with the next batch
+                for one in batch: one["error"] = e
+                self.errors += 1
+            self.requests, self.batches = self.requests+len(batch), self.batches+1
+            for one in batch: one["done"].set()
+
+class handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if not self.path.startswith("/predict"): return self.send_error(404)
+        try: x, size = self.server.predictor.preprocess(self.rfile.read(int(self.headers["Content-Length"])))
+        except Exception as e: return self.send_error(400, "cannot read the image: {}".format(e))
+        try: mask = np.asarray(Image.fromarray(self.server.batcher.submit(x)).resize(size, Image.NEAREST))
+        except Exception as e: return self.send_error(500, "prediction failed: {}".format(e))
+        if self.path.endswith("format=raw"): body, content_type = mask.tobytes(), "application/octet-stream"
+        else:
+            out = io.BytesIO()
+            Image.fromarray(mask).save(out, format="PNG")
+            body, content_type = out.getvalue(), "image/png"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Shape", "{},{}".format(*mask.shape))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/stats": return self.send_error(404)
+        b = self.server.batcher
+        body = json.dumps({"requests":b.requests, "batches":b.batches, "mean_batch_size":b.requests/max(b.batches, 1), "failed_batches":b.errors}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): pass # one line per request would dominate the output
+
+class server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+    from utils import load_model
+    module, model_class = load_model(opt.model)
+    httpd = server((opt.host, int(opt.port)), handler)
+    widths = {}
+    if opt.widths is not None:
+        with open(opt.widths, "r") as f: widths = json.load(f)["widths"]
+    httpd.predictor = predictor(module, model_class, opt.model_path, threads=int(opt.threads), gpu_frac=float(opt.gpu_frac), widths=widths)
+    httpd.batcher = batcher(httpd.predictor, max_batch=int(opt.max_batch), max_delay=float(opt.max_delay)/1000)
+    print("serving {} on http://{}:{}/predict".format(opt.model_path, opt.host, opt.port))
+    httpd.serve_forever()
@@ -0,0 +1,159 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import itertools
+import subprocess
+import optparse
+import numpy as np
+
+"""
+Hyperparameter sweep
+----------------------
+Run a model script once per point of a grid or of a random search, `-j` runs at a time, each one pinned to its own
+`-t` cores with its session threads capped to them, and all reading the images from one decoded cache
+(`dataset.write_decoded`, a read-only memory map shared through the page cache)
+     python sweep.py -s sweep.json -j 4 -t 4
+sweep.json, the values are passed to the script with `-o` (config and hyperparameter overrides):
+     {"model":"GAIN-SEC.py", "fixed":{"epoches":2},
+      "grid":{"base_lr":[1e-3,5e-4], "am_th":[0.4,0.5], "crf_config":[{"bi_srgb":13},{"bi_srgb":20}]}}
+  or {"model":"SEC.py", "trials":8, "seed":0,
+      "random":{"base_lr":{"log_uniform":[1e-4,1e-2]}, "weight_decay":{"uniform":[1e-5,1e-4]}, "accum_num":{"choice":[8,16]}}}
+A run is stopped early if its logged loss is not finite, or if after `-w` iterations the mean of its last `-n` logged
+losses is `-k` times the median of the same mean of the other runs up to the same iteration (one noisy batch does not
+stop a run). The scripts run unbuffered, so `log.txt` holds the losses as they are printed. `<out>/summary.tsv` holds the table printed at the end.
+"""
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-s', dest='spec', default='sweep.json', help='sweep spec (json)')
+    parser.add_option('-o', dest='output', default=None, help='directory of the runs (default: sweep-<spec name>)')
+    parser.add_option('-j', dest='jobs', default='2', help='number of parallel runs')
+    parser.add_option('-t', dest='threads', default='4', help='cores (and session threads) per run')
+    parser.add_option('-g', dest='gpu_id', default='', help='GPUs assigned to the runs in turn, e.g. 0,1 ("": CPU)')
+    parser.add_option('-f', dest='gpu_frac', default='0.45', help='specify the memory utilization of GPU')
+    parser.add_option('-c', dest='decoded_cache', default=os.path.join("data","decoded"), help='directory of the decoded images shared by the runs ("": decode in each run)')
+    parser.add_option('-k', dest='stop_factor', default='1.5', help='stop a run whose mean loss is this many times the median of the others')
+    parser.add_option('-n', dest='window', default='5', help='number of logged losses averaged before comparing the runs')
+    parser.add_option('-w', dest='grace', default='1000', help='iterations before a run can be stopped for its loss')
+    parser.add_option('-i', dest='interval', default='10', help='seconds between two checks of the runs')
+    (options, args) = parser.parse_args()
+    return options
+
+def points(spec):
+    """The overrides of each run: every combination of `grid`, or `trials` draws of `random`"""
+    if "grid" in spec:
+        keys = sorted(spec["grid"])
+        return [dict(zip(keys, values)) for values in itertools.product(*[spec["grid"][k] for k in keys])]
+    rng, rst = np.random.RandomState(spec.get("seed", 0)), []
+    for _ in range(spec.get("trials", 8)):
+        point = {}
+        for k, dist in sorted(spec["random"].items()):
+            if "choice" in dist: point[k] = dist["choice"][rng.randint(len(dist["choice"]))]
+            elif "uniform" in dist: point[k] = float(rng.uniform(*dist["uniform"]))
+            elif "log_uniform" in dist: point[k] = float(math.exp(rng.uniform(*np.log(dist["log_uniform"]))))
+            elif "int" in dist: point[k] = int(rng.randint(dist["int"][0], dist["int"][1]+1))
+            else: raise Exception("Unknown distribution: {}".format(dist))
+        rst.append(point)
+    return rst
+
+class run():
+    LOSS = re.compile(r"(\d+)iters, lr=\S+, loss=\S*=(\S+)$") # the console line of the trainers, every 500 iterations
+    def __init__(self, k, params, path):
+        self.k, self.params, self.path = k, params, path
+        self.status, self.proc, self.losses, self.offset = "pending", None, {}, 0
+        if os.path.exists(os.path.join(path, "status.json")):
+            with open(os.path.join(path, "status.json"), "r") as f: self.status = json.load(f)["status"]
+            self.read_log()
+
+    def start(self, opt, spec, slot):
+        if not os.path.exists(self.path): os.makedirs(self.path)
+        threads = int(opt.threads)
+        overrides = dict(spec.get("fixed", {}), **self.params)
+        overrides.update({"saver_path":self.path, "threads":threads})
+        if opt.decoded_cache: overrides["decoded_cache"] = opt.decoded_cache
+        gpus = opt.gpu_id.split(",")
+        cmd = [sys.executable, "-u", spec["model"], "-g", gpus[slot % len(gpus)], "-f", opt.gpu_frac, "-o", json.dumps(overrides)]
+        cores = [(slot*threads+c) % os.cpu_count() for c in range(threads)]
+        pin = (lambda: os.sched_setaffinity(0, cores)) if hasattr(os, "sched_setaffinity") else None
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads), PYTHONUNBUFFERED="1") # the losses reach log.txt as they are printed
+        self.log = open(os.path.join(self.path, "log.txt"), "w")
+        self.proc = subprocess.Popen(cmd, stdout=self.log, stderr=subprocess.STDOUT, env=env, preexec_fn=pin)
+        self.status = "running"
+        print("[sweep] run {} started on cores {}: {}".format(self.k, cores, self.params))
+
+    def read_log(self):
+        path = os.path.join(self.path, "log.txt")
+        if not os.path.exists(path): return
+        with open(path, "r") as f:
+            f.seek(self.offset)
+            for line in f.readlines():
+                m = run.LOSS.search(line.strip())
+                if m: self.losses[int(m.group(1))] = float(m.group(2))
+            self.offset = f.tell()
+
+    def finish(self, status):
+        if self.proc is not None and self.proc.poll() is None: self.proc.terminate()
+        if self.proc is not None: self.proc.wait()
+        self.log.close()
+        self.status = status
+        with open(os.path.join(self.path, "status.json"), "w") as f: json.dump({"status":status, "params":self.params}, f)
+        print("[sweep] run {} {}".format(self.k, status))
+
+def window_mean(losses, i, window):
+    """Mean of the last `window` losses logged up to the iteration i, None if fewer were logged"""
+    last = [losses[j] for j in sorted(j for j in losses if j <= i)[-window:]]
+    return np.mean(last) if len(last) == window else None
+
+def should_stop(one, runs, factor, grace, window=5):
+    if len(one.losses) == 0: return False
+    i = max(one.losses)
+    if not np.isfinite(one.losses[i]): return True
+    mean = window_mean(one.losses, i, window)
+    others = [window_mean(r.losses, i, window) for r in runs if r is not one and len(r.losses) > 0 and max(r.losses) >= i]
+    others = [m for m in others if m is not None and np.isfinite(m)]
+    return i >= grace and mean is not None and len(others) >= 2 and mean > factor*np.median(others)
+
+def summary(runs, path):
+    rows = []
+    for one in runs:
+        last = one.losses[max(one.losses)] if len(one.losses) > 0 else float("nan")
+        best = min(one.losses.values()) if len(one.losses) > 0 else float("nan")
+        miou = float("nan") # written by `python evaluate.py -s <run dir>`, if it was run
+        if os.path.exists(os.path.join(one.path, "eval.txt")):
+            with open(os.path.join(one.path, "eval.txt"), "r") as f: miou = max([float(line.split()[1]) for line in f.readlines()] or [miou])
+        rows.append((one.k, one.status, max(one.losses) if len(one.losses) > 0 else 0, last, best, miou, json.dumps(one.params, sort_keys=True)))
+    rows.sort(key=lambda row: (row[1] != "done", row[3] if np.isfinite(row[3]) else float("inf")))
+    header = ("run", "status", "iters", "loss", "best_loss", "mIoU", "params")
+    with open(os.path.join(path, "summary.tsv"), "w") as f:
+        for row in [header]+rows: f.write("\t".join(map(str, row))+"\n")
+    print("{:>4} {:>8} {:>8} {:>10} {:>10} {:>7}  {}".format(*header))
+    for row in rows: print("{:>4} {:>8} {:>8} {:>10.5f} {:>10.5f} {:>7.4f}  {}".format(*row))
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    with open(opt.spec, "r") as f: spec = json.load(f)
+    output = opt.output if opt.output is not None else "sweep-{}".format(os.path.splitext(os.path.basename(opt.spec))[0])
+    if opt.decoded_cache:
+        from dataset import dataset
+        dataset({"input_size":(321,321), "category_num":21, "categorys":["train"]}).write_decoded(opt.decoded_cache)
+    runs = [run(k, params, os.path.join(output, "run-{}".format(k))) for k, params in enumerate(points(spec))]
+    print("[sweep] {} runs, {} already finished".format(len(runs), len([one for one in runs if one.status != "pending"])))
+    slots = list(range(int(opt.jobs)))
+    while any(one.status in ["pending", "running"] for one in runs):
+        for one in [one for one in runs if one.status == "running"]:
+            one.read_log()
+            if one.proc.poll() is not None:
+                slots.append(one.slot)
+                one.finish("done" if one.proc.returncode == 0 else "failed")
+            elif should_stop(one, runs, float(opt.stop_factor), int(opt.grace), int(opt.window)):
+                slots.append(one.slot)
+                one.finish("stopped")
+        for one in [one for one in runs if one.status == "pending"]:
+            if len(slots) == 0: break
+            one.slot = slots.pop(0)
+            one.start(opt, spec, one.slot)
+        time.sleep(float(opt.interval))
+    summary(runs, output)
@@ -0,0 +1,62 @@
+import os
+import time
+import resource
+import threading
+import collections
+import numpy as np
+import tensorflow as tf
+
+class monitor():
+    """
+    Performance telemetry of a training loop
+    ------------------------------------------------------------------------
+    Timings are taken with time.time() around the calls that are already made (no extra session call) and written
+    every `interval` steps as scalars `perf/*` to the summary writer of the model, next to the losses:
+     * images_per_sec, step_time_p50/p90/p99 (seconds between two calls to `step`)
+     * mean time per step of each timed section, e.g. iterator_wait, accumulate, apply, crf (py_func)
+     * rss_mb: resident memory of the process
+    """
+    def __init__(self, writer, interval=100):
+        self.writer, self.interval = writer, interval
+        self.times, self.lock = collections.defaultdict(list), threading.Lock()
+        self.step_times, self.images, self.last = [], 0, None
+
+    def add(self, name, seconds):
+        """Record a duration, may be called from the threads of the session (py_func)"""
+        with self.lock: self.times[name].append(seconds)
+
+    def timed(self, name):
+        return _timer(self, name)
+
+    def step(self, i, images):
+        """Called once per training step, with the number of images of the step"""
+        now = time.time()
+        if self.last is not None:
+            self.step_times.append(now-self.last)
+            self.images += images
+        self.last = now
+        if i % self.interval == 0 and len(self.step_times) > 0: self.flush(i)
+
+    def flush(self, i):
+        with self.lock: times, self.times = self.times, collections.defaultdict(list)
+        steps = len(self.step_times)
+        value = [tf.Summary.Value(tag="perf/images_per_sec", simple_value=self.images/max(sum(self.step_times), 1e-12))]
+        for p in [50, 90, 99]: value.append(tf.Summary.Value(tag="perf/step_time_p{}".format(p), simple_value=np.percentile(self.step_times, p)))
+        for name in sorted(times): value.append(tf.Summary.Value(tag="perf/{}".format(name), simple_value=sum(times[name])/steps))
+        value.append(tf.Summary.Value(tag="perf/rss_mb", simple_value=rss()/2**20))
+        self.writer.add_summary(tf.Summary(value=value), global_step=i)
+        self.step_times, self.images = [], 0
+
+class _timer():
+    def __init__(self, monitor, name):
+        self.monitor, self.name = monitor, name
+    def __enter__(self):
+        self.start = time.time()
+    def __exit__(self, *args):
+        self.monitor.add(self.name, time.time()-self.start)
+
+def rss():
+    """Resident memory (bytes) of the process, the peak one if /proc is not available"""
+    try:
+        with open("/proc/self/statm", "r") as f: return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError): return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
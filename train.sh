@@ -1,6 +1,21 @@
 # [model = SEC.py | GAIN-SEC.py | GAIN-GCAM]
 python [model].py -g 0 -f 0.45 # training
+python [model].py -g 0 -f 0.45 -s -t 1800 # resume training from the latest full state checkpoint (saved every 1800s)
+python GAIN-SEC.py -g 0 -f 0.45 -k 7 # GAIN: attention mining over chunks of 7 complement images to bound the memory
+python evaluate.py -m GAIN-SEC.py -g 0 -f 0.1 -j 2 # next to the training: mIoU of each new checkpoint on held-out ids, best one kept as best-<iter>
+python footprint.py -m GAIN-SEC.py -b 1 -a 16 -f 0.45 # memory estimate of a config, and the memory savings needed to fit in 45% of GPU 0
+python GAIN-GCAM.py -g 0 -f 0.45 -c graph-cache # import the training graph built by a previous launch with the same code and config
+python tune_threads.py -m SEC.py -b 2 -p -k 16 -o thread_profile.json && python SEC.py -g "" -j thread_profile.json # CPU node: threads of the session, the input pipeline and the crf
+python prune.py -m SEC.py -r sec-saver/norm-104999 -k 0.75,0.5,0.35 -e 1 -g 0 -f 0.45 # slimmer models, accuracy/speed curve in pruned-SEC/curve.tsv
+python SEC.py -g 0 -f 0.45 -o '{"sampler":{"floor":0.2}}' # sample the images by their recent loss, skipping the easy ones more often
+python SEC.py -g 0 -f 0.45 -o '{"async_crf":true}' # overlap the crf of a batch with the forward pass of the next one
+python distill.py -m SEC.py -r sec-saver/norm-104999 -k 0.35 -e 4 -g 0 -f 0.45 # narrow student distilled from the teacher softmax, speedup in distilled-SEC/distill.tsv
+python crf_search.py -m SEC.py -r sec-saver/norm-104999 -j 16 -g 0 -f 0.2 # mIoU of a grid of crf configs over the cached unaries, best one for -o '{"crf_config":...}'
 python3 [model].py -g 0 -f 0.05 -r 104999 -a inference # save predicted mask to disk
+python3 [model].py -g 0 -f 0.1 -r 104999 -a inference -o '{"tta":{"scales":[1.0,0.75,1.25],"flip":true}}' # average of the flipped and rescaled views, one run per image
+python multi_infer.py -m SEC.py:sec-saver/norm-104999 -m GAIN-SEC.py:gain_sec-saver/norm-104999 -g 0 -f 0.1 # the masks of several models, each image decoded once
+python3 [model].py -g 0 -f 0.05 -r 104999 -a inference -d pred-cache # only predict the masks which are not cached yet
+python report.py -p sec-preds,gain_sec-preds,gain_gcam-preds -j 8 -o report # comparison mosaics of the predicted masks, open report/index.html
 
 # tensorboard
 tensorboard --port 7778 --logdir=[model]-saver/sum
\ No newline at end of file
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import optparse
+import numpy as np
+import tensorflow as tf
+
+"""
+Test-time augmentation
+----------------------------------------------
+With config["tta"] = {"scales":[1.0,0.75,1.25], "flip":true, "merge":"41"}, `build()` makes `input` the batch of the
+views of the images fed to `tta_input` (each scale, and its horizontal flip), so that one `sess.run` predicts every
+view; `merge_views` maps the `PRED_LAYER` of each view back to the frame of its image and averages them, at 41x41 ("41")
+or at the input size ("output"). `inference()` of the model scripts uses it, `-o '{"tta":{...}}'`.
+ * a scale s > 1 zooms in on the center of the image, s < 1 zooms out and pads with the mean color (as the
+   `random_scale` augmentation); where a view does not see the image, it is left out of the average
+ * the Grad-CAM of GAIN-GCAM normalizes its weights over the batch, i.e. over the views of the image
+     python tta.py -m SEC.py -r sec-saver/norm-104999 -s 0.75,1.25    # time per image and mIoU of each added view
+"""
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='model', default='SEC.py', help='model script')
+    parser.add_option('-r', dest='model_path', default=None, help='checkpoint of the trained model, e.g. sec-saver/norm-104999')
+    parser.add_option('-w', dest='widths', default=None, help='widths.json of a pruned or distilled model')
+    parser.add_option('-s', dest='scales', default='0.75,1.25', help='scales added after the flip, one at a time')
+    parser.add_option('-e', dest='merge', default='41', help='resolution of the merge: 41 or output')
+    parser.add_option('-i', dest='id_list', default=None, help='file of the held-out ids, one per line (default: the first -n ids of data/held_out.txt, which the trainers leave out)')
+    parser.add_option('-n', dest='num', default='300', help='number of held-out ids (the size of data/held_out.txt when it is drawn)')
+    parser.add_option('-g', dest='gpu_id', default='0', help='specify to run on which GPU, "" for the CPU')
+    parser.add_option('-f', dest='gpu_frac', default='0.2', help='specify the memory utilization of GPU')
+    (options, args) = parser.parse_args()
+    return options
+
+def boxes(scale, n):
+    """The box of the view of `scale` in its image, and the box of the image in the view (normalized coordinates)"""
+    side = 1.0/scale
+    c = (1-side)/2
+    return tf.tile([[c,c,c+side,c+side]], [n,1]), tf.tile([[-c*scale,-c*scale,(1-c)*scale,(1-c)*scale]], [n,1])
+
+def count(scales=(1.0,), flip=False, **kwargs):
+    return len(scales)*(2 if flip else 1)
+
+def build_views(x, scales=(1.0,), flip=False, **kwargs):
+    """The views [V*N,h,w,C] of the images x [N,h,w,C], view after view"""
+    n, size = tf.shape(x)[0], x.shape.as_list()[1:3]
+    rst = []
+    for scale in scales:
+        view = x if scale == 1.0 else tf.image.crop_and_resize(x, boxes(scale, n)[0], tf.range(n), size, extrapolation_value=0) # 0: the mean color
+        rst += [view, tf.reverse(view, axis=[2])] if flip else [view]
+    return tf.concat(rst, axis=0)
+
+def merge_views(pred, scales=(1.0,), flip=False, merge="41", size=(321,321)):
+    """Average of the predictions [V*N,h',w',C] of the views, each one in the frame of its image, [N,h',w',C] or [N,h,w,C]"""
+    parts = tf.split(pred, count(scales, flip), axis=0)
+    n, out = tf.shape(parts[0])[0], pred.shape.as_list()[1:3] if merge == "41" else list(size)
+    total, weight, k = 0, 0, 0
+    for scale in scales:
+        for flipped in [False, True] if flip else [False]:
+            p = tf.reverse(parts[k], axis=[2]) if flipped else parts[k]
+            k += 1
+            if scale == 1.0 and out == pred.shape.as_list()[1:3]:
+                total, weight = total+p, weight+1
+                continue
+            box = boxes(scale, n)[1]
+            total += tf.image.crop_and_resize(p, box, tf.range(n), out, extrapolation_value=0)
+            weight += tf.image.crop_and_resize(tf.ones_like(p[...,:1]), box, tf.range(n), out, extrapolation_value=0)
+    return total/tf.maximum(weight, 1e-5)
+
+def evaluate(module, model_class, config, opt, data):
+    """Seconds per image and mIoU on the held-out images of the model built with `config`, as evaluate.py"""
+    from evaluate import confusion, scores
+    with tf.Graph().as_default():
+        model = model_class(dict({"data":data, "input_size":(321,321), "category_num":21}, **config))
+        x, gt, y, _, _, iterator = data.next_batch(category="train", batch_size=1, epoches=1)
+        model.build()
+        pred = merge_views(model.net[module.PRED_LAYER], size=(model.h, model.w), **config["tta"])
+        mask = tf.argmax(tf.image.resize_bilinear(tf.nn.softmax(pred), (model.h, model.w)), axis=3)
+        with tf.Session(config=tf.ConfigProto(gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=float(opt.gpu_frac)))) as sess:
+            model.sess = sess
+            sess.run(tf.global_variables_initializer())
+            model.restore_from_model(tf.train.Saver(var_list=model.trainable_list), opt.model_path, checkpoint=False)
+            sess.run(iterator.initializer)
+            conf, times = 0, []
+            while True:
+                try: data_x, data_gt, data_y = sess.run([x, gt, y])
+                except tf.errors.OutOfRangeError: break
+                feed = {model.net["tta_input"]:data_x, model.net["drop_prob"]:1.0}
+                if "label" in model.net: feed[model.net["label"]] = np.tile(data_y, (count(**config["tta"]), 1))
+                start = time.time()
+                data_mask = sess.run(mask, feed_dict=feed)
+                times.append(time.time()-start)
+                conf = conf + confusion(data_mask.reshape(-1), data_gt.reshape(-1), model.category_num, data.ignore_label)
+    return np.median(times[1:]), scores(conf)[1] # the first run allocates the memory
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+    from dataset import dataset
+    from evaluate import held_out
+    from utils import load_model
+    module, model_class = load_model(opt.model)
+    data = dataset({"input_size":(321,321), "category_num":21, "categorys":["train"]})
+    data.select(held_out(data, opt))
+    config = {}
+    if opt.widths is not None:
+        with open(opt.widths, "r") as f: config["widths"] = json.load(f)["widths"]
+    steps = [("1 view", [1.0], False), ("+flip", [1.0], True)]
+    for scale in [float(s) for s in opt.scales.split(",") if s]: steps.append(("+scale {}".format(scale), steps[-1][1]+[scale], True))
+    rows = []
+    for name, scales, flip in steps:
+        t, miou = evaluate(module, model_class, dict(config, tta={"scales":scales, "flip":flip, "merge":opt.merge}), opt, data)
+        rows.append((name, count(scales, flip), t, miou))
+        print("[tta] {}: {} views, {:.1f}ms per image, mIoU={:.4f}".format(name, rows[-1][1], 1000*t, miou))
+    print("{:>14} {:>6} {:>12} {:>10} {:>8} {:>9}".format("views", "count", "ms/image", "ms/added", "mIoU", "gain"))
+    for k, (name, n, t, miou) in enumerate(rows):
+        added = (t-rows[k-1][2])/(n-rows[k-1][1]) if k > 0 else t
+        print("{:>14} {:>6} {:>12.1f} {:>10.1f} {:>8.4f} {:>+9.4f}".format(name, n, 1000*t, 1000*added, miou, miou-rows[0][3]))
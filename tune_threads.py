@@ -0,0 +1,119 @@
+import os
+import io
+import sys
+import json
+import time
+import types
+import itertools
+import subprocess
+import optparse
+import numpy as np
+
+"""
+Thread and affinity tuner
+----------------------------------------------
+Time a short synthetic workload of a model for each combination of intra-op threads, inter-op threads, tf.data threads
+(decoding of the images) and CRF workers, each one in its own process (the thread pools of TF are set once per
+process), and write the fastest combination of training and of inference to a profile loaded with `-j`
+     python tune_threads.py -m SEC.py -b 2 -o thread_profile.json
+     python SEC.py -g "" -j thread_profile.json
+ * train: one accumulation step (forward, backward and the CRF py_func) per batch of the pipeline
+ * inference: the forward pass of the prediction layer only
+With `-p` every combination is also run pinned to the first `-k` cores, the profile then holds the cores to pin to.
+"""
+
+def parse_arg():
+    parser = optparse.OptionParser()
+    parser.add_option('-m', dest='model', default='SEC.py', help='model script')
+    parser.add_option('-b', dest='batch_size', default='1', help='batch size')
+    parser.add_option('-n', dest='iterations', default='10', help='number of timed iterations per combination')
+    parser.add_option('-k', dest='cores', default=str(os.cpu_count()), help='cores given to the job')
+    parser.add_option('-i', dest='intra', default=None, help='intra-op threads to try, e.g. 4,8 (default: cores, cores/2, cores/4)')
+    parser.add_option('-e', dest='inter', default='1,2', help='inter-op threads to try')
+    parser.add_option('-d', dest='data_threads', default='1,2,4', help='tf.data threads to try')
+    parser.add_option('-w', dest='crf_workers', default='1,2,4', help='crf workers to try (train only)')
+    parser.add_option('-p', dest='pin', action='store_true', default=False, help='also try each combination pinned to the first -k cores')
+    parser.add_option('-r', dest='roles', default='train,inference', help='workloads to tune')
+    parser.add_option('-o', dest='output', default='thread_profile.json', help='profile to write')
+    parser.add_option('-g', dest='gpu_id', default='', help='specify to run on which GPU ("": CPU)')
+    parser.add_option('--worker', dest='worker', default=None, help=optparse.SUPPRESS_HELP) # a combination, run in a child process
+    (options, args) = parser.parse_args()
+    return options
+
+def images(num=16, size=(500,375), seed=0):
+    """Random jpg bytes, of the size of the VOC images"""
+    from PIL import Image
+    rng, rst = np.random.RandomState(seed), []
+    for _ in range(num):
+        out = io.BytesIO()
+        Image.fromarray(rng.randint(0, 256, (size[1],size[0],3)).astype(np.uint8)).save(out, format="JPEG")
+        rst.append(out.getvalue())
+    return rst
+
+def workload(model_path, role, batch_size, iterations, profile):
+    """Images per second of `role` with the threads of `profile`, in this process"""
+    import tensorflow as tf
+    from dataset import IMG_MEAN
+    from utils import load_model, session_config
+    module, model_class = load_model(model_path)
+    model = model_class({"data":types.SimpleNamespace(img_mean=IMG_MEAN), "input_size":(321,321), "category_num":21, "accum_num":4, "thread_profile":profile, "crf_workers":profile.get("crf_workers",1)})
+    # the per-sample part of dataset.next_batch: decode and resize, on `data_threads` threads
+    def m(data):
+        img = tf.image.resize_images(tf.cast(tf.image.decode_jpeg(data, channels=3), tf.float32), (model.h, model.w))
+        return img[:,:,::-1] - IMG_MEAN
+    x = tf.data.Dataset.from_tensor_slices(images()).repeat().map(m, num_parallel_calls=profile.get("data_threads")).batch(batch_size).make_one_shot_iterator().get_next()
+    model.build()
+    if role == "train":
+        model.optimize(1e-3, 0.9, 5e-5)
+        target = model.net["accum_gradient_accum"]
+    else: target = model.net[module.PRED_LAYER]
+    rng = np.random.RandomState(0)
+    feed = {model.net["drop_prob"]:0.5 if role == "train" else 1.0, model.net["label"]:(rng.uniform(size=(batch_size,21)) < 0.2).astype(np.int32)}
+    if "cues" in model.net: feed[model.net["cues"]] = (rng.uniform(size=(batch_size,41,41,21)) < 0.05).astype(np.float32)
+    if "gt" in model.net: feed[model.net["gt"]] = rng.randint(0, 21, (batch_size,model.h,model.w,1))
+    with tf.Session(config=session_config(model.config, 0.9)) as sess:
+        model.sess = sess
+        sess.run(tf.global_variables_initializer())
+        for i in range(iterations+2): # the first two calls are not timed: allocation, crf pool
+            if i == 2: start = time.time()
+            feed[model.net["input"]] = sess.run(x)
+            sess.run(target, feed_dict=feed)
+    return iterations*batch_size/(time.time()-start)
+
+def combinations(opt, role):
+    cores = int(opt.cores)
+    intra = [int(v) for v in opt.intra.split(",")] if opt.intra is not None else sorted(set([cores, max(cores//2, 1), max(cores//4, 1)]), reverse=True)
+    workers = [int(v) for v in opt.crf_workers.split(",")] if role == "train" else [1]
+    pins = [None, list(range(cores))] if opt.pin else [None]
+    rst = []
+    for a, b, d, w, pin in itertools.product(intra, [int(v) for v in opt.inter.split(",")], [int(v) for v in opt.data_threads.split(",")], workers, pins):
+        rst.append(dict({"intra":a, "inter":b, "data_threads":d, "crf_workers":w}, **({"cores":pin} if pin is not None else {})))
+    return rst
+
+def measure(opt, role, profile):
+    """Run one combination in a child process, return its images per second (0 if it failed)"""
+    cmd = [sys.executable, __file__, "-m", opt.model, "-b", opt.batch_size, "-n", opt.iterations, "-g", opt.gpu_id, "--worker", json.dumps({"role":role, "profile":profile})]
+    env = dict(os.environ, OMP_NUM_THREADS=str(profile["intra"]))
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env, universal_newlines=True)
+    lines = [line for line in proc.stdout.splitlines() if line.startswith("[tune] ")]
+    return float(lines[-1].split()[1]) if proc.returncode == 0 and len(lines) > 0 else 0.0
+
+if __name__ == "__main__":
+    opt = parse_arg()
+    os.environ["CUDA_VISIBLE_DEVICES"] = opt.gpu_id
+    if opt.worker is not None:
+        worker = json.loads(opt.worker)
+        print("[tune] {}".format(workload(opt.model, worker["role"], int(opt.batch_size), int(opt.iterations), worker["profile"])))
+        sys.exit(0)
+    result = {"machine":{"cpu_count":os.cpu_count(), "cores":int(opt.cores), "model":opt.model, "batch_size":int(opt.batch_size)}}
+    for role in opt.roles.split(","):
+        rows = []
+        for profile in combinations(opt, role):
+            rows.append((measure(opt, role, profile), profile))
+            print("[{}] {:>8.2f} images/s  {}".format(role, rows[-1][0], json.dumps(profile, sort_keys=True)))
+        rows.sort(key=lambda row: -row[0])
+        assert rows[0][0] > 0, "every combination of {} failed".format(role)
+        result[role] = dict(rows[0][1], images_per_sec=rows[0][0])
+        print("[{}] best: {}".format(role, json.dumps(result[role], sort_keys=True)))
+    with open(opt.output, "w") as f: json.dump(result, f, indent=1, sort_keys=True)
+    print("profile written to {}".format(opt.output))
@@ -0,0 +1,42 @@
+import os
+import json
+import importlib.util
+
+def load_model(script):
+    """
+    Import a model script (SEC.py, GAIN-SEC.py, GAIN-GCAM.py) without running its `__main__` part
+    return: the module and its model class (`SEC` or `GAIN`)
+    """
+    name = os.path.splitext(os.path.basename(script))[0].replace("-", "_").lower()
+    spec = importlib.util.spec_from_file_location(name, script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module, getattr(module, "GAIN", None) or getattr(module, "SEC")
+
+def load_profile(path, role="train"):
+    """The thread profile of `role` ("train" or "inference") written by tune_threads.py, {} if `path` is None"""
+    if path is None: return {}
+    with open(path, "r") as f: return json.load(f).get(role, {})
+
+def session_config(config, gpu_frac):
+    """
+    ConfigProto of the session of a model: intra/inter op threads of config["thread_profile"] (tune_threads.py), else
+    config["threads"] for both (0: one per core); the process is pinned to the cores of the profile, if it has some
+    """
+    import tensorflow as tf
+    profile, threads = config.get("thread_profile") or {}, config.get("threads", 0)
+    if profile.get("cores") and hasattr(os, "sched_setaffinity"): os.sched_setaffinity(0, profile["cores"])
+    return tf.ConfigProto(intra_op_parallelism_threads=profile.get("intra", threads), inter_op_parallelism_threads=profile.get("inter", threads), gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_frac))
+
+def pruned_shape(layer, shape, widths, layers):
+    """
+    Shape of the weights of the conv/fc `layer` in a pruned model (prune.py): the output width is widths[layer] and the
+    input width is the output width of the previous conv/fc layer of `layers` (the last one for a classifier that is not
+    in `layers`); the layers that are not in `widths` keep `shape`
+    """
+    convs = [one for one in layers if one.startswith("conv") or one.startswith("fc")]
+    k = convs.index(layer) if layer in convs else len(convs)
+    shape = list(shape)
+    if layer in widths: shape[-1] = widths[layer]
+    if k > 0 and convs[k-1] in widths: shape[-2] = widths[convs[k-1]]
+    return shape